@@ -1,233 +1,84 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context, url_for, redirect, g
+import click
 import requests
 import json
-from datetime import datetime
-import sqlite3
-import qrcode
+import io
+import csv
+import tempfile
 import os
-from weasyprint import HTML
-import base64
+import hashlib
+import logging
+import sqlite3
+import time
+from datetime import datetime, timezone
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import archive
+import assets
+import bulk
+import dedup
+import erp
+import export
+import fbr_client
+import invoices
+import metrics
+import outbox
+import payload_codec
+import payloads
+import pdfs
+import qr
+import refdata
+import render_cache
+import reports
+import storage
+import totals
+import validation
+from scenarios import SCENARIOS
 
 DB_PATH = 'invoices.db'
-QR_FOLDER = 'static/qrcodes'
-os.makedirs(QR_FOLDER, exist_ok=True)
-PDF_FOLDER = "static/pdfs"
-os.makedirs(PDF_FOLDER, exist_ok=True)
+# DEBUG logs every request with the time spent in each stage
+LOG_LEVEL = os.environ.get('FBR_LOG_LEVEL', 'INFO').upper()
+os.makedirs(pdfs.PDF_FOLDER, exist_ok=True)
 
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# Logo and other assets are inlined into PDFs from memory
+app.jinja_env.globals['asset_data_uri'] = assets.data_uri
+assets.preload()
+
+# Create / migrate the schema once per process, not per request
+storage.init_db(DB_PATH)
+
+# Rendered PDFs are cached per template version, so editing invoice.html or its
+# stylesheet invalidates them
+def _invoice_template_version():
+    digest = hashlib.sha256(app.jinja_env.loader.get_source(app.jinja_env, "invoice.html")[0].encode())
+    with open(pdfs.INVOICE_CSS_PATH, "rb") as css_file:
+        digest.update(css_file.read())
+    return digest.hexdigest()[:12]
+
+INVOICE_TEMPLATE_VERSION = _invoice_template_version()
+# Last-Modified of an invoice page is when it was saved, or when the template last changed if later
+INVOICE_TEMPLATE_MODIFIED = max(os.path.getmtime(os.path.join(app.root_path, 'templates', 'invoice.html')),
+                                os.path.getmtime(pdfs.INVOICE_CSS_PATH))
+
+invoice_pages = render_cache.RenderCache(INVOICE_TEMPLATE_VERSION)
+
+# Set by warm_up(); /readyz reports not ready until then
+WARMED_UP = False
+
+
+@app.before_request
+def start_request_timing():
+    g.request_timing = metrics.start_request()
+
+@app.after_request
+def finish_request_timing(response):
+    metrics.finish_request(g.request_timing, request.endpoint or 'unmatched', response.status_code)
+    return response
 
-# Scenario configurations
-SCENARIOS = {
-    'SN001': {
-        'name': 'Standard Rate - Registered Buyer (B2B)',
-        'description': 'Sale to registered business at 18% standard rate',
-        'buyer_type': 'Registered',
-        'tax_rate': '18%',
-        'sale_type': 'Goods at standard rate (default)',
-        'info': {
-            'title': 'Business-to-Business (B2B) Sale',
-            'points': [
-                'Tax Rate: Standard rate (18%)',
-                'Buyer Type: Sales-tax registered',
-                'Input Tax Credit: Buyer can claim credit when filing',
-                'Use Case: Regular business sales of taxable goods'
-            ]
-        }
-    },
-    'SN002': {
-        'name': 'Standard Rate - Unregistered Buyer (B2C)',
-        'description': 'Sale to unregistered buyer/consumer at 18% standard rate',
-        'buyer_type': 'Unregistered',
-        'tax_rate': '18%',
-        'sale_type': 'Goods at standard rate (default)',
-        'info': {
-            'title': 'Business-to-Consumer (B2C) Sale',
-            'points': [
-                'Tax Rate: Standard rate (18%)',
-                'Buyer Type: Not sales-tax registered (end consumer)',
-                'Input Tax Credit: Buyer CANNOT claim credit',
-                'Use Case: Selling products to end consumers'
-            ]
-        }
-    },
-    'SN005': {
-        'name': 'Reduced-Rate Sale',
-        'description': 'Sale of goods at reduced tax rate (lower than standard 18%)',
-        'buyer_type': 'Unregistered',
-        'tax_rate': '1%',
-        'sale_type': 'Goods at Reduced Rate',
-        'info': {
-            'title': 'Reduced-Rate Goods Sale',
-            'points': [
-                'Tax Rate: Reduced rate (1% or other lower rate, not standard 18%)',
-                'Applicable when law sets a lower tax percentage',
-                'Buyer Type: Unregistered',
-                'Requires correct reduced tax rate in invoice',
-                'SRO Schedule reference required'
-            ]
-        }
-    },
-    'SN006': {
-        'name': 'Exempt Goods Sale',
-        'description': 'Sale of goods that are exempt from Sales Tax',
-        'buyer_type': 'Registered',
-        'tax_rate': 'Exempt',
-        'sale_type': 'Exempt goods',
-        'info': {
-            'title': 'Sales Tax Exempt Goods',
-            'points': [
-                'Tax Rate: Exempt (no sales tax charged)',
-                'Buyer Type: Registered',
-                'No normal sales tax is charged',
-                'Invoice must be marked as exempt sale',
-                'SRO Schedule reference required (e.g., 6th Schedule Table I)'
-            ]
-        }
-    },
-    'SN007': {
-        'name': 'Zero-Rated Sale',
-        'description': 'Sale of goods taxed at zero rate (exports & certain goods)',
-        'buyer_type': 'Unregistered',
-        'tax_rate': '0%',
-        'sale_type': 'Goods at zero-rate',
-        'info': {
-            'title': 'Zero-Rated Goods Sale',
-            'points': [
-                'Tax Rate: Zero-rate (0% - tax applied but at zero)',
-                'Buyer Type: Unregistered',
-                'Buyers may still claim input tax credit',
-                'Common for exports and internationally traded goods',
-                'SRO number required (e.g., 327(I)/2008)'
-            ]
-        }
-    },
-    'SN008': {
-        'name': 'Sale of 3rd Schedule Goods',
-        'description': 'Goods listed in 3rd Schedule with special tax treatment',
-        'buyer_type': 'Unregistered',
-        'tax_rate': '18%',
-        'sale_type': '3rd Schedule Goods',
-        'info': {
-            'title': '3rd Schedule Goods Sale',
-            'points': [
-                'Tax Rate: Standard 18% (or as per specific SRO)',
-                'Goods listed in 3rd Schedule of Sales Tax Act',
-                'Special tax treatment or specific pricing master rules',
-                'Buyer Type: Unregistered',
-                'Examples: daily-essential items, regulated products',
-                'Fixed/Notified value may be required'
-            ]
-        }
-    },
-    'SN016': {
-        'name': 'Processing/Conversion of Goods',
-        'description': 'Processing or converting goods (toll manufacturing)',
-        'buyer_type': 'Unregistered',
-        'tax_rate': '5%',
-        'sale_type': 'Processing/Conversion of Goods',
-        'info': {
-            'title': 'Processing/Conversion Service',
-            'points': [
-                'Tax Rate: 5%',
-                'Activity: Processing or converting goods on behalf of someone',
-                'Buyer Type: Unregistered',
-                'Common in toll processing/manufacturing arrangements',
-                'Buyer may not be typical reseller',
-                'Service-based transaction'
-            ]
-        }
-    },
-    'SN017': {
-        'name': 'Goods with FED in ST Mode',
-        'description': 'Goods where FED is charged in Sales Tax mode',
-        'buyer_type': 'Unregistered',
-        'tax_rate': '8%',
-        'sale_type': 'Goods (FED in ST Mode)',
-        'info': {
-            'title': 'FED in Sales Tax Mode',
-            'points': [
-                'Tax Rate: 8% (or as applicable)',
-                'Federal Excise Duty (FED) applied in sales tax mode',
-                'Buyer Type: Unregistered',
-                'Requires correct FED fields in invoice',
-                'Both sales tax and FED may apply',
-                'Assign correct rates for both taxes'
-            ]
-        }
-    },
-    'SN024': {
-        'name': 'Goods per SRO 297(I)/2023',
-        'description': 'Goods with unique tax rules under SRO 297(I)/2023',
-        'buyer_type': 'Unregistered',
-        'tax_rate': '25%',
-        'sale_type': 'Goods as per SRO.297(|)/2023',
-        'info': {
-            'title': 'SRO 297(I)/2023 Specific Goods',
-            'points': [
-                'Tax Rate: 25% (or as defined in SRO)',
-                'Goods specifically defined in SRO 297(I)/2023',
-                'Buyer Type: Unregistered',
-                'Unique tax rules or fixed sales tax percentage',
-                'May have mandated schedules or fixed notified values',
-                'SRO Schedule and Item Serial No. required'
-            ]
-        }
-    },
-    'SN026': {
-        'name': 'Retail Sale - Standard Rate (B2C)',
-        'description': 'Retail sale to end consumer at standard 18% rate',
-        'buyer_type': 'Unregistered',
-        'tax_rate': '18%',
-        'sale_type': 'Goods at standard rate (default)',
-        'info': {
-            'title': 'Retail B2C Sale - Standard Rate',
-            'points': [
-                'Tax Rate: Standard 18%',
-                'Buyer Type: End consumer (unregistered)',
-                'Retail business-to-consumer transaction',
-                'Tax clearly applied at standard rate',
-                'Typical retail store sale to individual customer'
-            ]
-        }
-    },
-    'SN027': {
-        'name': 'Retail Sale - 3rd Schedule Goods',
-        'description': 'Retail sale of 3rd Schedule goods to consumer',
-        'buyer_type': 'Unregistered',
-        'tax_rate': '18%',
-        'sale_type': '3rd Schedule Goods',
-        'info': {
-            'title': 'Retail B2C Sale - 3rd Schedule Goods',
-            'points': [
-                'Tax Rate: 18% (or as per schedule)',
-                'Buyer Type: End consumer (unregistered)',
-                'Goods from 3rd Schedule (special tax rules)',
-                'Specific pricing and SRO schedule requirements',
-                'Regulated consumer products sold by retailers',
-                'Fixed/Notified value may be required'
-            ]
-        }
-    },
-    'SN028': {
-        'name': 'Retail Sale - Reduced Rate (B2C)',
-        'description': 'Retail sale to consumer at reduced tax rate',
-        'buyer_type': 'Unregistered',
-        'tax_rate': '1%',
-        'sale_type': 'Goods at Reduced Rate',
-        'info': {
-            'title': 'Retail B2C Sale - Reduced Rate',
-            'points': [
-                'Tax Rate: Reduced rate (1% or other lower rate)',
-                'Buyer Type: End consumer (unregistered)',
-                'Retail B2C transaction',
-                'Reduced rate must be correctly applied',
-                'SRO Schedule reference required',
-                'Fixed/Notified value required'
-            ]
-        }
-    }
-}
 
 @app.route('/')
 def index():
@@ -237,57 +88,382 @@ def index():
 def form(scenario_id):
     if scenario_id not in SCENARIOS:
         return "Scenario not found", 404
-    return render_template('form.html', scenario_id=scenario_id, scenario=SCENARIOS[scenario_id])
+    conn = storage.get_connection()
+    # Short lists go into the page; HS codes and SRO serials are looked up from /ref as they are typed
+    return render_template('form.html', scenario_id=scenario_id, scenario=SCENARIOS[scenario_id],
+                           idempotency_key=outbox.new_key(),
+                           uoms=refdata.search(conn, 'uoms', limit=refdata.MAX_SUGGESTIONS),
+                           sro_schedules=refdata.search(conn, 'sro_schedules', scope=scenario_id,
+                                                        limit=refdata.MAX_SUGGESTIONS))
 
 @app.route("/invoice/<invoice_id>")
 def print_invoice(invoice_id):
-    invoice = get_invoice_from_db(invoice_id)
+    """The printable invoice page, rendered once per template version and revalidated with ETags"""
+    etag = invoice_pages.etag(invoice_id)
+    if etag in request.if_none_match:
+        return invoice_page_response(Response(status=304), etag)
+
+    page = invoice_pages.get(invoice_id)
+    if page is None:
+        invoice = get_invoice_from_db(invoice_id)
+
+        if not invoice:
+            return "Invoice not found", 404
+
+        invoice["qr_code"] = url_for("qr_code", invoice_number=invoice_id)
+
+        with metrics.timer('render'):
+            html = render_template(
+                "invoice.html",
+                invoice=invoice
+            )
+        last_modified = max(_timestamp(invoice['created_at']), INVOICE_TEMPLATE_MODIFIED)
+        page = invoice_pages.put(invoice_id, html.encode('utf-8'), last_modified)
+
+    response = invoice_page_response(Response(page.html, mimetype='text/html'), etag)
+    response.last_modified = page.last_modified
+    return response.make_conditional(request)
+
+def invoice_page_response(response, etag):
+    response.set_etag(etag)
+    # Cacheable anywhere, but checked every time, so a template change is picked up
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+def _timestamp(created_at):
+    """Unix time of a SQLite CURRENT_TIMESTAMP value (UTC)"""
+    try:
+        return datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
 
-    if not invoice:
-        return "Invoice not found", 404
+@app.route("/qr/<invoice_number>")
+def qr_code(invoice_number):
+    """QR code image for a saved invoice (?format=svg for SVG). Images never change, so cache hard."""
+    fmt = request.args.get("format", "png")
+    if fmt not in qr.MIMETYPES:
+        return "Unsupported format", 400
 
-    return render_template(
-        "invoice.html",
-        invoice=invoice
-    )
+    etag = qr.etag(invoice_number, fmt)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        period = None
+        if not invoice_exists(invoice_number):
+            period = archive.period_of_invoice(storage.get_connection(), invoice_number)
+            if period is None:
+                return "Invoice not found", 404
+        image = None
+        if period is not None:
+            image = archive.read_artifact(period, archive.qr_member(invoice_number, fmt))
+        if image is None:
+            # Not stored again for an archived invoice: the archive is where its images belong
+            image = qr.image_bytes(invoice_number, fmt, persist=qr.QR_PERSIST and period is None)
+        response = Response(image, mimetype=qr.MIMETYPES[fmt])
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response
 
 @app.route("/invoice/<invoice_id>/pdf")
 def print_invoice_pdf(invoice_id):
-    # Fetch invoice from DB
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM invoices WHERE invoice_number = ?", (invoice_id,))
-    row = cursor.fetchone()
-    conn.close()
-
-    if not row:
-        return "Invoice not found", 404
-
-    invoice = {
-        "invoice_number": row["invoice_number"],
-        "scenario_id": row["scenario_id"],
-        "created_at": row["created_at"],
-        "payload": json.loads(row["payload"])
-    }
+    invoice = get_invoice_from_db(invoice_id)
 
-    # QR code path
-    qr_path = os.path.join(QR_FOLDER, f"{invoice_id}.png")
-    if os.path.exists(qr_path):
-        invoice["qr_code"] = qr_path
-    else:
-        invoice["qr_code"] = None
+    if not invoice:
+        return "Invoice not found", 404
 
-    # Render HTML to string
-    html_out = render_template("invoice.html", invoice=invoice)
+    if invoice['archive_period']:
+        # As it was rendered when the invoice was archived
+        data = archive.read_artifact(invoice['archive_period'], archive.pdf_member(invoice_id))
+        if data is not None:
+            return send_file(io.BytesIO(data), mimetype='application/pdf', as_attachment=True,
+                             download_name=f"Invoice_{invoice_id}.pdf")
 
-    # Generate PDF
-    pdf_path = os.path.join(PDF_FOLDER, f"{invoice_id}.pdf")
-    HTML(string=html_out, base_url=".").write_pdf(pdf_path)
+    # Serve the cached PDF straight from disk when it is up to date
+    pdf_path = pdfs.artifact_path(invoice_id, invoice_pdf_hash(invoice))
+    if not os.path.exists(pdf_path):
+        try:
+            with metrics.timer('pdf_render'):
+                pdf_path = schedule_invoice_pdf(invoice).result(timeout=pdfs.PDF_WAIT_SECONDS)
+        except FutureTimeoutError:
+            return jsonify(invoice_pdf_status_data(invoice)), 202
+        except Exception as e:
+            return f"PDF generation failed: {e}", 500
 
     # Return PDF as download
     return send_file(pdf_path, as_attachment=True, download_name=f"Invoice_{invoice_id}.pdf")
 
+@app.route("/invoice/<invoice_id>/pdf/status")
+def invoice_pdf_status(invoice_id):
+    invoice = get_invoice_from_db(invoice_id)
+
+    if not invoice:
+        return jsonify({'error': 'Invoice not found'}), 404
+
+    return jsonify(invoice_pdf_status_data(invoice))
+
+
+# ----------------- INVOICE LISTING -----------------
+@app.route('/invoices')
+def list_invoices():
+    """Saved invoices, newest first, as HTML or JSON (?format=json or Accept: application/json).
+
+    Query parameters: scenario, from, to (invoice date, YYYY-MM-DD), buyer (NTN/CNIC),
+    min_amount, max_amount, q (search buyer name and item descriptions), limit and cursor.
+    """
+    want_json = wants_json()
+    filters = dict(
+        scenario_id=request.args.get('scenario') or None,
+        date_from=request.args.get('from') or None,
+        date_to=request.args.get('to') or None,
+        buyer_ntn_cnic=request.args.get('buyer') or None,
+        search=request.args.get('q') or None,
+    )
+    try:
+        min_amount = _optional_float(request.args.get('min_amount'))
+        max_amount = _optional_float(request.args.get('max_amount'))
+        limit = int(request.args.get('limit') or invoices.LIST_PAGE_SIZE)
+        rows, next_cursor = invoices.list_invoices(
+            storage.get_connection(), min_amount=min_amount, max_amount=max_amount,
+            cursor=request.args.get('cursor') or None, limit=limit, **filters
+        )
+    except ValueError as e:
+        if want_json:
+            return jsonify({'error': str(e)}), 400
+        return f"Invalid filter: {e}", 400
+
+    results = [invoice_summary(row) for row in rows]
+    if want_json:
+        return jsonify({'invoices': results, 'next_cursor': next_cursor})
+
+    args = request.args.to_dict()
+    first_url = url_for('list_invoices', **{k: v for k, v in args.items() if k != 'cursor'})
+    next_url = url_for('list_invoices', **dict(args, cursor=next_cursor)) if next_cursor else None
+    return render_template('invoices.html', invoices=results, first_url=first_url, next_url=next_url,
+                           args=request.args, scenarios=SCENARIOS)
+
+def wants_json():
+    return json_requested(request.args, request.accept_mimetypes)
+
+def json_requested(args, accept_mimetypes):
+    """Whether a request asks for JSON: ``?format=json``, or JSON as its best Accept match (shared with asgi.py)"""
+    return args.get('format') == 'json' or accept_mimetypes.best == 'application/json'
+
+def invoice_summary(row):
+    summary = dict(row)
+    summary['grand_total'] = totals.from_paisa(row['grand_total'])
+    return summary
+
+def _optional_float(value):
+    if value is None or value.strip() == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError(f'{value!r} is not a number')
+
+# ----------------- REPORTS -----------------
+@app.route('/reports/summary')
+def reports_summary():
+    """Sales tax totals from the daily aggregates, as JSON or CSV (?format=csv).
+
+    Query parameters: from, to (invoice date, YYYY-MM-DD), scenario and group_by,
+    a comma separated list of day, month, scenario, province, buyer_type, rate, hs_code.
+    """
+    group_by = _split_values(request.args.getlist('group_by'))
+    try:
+        rows = reports.summary(
+            storage.get_connection(), group_by,
+            date_from=request.args.get('from') or None,
+            date_to=request.args.get('to') or None,
+            scenario_id=request.args.get('scenario') or None,
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if request.args.get('format') == 'csv':
+        return Response(report_csv(rows), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=sales_tax_summary.csv'})
+    return jsonify({'group_by': group_by, 'rows': rows})
+
+@app.cli.command('report')
+@click.option('--from', 'date_from', help='First invoice date (YYYY-MM-DD)')
+@click.option('--to', 'date_to', help='Last invoice date (YYYY-MM-DD)')
+@click.option('--scenario', 'scenario_id', help='Only this scenario, e.g. SN001')
+@click.option('--group-by', multiple=True, help=f"Dimension to group by (repeatable): {', '.join(reports.DIMENSIONS)}")
+@click.option('--format', 'report_format', type=click.Choice(['table', 'csv', 'json']), default='table', show_default=True)
+def report_command(date_from, date_to, scenario_id, group_by, report_format):
+    """Print a sales tax summary from the daily aggregates."""
+    try:
+        rows = reports.summary(storage.get_connection(), _split_values(group_by),
+                               date_from=date_from, date_to=date_to, scenario_id=scenario_id)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    if report_format == 'json':
+        click.echo(json.dumps(rows, default=str, indent=2))
+    elif report_format == 'csv':
+        click.echo(report_csv(rows), nl=False)
+    elif rows:
+        columns = list(rows[0])
+        cells = [columns] + [['' if row[column] is None else str(row[column]) for column in columns] for row in rows]
+        widths = [max(len(line[index]) for line in cells) for index in range(len(columns))]
+        for line in cells:
+            click.echo('  '.join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip())
+
+@app.cli.command('rebuild-reports')
+def rebuild_reports_command():
+    """Recompute the report aggregates from every saved invoice."""
+    count = storage.run_write(reports.rebuild)
+    click.echo(f"Aggregated {count} invoices")
+
+def report_csv(rows):
+    buffer = io.StringIO()
+    if rows:
+        writer = csv.DictWriter(buffer, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return buffer.getvalue()
+
+
+# ----------------- STORAGE -----------------
+@app.cli.command('recode-payloads')
+@click.option('--codec', type=click.Choice(sorted(payload_codec.CODECS)), default=payload_codec.CODEC,
+              show_default=True, help='Codec to rewrite the payloads with')
+@click.option('--train', is_flag=True, help='Train a new compression dictionary on recent invoices first')
+@click.option('--samples', default=payload_codec.TRAINING_SAMPLES, show_default=True,
+              help='Invoices to train the dictionary on')
+@click.option('--batch-size', default=payload_codec.RECODE_BATCH_SIZE, show_default=True,
+              help='Invoices rewritten per transaction')
+def recode_payloads_command(codec, train, samples, batch_size):
+    """Rewrite stored invoice payloads with a codec, a batch at a time."""
+    try:
+        payload_codec.CODECS[codec].check()
+        if train:
+            dictionary_id = storage.run_write(payload_codec.train, codec, samples)
+            click.echo(f"Trained dictionary {dictionary_id}" if dictionary_id else "No invoices to train on", err=True)
+    except (ValueError, RuntimeError) as e:
+        raise click.ClickException(str(e))
+
+    last_id = read = rewritten = 0
+    while True:
+        # One short transaction per batch, so submissions carry on meanwhile
+        last_id, batch_read, batch_rewritten = storage.run_write(payload_codec.recode_batch, codec, last_id, batch_size)
+        if not batch_read:
+            break
+        read += batch_read
+        rewritten += batch_rewritten
+        click.echo(f"{read} invoices read, {rewritten} rewritten", err=True)
+
+    for line in payload_codec.stats(storage.get_connection()):
+        dictionary = f" (dictionary {line['dictionary']})" if line['dictionary'] else ''
+        click.echo(f"{line['codec']}{dictionary}: {line['invoices']} invoices, {line['bytes']} bytes")
+    if codec != payload_codec.CODEC:
+        click.echo(f"Set FBR_PAYLOAD_CODEC={codec} so new invoices are written with it too", err=True)
+
+@app.cli.command('archive-invoices')
+@click.option('--older-than', 'months', type=click.IntRange(min=0), default=archive.ARCHIVE_AFTER_MONTHS,
+              show_default=True, help='Archive invoices saved more than this many whole months ago')
+@click.option('--dry-run', is_flag=True, help='Only list the months that would be archived')
+@click.option('--vacuum', is_flag=True, help='Shrink invoices.db afterwards (blocks writes while it runs)')
+@click.option('--batch-size', default=archive.ARCHIVE_BATCH_SIZE, show_default=True,
+              help='Invoices moved per transaction')
+def archive_invoices_command(months, dry_run, vacuum, batch_size):
+    """Move old invoices into per-month archive files, with their PDFs and QR codes."""
+    cutoff = archive.cutoff(months)
+    due = archive.due_periods(storage.get_connection(), cutoff)
+    if not due:
+        click.echo(f"No invoices saved before {cutoff}")
+        return
+    for period, count in due:
+        if dry_run:
+            click.echo(f"{period}: {count} invoices")
+            continue
+        moved = archive.archive_period(period, batch_size,
+                                       progress=lambda moved: click.echo(f"{period}: {moved} invoices moved", err=True))
+        click.echo(f"{period}: {moved} invoices archived to {archive.database_path(period)}")
+    if vacuum and not dry_run:
+        # Deleted rows leave free pages that new invoices reuse; VACUUM hands them back to the disk
+        conn = storage.connect()
+        try:
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+
+
+# ----------------- REFERENCE DATA -----------------
+@app.route('/ref')
+def reference_lists():
+    """Which reference lists are loaded, from where and when"""
+    return jsonify({'lists': refdata.lists(storage.get_connection())})
+
+@app.route('/ref/<kind>')
+def reference_data(kind):
+    """Entries of a reference list for autocomplete.
+
+    Query parameters: q (code or description prefix), scope (the scenario, or
+    the SRO schedule for sro_items) and limit. Browsers reuse an answer for
+    FBR_REFDATA_MAX_AGE seconds, then revalidate it with an ETag that changes
+    when the list is loaded again.
+    """
+    if kind not in refdata.KINDS:
+        return jsonify({'error': f'Unknown reference list {kind}'}), 404
+    conn = storage.get_connection()
+    etag = f"{kind}-{refdata.version(conn, kind)}-{hashlib.sha256(request.query_string).hexdigest()[:16]}"
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        try:
+            limit = int(request.args.get('limit') or refdata.SUGGESTIONS)
+        except ValueError:
+            return jsonify({'error': 'limit must be a whole number'}), 400
+        items = refdata.search(conn, kind, request.args.get('q', ''), request.args.get('scope', ''), limit)
+        response = jsonify({'kind': kind, 'items': items})
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = refdata.MAX_AGE
+    return response
+
+@app.cli.command('load-refdata')
+@click.argument('kind', type=click.Choice(list(refdata.KINDS)))
+@click.argument('source_file', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option('--defaults', is_flag=True, help='Put back the shipped defaults instead')
+def load_refdata_command(kind, source_file, defaults):
+    """Replace a reference list with the entries of a CSV or JSON file.
+
+    CSV files need a code column, and may have description and scope columns
+    (scope: the scenario for rates and sro_schedules, the SRO schedule for
+    sro_items). JSON files hold a list of objects with the same keys, or a
+    list saved from FBR's reference API.
+    """
+    if defaults == bool(source_file):
+        raise click.UsageError('Give either a file or --defaults')
+    try:
+        if defaults:
+            count = refdata.load(kind, refdata.default_rows(kind), refdata.DEFAULTS)
+        else:
+            count = refdata.load(kind, refdata.read_file(source_file), os.path.abspath(source_file))
+    except (ValueError, OSError) as e:
+        raise click.ClickException(str(e))
+    click.echo(f"{kind}: {count} entries loaded")
+
+@app.cli.command('refresh-refdata')
+@click.option('--kind', 'kinds', multiple=True, type=click.Choice(refdata.FBR_KINDS),
+              help='List to refresh (default: every list FBR publishes)')
+@click.option('--url', default=refdata.FBR_URL, show_default=True, help="Base URL of FBR's reference API")
+@click.option('--token', envvar='FBR_BEARER_TOKEN', required=True, help='Bearer token (without Bearer keyword)')
+def refresh_refdata_command(kinds, url, token):
+    """Replace the HS code and unit of measure lists with FBR's current ones."""
+    for kind in kinds or refdata.FBR_KINDS:
+        try:
+            count = refdata.load(kind, refdata.fetch(kind, token, url), url)
+        except (ValueError, RuntimeError, requests.exceptions.RequestException) as e:
+            raise click.ClickException(f"{kind}: {e}")
+        click.echo(f"{kind}: {count} entries loaded from {url}")
 
 
 # ----------------- SUBMIT ROUTE -----------------
@@ -295,522 +471,620 @@ def print_invoice_pdf(invoice_id):
 def submit(scenario_id):
     payload = None  # Ensure payload exists in exception handling
     try:
-        form_data = request.form.to_dict()
+        # A JSON object body may carry its items as an "items" array instead of item_<n>_* fields
+        form_data = request.get_json() if request.is_json else request.form.to_dict()
+        if not isinstance(form_data, dict):
+            raise ValueError('JSON body must be an object')
         api_url = form_data.get('api_url')
         bearer_token = form_data.get('bearer_token')
 
-        # Map scenarios to payload builders
-        payload_builders = {
-            'SN001': build_sn001_payload,
-            'SN002': build_sn002_payload,
-            'SN005': build_sn005_payload,
-            'SN006': build_sn006_payload,
-            'SN007': build_sn007_payload,
-            'SN008': build_sn008_payload,
-            'SN016': build_sn016_payload,
-            'SN017': build_sn017_payload,
-            'SN024': build_sn024_payload,
-            'SN026': build_sn026_payload,
-            'SN027': build_sn027_payload,
-            'SN028': build_sn028_payload,
-        }
-
-        if scenario_id not in payload_builders:
+        if scenario_id not in payloads.BUILDERS:
             return jsonify({'error': f'Scenario {scenario_id} not implemented yet'}), 400
 
         # Build JSON payload
-        payload = payload_builders[scenario_id](form_data)
-
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {bearer_token}'
-        }
-
-        # Send request to API
-        response = requests.post(api_url, json=payload, headers=headers)
-
-        # Safe JSON parsing
-        try:
-            response_data = response.json()
-        except ValueError:
-            response_data = {'raw_response': response.text}
+        with metrics.timer('payload_build'):
+            payload = build_payload(scenario_id, form_data)
+
+        # Rejected here rather than by FBR: no API call, no rate-limit budget spent
+        with metrics.timer('validate'):
+            errors = validation.validate(scenario_id, payload)
+        if errors:
+            return submit_response({
+                'success': False,
+                'error': f'{len(errors)} problem(s) found before sending to FBR',
+                'validation_errors': errors,
+                'request_payload': payload
+            }, 422)
+
+        # Answered with the invoice FBR already issued for the same payload, unless sent again on purpose
+        payload_hash = None
+        if str(form_data.get('allow_duplicate', '')).lower() not in ('1', 'true', 'on', 'yes'):
+            with metrics.timer('dedup'):
+                payload_hash = dedup.payload_hash(payload)
+                invoice_number = dedup.issued_invoice(storage.get_connection(), payload_hash)
+            if invoice_number:
+                return submit_response(dedup.duplicate_result(payload, invoice_number))
 
-        result = {
-            'status_code': response.status_code,
-            'success': False,
-            'request_payload': payload,
-            'response_data': response_data,
-            'response_headers': dict(response.headers)
-        }
+        if outbox.ENABLED:
+            # Saved before anything is sent, so a slow or unavailable FBR doesn't lose the invoice
+            with metrics.timer('outbox_enqueue'):
+                try:
+                    entry = outbox.enqueue(scenario_id, payload, api_url, bearer_token,
+                                           form_data.get('idempotency_key'), payload_hash)
+                except outbox.KeyConflict as e:
+                    return submit_response({'success': False, 'error': str(e), 'request_payload': payload}, 409)
+            with metrics.timer('outbox_wait'):
+                entry = outbox.wait(entry['idempotency_key'])
+            return submit_response(outbox.result(entry), 200 if entry['status'] in outbox.SETTLED else 202)
 
-        # Save invoice and generate QR code if invoiceNumber exists
-        invoice_number = None
-        if response.status_code == 200 and isinstance(response_data, dict):
-            invoice_number = response_data.get('invoiceNumber')
+        if payload_hash is None:
+            result = post_invoice(scenario_id, payload, api_url, bearer_token)
+        else:
+            result = post_invoice_once(scenario_id, payload, api_url, bearer_token, payload_hash)
 
-            if invoice_number:
-                result['success'] = True
-                # Connect to DB and create table if not exists
-                conn = sqlite3.connect(DB_PATH)
-                cursor = conn.cursor()
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS invoices (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        invoice_number TEXT UNIQUE,
-                        scenario_id TEXT,
-                        payload TEXT,
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                cursor.execute(
-                    "INSERT OR IGNORE INTO invoices (invoice_number, scenario_id, payload) VALUES (?, ?, ?)",
-                    (invoice_number, scenario_id, json.dumps(payload))
-                )
-                conn.commit()
-                conn.close()
-
-                import time
-
-                # ... inside submit function ...
-
-                # 1. Setup STRICT Version 2
-                qr = qrcode.QRCode(
-                    version=2, 
-                    error_correction=qrcode.constants.ERROR_CORRECT_L,
-                    box_size=3,
-                    border=4,
-                )
-                
-                # 2. Add Data
-                qr.add_data(invoice_number) 
-
-                # 3. Force Build
-                qr.make(fit=False)
-
-                # --- THE TRUTH CHECK ---
-                matrix = qr.get_matrix()
-                width = len(matrix)
-                print(f"DEBUG: QR Version reported: {qr.version}")
-                print(f"DEBUG: Actual Grid Width: {width} squares")
-                
-                if width == 21:
-                    print("RESULT: This is VERSION 1 (Incorrect)")
-                elif width == 25:
-                    print("RESULT: This is VERSION 2 (Correct!)")
-                # -----------------------
-
-                qr_img = qr.make_image(fill_color="black", back_color="white")
-                
-                # 4. SAVE WITH TIMESTAMP (Bypasses Cache)
-                timestamp = int(time.time())
-                unique_filename = f"{invoice_number}.png"
-                qr_path = os.path.join(QR_FOLDER, unique_filename)
-                qr_img.save(qr_path)
-                
-                print(f"SAVED TO: {qr_path}")
-                # Add QR path for rendering
-                result['qr_code'] = f'/static/qrcodes/{invoice_number}.png'
-
-        return render_template(
-    'result.html',
-    result=result,
-    invoice_id=invoice_number
-)
+        return submit_response(result)
 
 
     except requests.exceptions.RequestException as e:
-        return render_template('result.html', result={
+        return submit_response({
             'success': False,
             'error': str(e),
             'request_payload': payload
         })
     except Exception as e:
-        return render_template('result.html', result={
+        return submit_response({
             'success': False,
             'error': f'Application error: {str(e)}',
             'request_payload': payload
         })
 
-
-# ---------------- HELPER FUNCTIONS -----------------
-def get_invoice_from_db(invoice_number):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-
-    cursor.execute(
-        "SELECT * FROM invoices WHERE invoice_number = ?",
-        (invoice_number,)
+def submit_response(result, status=200):
+    """The submit result as result.html, or as JSON for API clients (Accept: application/json)"""
+    if wants_json():
+        return jsonify(result), status
+    with metrics.timer('render'):
+        return render_template('result.html', result=result, invoice_id=result.get('invoice_number')), status
+
+
+# ----------------- OUTBOX -----------------
+@app.route('/outbox')
+def outbox_status():
+    """Queue depth, drain rate and the entries that need attention, as HTML or JSON"""
+    conn = storage.get_connection()
+    stats = outbox.stats(conn)
+    problems = outbox.entries(conn, (outbox.HELD, outbox.DEAD, outbox.REJECTED))
+    if wants_json():
+        return jsonify(dict(stats, problems=problems))
+    waiting = outbox.entries(conn, (outbox.PENDING, outbox.SENDING))
+    return render_template('outbox.html', stats=stats, problems=problems, waiting=waiting)
+
+@app.route('/outbox/<key>')
+def outbox_entry(key):
+    entry = outbox.get(key)
+    if entry is None:
+        return "Outbox entry not found", 404
+    result = outbox.result(entry)
+    if wants_json():
+        return jsonify(result)
+    return render_template('result.html', result=result, invoice_id=result['invoice_number'])
+
+@app.route('/outbox/<key>/retry', methods=['POST'])
+def outbox_retry(key):
+    storage.run_write(outbox.retry, [key])
+    return redirect(url_for('outbox_entry', key=key))
+
+@app.cli.command('outbox-retry')
+@click.argument('keys', nargs=-1)
+@click.option('--status', type=click.Choice(sorted(outbox.RETRYABLE)), default=outbox.HELD, show_default=True,
+              help='Requeue every entry with this status when no keys are given')
+def outbox_retry_command(keys, status):
+    """Requeue held or dead outbox entries for sending."""
+    count = storage.run_write(outbox.retry, list(keys) or None, None if keys else status)
+    click.echo(f"{count} outbox entries requeued")
+
+@app.route('/validate/<scenario_id>', methods=['POST'])
+def validate_invoice(scenario_id):
+    """Check a form / JSON invoice against the scenario's rules without sending it"""
+    form_data = request.get_json(silent=True) if request.is_json else request.form.to_dict()
+    if not isinstance(form_data, dict):
+        return jsonify({'error': 'JSON body must be an object'}), 400
+    if scenario_id not in payloads.BUILDERS:
+        return jsonify({'error': f'Scenario {scenario_id} not implemented yet'}), 400
+    try:
+        payload = build_payload(scenario_id, form_data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    errors = validation.validate(scenario_id, payload)
+    return jsonify({'valid': not errors, 'errors': errors})
+
+@app.cli.command('validate')
+@click.argument('invoice_file', type=click.Path(exists=True, dir_okay=False))
+def validate_command(invoice_file):
+    """Check every invoice in a CSV / JSON-lines file without sending anything."""
+    started = time.monotonic()
+    total = invalid = 0
+    with open(invoice_file, encoding='utf-8-sig', newline='') as stream:
+        for record in bulk.read_invoices(stream, invoice_file):
+            total += 1
+            form_data = record['form_data']
+            try:
+                if '_error' in form_data:
+                    raise ValueError(form_data['_error'])
+                payload = build_payload(record['scenario_id'], form_data)
+            except ValueError as e:
+                errors = [{'field': '', 'code': 'invalid', 'message': str(e)}]
+            else:
+                errors = validation.validate(record['scenario_id'], payload)
+            if errors:
+                invalid += 1
+                click.echo(f"row {record['row']}: {validation.format_errors(errors)}")
+    elapsed = time.monotonic() - started
+    rate = f", {total / elapsed:.0f} invoices/s" if elapsed else ''
+    click.echo(f"{total} invoices checked in {elapsed:.2f}s: {total - invalid} valid, {invalid} invalid{rate}", err=True)
+    if invalid:
+        raise SystemExit(1)
+
+@app.route('/fbr/metrics')
+def fbr_metrics():
+    """Connection reuse and latency of calls to the FBR API"""
+    return jsonify(fbr_client.client.metrics_snapshot())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Stage and request timings, FBR API calls and outbox depth, in Prometheus text format"""
+    fbr = fbr_client.client.metrics_snapshot()
+    latency = fbr['latency_seconds']
+    outbox_stats = outbox.stats(storage.get_connection())
+    page_cache = invoice_pages.stats()
+    text = metrics.exposition(
+        *metrics.counter_lines('fbr_api_requests_total', 'Requests sent to the FBR API', fbr['requests']),
+        *metrics.counter_lines('fbr_api_retries_total', 'FBR API requests retried', fbr['retries']),
+        *metrics.counter_lines('fbr_api_errors_total', 'FBR API requests that failed or got a 5xx', fbr['errors']),
+        *metrics.counter_lines('fbr_api_handshakes_total', 'Connections opened to the FBR API', fbr['handshakes']),
+        *metrics.histogram_lines('fbr_api_latency_seconds', 'FBR API response time', fbr_client.LATENCY_BUCKETS,
+                                 list(latency['buckets'].values()), latency['sum']),
+        *metrics.counter_lines('fbr_render_cache_hits_total', 'Invoice pages served from the render cache',
+                               page_cache['hits']),
+        *metrics.counter_lines('fbr_render_cache_misses_total', 'Invoice pages rendered', page_cache['misses']),
+        *metrics.gauge_lines('fbr_render_cache_bytes', 'Size of the invoice pages cached in memory',
+                             page_cache['bytes']),
+        *metrics.gauge_lines('fbr_outbox_entries', 'Outbox entries by status', outbox_stats['counts'], 'status'),
+        *metrics.gauge_lines('fbr_outbox_oldest_waiting_seconds', 'Age of the oldest unsent outbox entry',
+                             outbox_stats['oldest_waiting_seconds'] or 0),
     )
+    return Response(text, mimetype='text/plain; version=0.0.4')
 
-    row = cursor.fetchone()
-    conn.close()
+@app.route('/healthz')
+def healthz():
+    """Liveness: the process is up and answering requests"""
+    return jsonify({'status': 'ok'})
 
-    if not row:
-        return None
+@app.route('/readyz')
+def readyz():
+    """Readiness: warmed up, database migrated and reachable, background workers running"""
+    checks = {'warmed_up': WARMED_UP}
+    try:
+        checks['database'] = storage.schema_is_current(storage.get_connection())
+    except sqlite3.Error:
+        checks['database'] = False
+    if outbox.ENABLED:
+        checks['outbox'] = outbox.running()
+    checks['pdf_renderer'] = pdfs.is_healthy()
+    ready = all(checks.values())
+    return jsonify({'ready': ready, 'checks': checks}), 200 if ready else 503
+
+
+# ----------------- BULK PDF EXPORT -----------------
+@app.route('/export/pdfs')
+def export_pdfs():
+    """Export many invoice PDFs as a ZIP (default) or one merged PDF.
+
+    Query parameters: from, to (YYYY-MM-DD), scenario (repeatable or comma separated),
+    ids (comma separated invoice numbers) and format=zip|pdf.
+    """
+    export_format = request.args.get('format', 'zip')
+    filters = dict(
+        date_from=request.args.get('from'),
+        date_to=request.args.get('to'),
+        scenario_ids=_split_values(request.args.getlist('scenario')),
+        invoice_numbers=_split_values(request.args.getlist('ids')),
+    )
 
-    return {
-        "invoice_number": row["invoice_number"],
-        "scenario_id": row["scenario_id"],
-        "payload": json.loads(row["payload"]),
-        "created_at": row["created_at"]
-    }
+    if export_format == 'pdf':
+        try:
+            export.check_merge_support()
+        except RuntimeError as e:
+            return jsonify({'error': str(e)}), 400
+        merged = tempfile.TemporaryFile()
+        failed = export.write_merged_pdf(render_export(**filters), merged)
+        if failed:
+            # A merged PDF has nowhere to say an invoice is missing from it, so none is sent
+            merged.close()
+            return jsonify({
+                'error': f'{len(failed)} invoices failed to render',
+                'failed': [{'invoice_number': invoice_number, 'error': error} for invoice_number, error in failed],
+            }), 500
+        merged.seek(0)
+        return send_file(merged, mimetype='application/pdf', as_attachment=True, download_name='Invoices.pdf')
+
+    if export_format != 'zip':
+        return jsonify({'error': 'format must be zip or pdf'}), 400
+
+    return Response(
+        stream_with_context(export.stream_zip(render_export(**filters))),
+        mimetype='application/zip',
+        headers={'Content-Disposition': 'attachment; filename=Invoices.zip'},
+    )
 
-def safe_float(value):
-    """Convert to float safely, return 0 if invalid"""
-    try:
-        return float(value)
-    except (ValueError, TypeError):
-        return 0.0
+@app.cli.command('export-pdfs')
+@click.option('--from', 'date_from', help='First invoice date (YYYY-MM-DD)')
+@click.option('--to', 'date_to', help='Last invoice date (YYYY-MM-DD)')
+@click.option('--scenario', 'scenario_ids', multiple=True, help='Scenario to include, e.g. SN001 (repeatable)')
+@click.option('--ids', help='Comma separated invoice numbers')
+@click.option('--format', 'export_format', type=click.Choice(['zip', 'pdf']), default='zip', show_default=True)
+@click.option('--workers', default=export.EXPORT_WORKERS, show_default=True, help='Render processes')
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), required=True)
+def export_pdfs_command(date_from, date_to, scenario_ids, ids, export_format, workers, output):
+    """Render stored invoices into a ZIP of PDFs or one merged PDF."""
+    rendered = _report_progress(render_export(
+        date_from=date_from,
+        date_to=date_to,
+        scenario_ids=_split_values(scenario_ids),
+        invoice_numbers=_split_values([ids] if ids else []),
+        workers=workers,
+    ))
+    failed = []
+    with open(output, 'wb') as target:
+        if export_format == 'pdf':
+            failed = export.write_merged_pdf(rendered, target)
+        else:
+            for chunk in export.stream_zip(rendered):
+                target.write(chunk)
+    if failed:
+        # As for /export/pdfs: a merged PDF missing invoices is not written at all
+        os.remove(output)
+        raise click.ClickException(f"{len(failed)} invoices failed to render, nothing written: " +
+                                   ', '.join(f"{invoice_number} ({error})" for invoice_number, error in failed))
+    click.echo(f"Wrote {output}", err=True)
+
+def render_export(date_from=None, date_to=None, scenario_ids=None, invoice_numbers=None, workers=export.EXPORT_WORKERS):
+    rows = export.select_invoices(storage.get_connection(), date_from, date_to, scenario_ids, invoice_numbers)
+    return export.render_pdfs(
+        (invoice_from_row(row) for row in rows),
+        render_invoice_pdf_html,
+        cached_path=lambda invoice: pdfs.artifact_path(invoice['invoice_number'], invoice_pdf_hash(invoice)),
+        workers=workers,
+    )
 
-def safe_float_or_empty(value):
-    """Convert to float if valid, otherwise return empty string for API compatibility"""
-    if value is None or str(value).strip() == "":
-        return ""
+def _report_progress(rendered):
+    count = 0
+    for invoice_number, pdf, error in rendered:
+        count += 1
+        if error is not None:
+            click.echo(f"{invoice_number}: render failed: {error}", err=True)
+        elif count % 100 == 0:
+            click.echo(f"{count} invoices rendered", err=True)
+        yield invoice_number, pdf, error
+
+def _split_values(values):
+    return [value.strip() for item in values for value in item.split(',') if value.strip()]
+
+
+# ----------------- BULK SUBMISSION -----------------
+@app.route('/bulk')
+def bulk_form():
+    return render_template('bulk.html', scenarios=SCENARIOS)
+
+@app.route('/bulk/submit', methods=['POST'])
+def bulk_submit():
+    """Submit a CSV / JSON-lines file of invoices and stream one JSON result per line"""
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({'error': 'No invoice file uploaded'}), 400
+
+    api_url = request.form.get('api_url')
+    bearer_token = request.form.get('bearer_token')
     try:
-        return float(value)
-    except (ValueError, TypeError):
-        return ""
-
-def parse_items(form_data):
-    """Parse items from form data safely"""
-    items = []
-    index = 0
-    while f'item_{index}_hsCode' in form_data:
-        item = {
-            'hsCode': form_data.get(f'item_{index}_hsCode', ''),
-            'productDescription': form_data.get(f'item_{index}_productDescription', ''),
-            'rate': form_data.get(f'item_{index}_rate', '18%'),
-            'uoM': form_data.get(f'item_{index}_uoM', ''),
-            'quantity': safe_float(form_data.get(f'item_{index}_quantity')),
-            'totalValues': safe_float(form_data.get(f'item_{index}_totalValues')),
-            'valueSalesExcludingST': safe_float(form_data.get(f'item_{index}_valueSalesExcludingST')),
-            'fixedNotifiedValueOrRetailPrice': safe_float(form_data.get(f'item_{index}_fixedNotifiedValueOrRetailPrice')),
-            'salesTaxApplicable': safe_float(form_data.get(f'item_{index}_salesTaxApplicable')),
-            'salesTaxWithheldAtSource': safe_float(form_data.get(f'item_{index}_salesTaxWithheldAtSource')),
-            # 'extraTax': safe_float(form_data.get(f'item_{index}_extraTax')),
-            'extraTax': safe_float_or_empty(form_data.get(f'item_{index}_extraTax')),
-            'furtherTax': safe_float(form_data.get(f'item_{index}_furtherTax')),
-            'sroScheduleNo': form_data.get(f'item_{index}_sroScheduleNo', ''),
-            'fedPayable': safe_float(form_data.get(f'item_{index}_fedPayable')),
-            'discount': safe_float(form_data.get(f'item_{index}_discount')),
-            'saleType': form_data.get(f'item_{index}_saleType', 'Goods at standard rate (default)'),
-            'sroItemSerialNo': form_data.get(f'item_{index}_sroItemSerialNo', '')
-        }
-        items.append(item)
-        index += 1
-    return items
-
-# import base64
-# import os
-
-# Helper function to encode image
-def get_base64_image(image_path):
+        workers = int(request.form.get('workers') or bulk.DEFAULT_WORKERS)
+    except ValueError:
+        return jsonify({'error': 'workers must be a whole number'}), 400
+    workers = max(1, min(workers, bulk.MAX_WORKERS))
+
+    # The upload is closed with the request, so keep our own copy for the streamed response
+    spooled = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    upload.save(spooled)
+    spooled.seek(0)
+    filename = upload.filename
+
+    def generate():
+        stream = io.TextIOWrapper(spooled, encoding='utf-8-sig', newline='')
+        records = bulk.read_invoices(stream, filename)
+        results = bulk.submit_batch(
+            records,
+            build_payload,
+            lambda scenario_id, payload: post_invoice_once(scenario_id, payload, api_url, bearer_token),
+            workers=workers,
+            validate=validation.validate,
+            find_duplicate=find_duplicate,
+        )
+        try:
+            for line in bulk.with_summary(results):
+                yield json.dumps(line) + "\n"
+        finally:
+            stream.close()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.cli.command('bulk-submit')
+@click.argument('invoice_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--api-url', envvar='FBR_API_URL', required=True, help='FBR API URL')
+@click.option('--token', envvar='FBR_BEARER_TOKEN', required=True, help='Bearer token (without Bearer keyword)')
+@click.option('--workers', default=bulk.DEFAULT_WORKERS, show_default=True, help='Concurrent FBR requests')
+@click.option('--retries', default=bulk.DEFAULT_RETRIES, show_default=True, help='Retries per invoice on transient failures')
+@click.option('--output', type=click.File('w'), default='-', help='Where to write the JSON-lines report')
+@click.option('--no-validate', is_flag=True, help='Send invoices without checking them locally first')
+@click.option('--allow-duplicates', is_flag=True, help='Send invoices even if FBR already issued the same one')
+def bulk_submit_command(invoice_file, api_url, token, workers, retries, output, no_validate, allow_duplicates):
+    """Submit every invoice in a CSV / JSON-lines file to FBR."""
+    with open(invoice_file, encoding='utf-8-sig', newline='') as stream:
+        results = bulk.submit_batch(
+            bulk.read_invoices(stream, invoice_file),
+            build_payload,
+            _bulk_post(api_url, token, allow_duplicates),
+            workers=workers,
+            retries=retries,
+            validate=None if no_validate else validation.validate,
+            find_duplicate=None if allow_duplicates else find_duplicate,
+        )
+        _write_bulk_report(results, output)
+
+@app.cli.command('import-erp')
+@click.argument('export_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--mapping', 'mapping_file', type=click.Path(exists=True, dir_okay=False),
+              help='JSON column mapping (see erp.py); columns named like the form fields need none')
+@click.option('--sheet', help='XLSX sheet to read (default: the active one)')
+@click.option('--delimiter', default=',', show_default=True, help='CSV field separator')
+@click.option('--output', type=click.File('w'), default='-',
+              help='Where to write the invoices as JSON lines for bulk-submit, or the report with --submit')
+@click.option('--submit', is_flag=True, help='Submit the invoices to FBR as they are read')
+@click.option('--api-url', envvar='FBR_API_URL', help='FBR API URL (with --submit)')
+@click.option('--token', envvar='FBR_BEARER_TOKEN', help='Bearer token (with --submit)')
+@click.option('--workers', default=bulk.DEFAULT_WORKERS, show_default=True, help='Concurrent FBR requests')
+@click.option('--no-validate', is_flag=True, help='Skip the local checks')
+@click.option('--allow-duplicates', is_flag=True, help='With --submit, send invoices FBR already issued again')
+def import_erp_command(export_file, mapping_file, sheet, delimiter, output, submit, api_url, token, workers, no_validate,
+                       allow_duplicates):
+    """Read an ERP sales export (CSV / XLSX, one row per invoice line) into invoices.
+
+    Without --submit, invoices that pass the local checks are written as JSON
+    lines for bulk-submit, and the others are listed on stderr.
+    """
     try:
-        with open(image_path, "rb") as img_file:
-            return base64.b64encode(img_file.read()).decode('utf-8')
-    except FileNotFoundError:
-        print(f"Error: Image not found at {image_path}")
-        return None
+        mapping = erp.ColumnMapping.load(mapping_file) if mapping_file else erp.ColumnMapping()
+        records = erp.read_invoices(erp.read_rows(export_file, sheet, delimiter), mapping)
+        validate = None if no_validate else validation.validate
+        if submit:
+            if not api_url or not token:
+                raise click.UsageError('--submit needs --api-url and --token')
+            _write_bulk_report(bulk.submit_batch(
+                records,
+                build_payload,
+                _bulk_post(api_url, token, allow_duplicates),
+                workers=workers,
+                validate=validate,
+                find_duplicate=None if allow_duplicates else find_duplicate,
+            ), output)
+            return
+
+        written = rejected = 0
+        for record, errors in erp.check(records, build_payload, validate):
+            if errors:
+                rejected += 1
+                click.echo(f"Row {record['row']}: {'; '.join(errors)}", err=True)
+            else:
+                written += 1
+                output.write(erp.as_json_line(record) + "\n")
+    except (ValueError, RuntimeError) as e:
+        raise click.ClickException(str(e))
+    click.echo(f"{written} invoices ready, {rejected} with errors", err=True)
+
+def _bulk_post(api_url, token, allow_duplicates=False):
+    if allow_duplicates:
+        return lambda scenario_id, payload: post_invoice(scenario_id, payload, api_url, token)
+    # Identical lines of one file, sent at the same time, are sent once
+    return lambda scenario_id, payload: post_invoice_once(scenario_id, payload, api_url, token)
+
+def _write_bulk_report(results, output):
+    for line in bulk.with_summary(results):
+        output.write(json.dumps(line) + "\n")
+        output.flush()
+        if 'summary' in line:
+            click.echo(bulk.format_summary(line['summary']), err=True)
+        else:
+            click.echo(f"[{line['seq']}] row {line['row']}: {line['status']} {line.get('invoice_number') or line.get('error') or ''}", err=True)
 
-    logo_path = os.path.join('static', 'images', 'fbr_logo.jpg') 
-
-# 2. Convert to Base64
-    fbr_logo_data = get_base64_image(logo_path)
-
-    return render_template("invoice.html", 
-                       invoice=invoice_data,
-                       fbr_invoice_number=fbr_invoice_number,
-                       fbr_logo_data=fbr_logo_data,  # <--- Pass this
-                       qr_code=qr_code_path)
-
-def build_sn001_payload(form_data):
-    """Build JSON payload for SN001 scenario"""
-    items = parse_items(form_data)
-    
-    payload = {
-        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
-        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
-        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
-        'sellerProvince': form_data.get('sellerProvince', ''),
-        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
-        'sellerAddress': form_data.get('sellerAddress', ''),
-        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
-        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
-        'buyerProvince': form_data.get('buyerProvince', ''),
-        'buyerAddress': form_data.get('buyerAddress', ''),
-        'invoiceRefNo': form_data.get('invoiceRefNo', ''),
-        'scenarioId': 'SN001',
-        # 'buyerRegistrationType': 'Registered',
-        "buyerRegistrationType": form_data["buyerType"],
-        'items': items
-    }
-    
-    return payload
-
-def build_sn002_payload(form_data):
-    """Build JSON payload for SN002 scenario"""
-    items = parse_items(form_data)
-    
-    payload = {
-        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
-        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
-        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
-        'sellerProvince': form_data.get('sellerProvince', ''),
-        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
-        'sellerAddress': form_data.get('sellerAddress', ''),
-        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
-        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
-        'buyerProvince': form_data.get('buyerProvince', ''),
-        'buyerAddress': form_data.get('buyerAddress', ''),
-        'invoiceRefNo': form_data.get('invoiceRefNo', ''),
-        'scenarioId': 'SN002',
-        # 'buyerRegistrationType': 'Unregistered',
-        "buyerRegistrationType": form_data["buyerType"],
-        'items': items
-    }
-    
-    return payload
-
-def build_sn005_payload(form_data):
-    """Build JSON payload for SN005 scenario"""
-    items = parse_items(form_data)
-    
-    payload = {
-        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
-        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
-        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
-        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
-        'sellerAddress': form_data.get('sellerAddress', ''),
-        'sellerProvince': form_data.get('sellerProvince', ''),
-        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
-        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
-        'buyerProvince': form_data.get('buyerProvince', ''),
-        'buyerAddress': form_data.get('buyerAddress', ''),
-        'invoiceRefNo': form_data.get('invoiceRefNo', ''),
-        'scenarioId': 'SN005',
-        # 'buyerRegistrationType': form_data.get('buyerRegistrationType', 'Unregistered'),
-        "buyerRegistrationType": form_data["buyerType"],
-        'items': items
-    }
-    
-    return payload
-
-def build_sn006_payload(form_data):
-    """Build JSON payload for SN006 scenario"""
-    items = parse_items(form_data)
-    
-    payload = {
-        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
-        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
-        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
-        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
-        'sellerProvince': form_data.get('sellerProvince', ''),
-        'sellerAddress': form_data.get('sellerAddress', ''),
-        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
-        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
-        'buyerProvince': form_data.get('buyerProvince', ''),
-        'buyerAddress': form_data.get('buyerAddress', ''),
-        'invoiceRefNo': form_data.get('invoiceRefNo', ''),
-        'scenarioId': 'SN006',
-        # 'buyerRegistrationType': form_data.get('buyerRegistrationType', 'Registered'),
-        "buyerRegistrationType": form_data["buyerType"],
-        'items': items
-    }
-    
-    return payload
-
-def build_sn007_payload(form_data):
-    """Build JSON payload for SN007 scenario"""
-    items = parse_items(form_data)
-    
-    payload = {
-        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
-        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
-        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
-        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
-        'sellerProvince': form_data.get('sellerProvince', ''),
-        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
-        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
-        'buyerProvince': form_data.get('buyerProvince', ''),
-        'buyerAddress': form_data.get('buyerAddress', ''),
-        'sellerAddress': form_data.get('sellerAddress', ''),
-        'scenarioId': 'SN007',
-        # 'buyerRegistrationType': form_data.get('buyerRegistrationType', 'Unregistered'),
-        "buyerRegistrationType": form_data["buyerType"],
-        'invoiceRefNo': form_data.get('invoiceRefNo', '0'),
-        'items': items
-    }
-    
-    return payload
-
-def build_sn008_payload(form_data):
-    """Build JSON payload for SN008 scenario"""
-    items = parse_items(form_data)
-    
-    payload = {
-        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
-        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
-        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
-        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
-        'sellerProvince': form_data.get('sellerProvince', ''),
-        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
-        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
-        'buyerProvince': form_data.get('buyerProvince', ''),
-        'buyerAddress': form_data.get('buyerAddress', ''),
-        'sellerAddress': form_data.get('sellerAddress', ''),
-        'invoiceRefNo': form_data.get('invoiceRefNo', '0'),
-        'scenarioId': 'SN008',
-        # 'buyerRegistrationType': form_data.get('buyerRegistrationType', 'Unregistered'),
-        "buyerRegistrationType": form_data["buyerType"],
-        'items': items
-    }
-    
-    return payload
-
-def build_sn016_payload(form_data):
-    """Build JSON payload for SN016 scenario"""
-    items = parse_items(form_data)
-    
-    payload = {
-        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
-        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
-        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
-        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
-        'sellerProvince': form_data.get('sellerProvince', ''),
-        'sellerAddress': form_data.get('sellerAddress', ''),
-        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
-        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
-        'buyerProvince': form_data.get('buyerProvince', ''),
-        'buyerAddress': form_data.get('buyerAddress', ''),
-        'invoiceRefNo': form_data.get('invoiceRefNo', ''),
-        'scenarioId': 'SN016',
-        # 'buyerRegistrationType': form_data.get('buyerRegistrationType', 'Unregistered'),
-        "buyerRegistrationType": form_data["buyerType"],
-        'items': items
-    }
-    
-    return payload
-
-def build_sn017_payload(form_data):
-    """Build JSON payload for SN017 scenario"""
-    items = parse_items(form_data)
-    
-    payload = {
-        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
-        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
-        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
-        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
-        'sellerProvince': form_data.get('sellerProvince', ''),
-        'sellerAddress': form_data.get('sellerAddress', ''),
-        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
-        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
-        'buyerProvince': form_data.get('buyerProvince', ''),
-        'buyerAddress': form_data.get('buyerAddress', ''),
-        'invoiceRefNo': form_data.get('invoiceRefNo', ''),
-        'scenarioId': 'SN017',
-        # 'buyerRegistrationType': form_data.get('buyerRegistrationType', 'Unregistered'),
-        "buyerRegistrationType": form_data["buyerType"],
-        'items': items
-    }
-    
-    return payload
-
-def build_sn024_payload(form_data):
-    """Build JSON payload for SN024 scenario"""
-    items = parse_items(form_data)
-    
-    payload = {
-        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
-        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
-        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
-        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
-        'sellerProvince': form_data.get('sellerProvince', ''),
-        'sellerAddress': form_data.get('sellerAddress', ''),
-        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
-        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
-        'buyerProvince': form_data.get('buyerProvince', ''),
-        'buyerAddress': form_data.get('buyerAddress', ''),
-        # 'buyerRegistrationType': form_data.get('buyerRegistrationType', 'Unregistered'),
-        "buyerRegistrationType": form_data["buyerType"],
-        'scenarioId': 'SN024',
-        'invoiceRefNo': form_data.get('invoiceRefNo', ''),
-        'items': items
+
+# ---------------- HELPER FUNCTIONS -----------------
+def build_payload(scenario_id, form_data):
+    """Build the FBR payload for a scenario from form-style data"""
+    return payloads.build(scenario_id, form_data)
+
+def post_invoice(scenario_id, payload, api_url, bearer_token):
+    """Send a built payload to FBR, save the invoice and its QR code on success.
+
+    Network errors are raised as requests exceptions so callers can decide whether to retry.
+    """
+    # Send request to API over the shared keep-alive pool
+    with metrics.timer('fbr_call'):
+        response = fbr_client.client.post(api_url, json=payload, headers=fbr_headers(bearer_token))
+    result = invoice_result(payload, response)
+
+    # Save invoice and generate QR code if invoiceNumber exists
+    if result['success']:
+        save_invoice(result['invoice_number'], scenario_id, payload)
+        invoice_saved(result['invoice_number'])
+
+    return result
+
+def post_invoice_once(scenario_id, payload, api_url, bearer_token, payload_hash=None):
+    """post_invoice(), unless this process is already sending the same payload: then that request's result.
+
+    A result that is another request's issued invoice is marked as a duplicate.
+    """
+    result, duplicate = dedup.send_once(payload_hash or dedup.payload_hash(payload),
+                                        lambda: post_invoice(scenario_id, payload, api_url, bearer_token))
+    if duplicate and result['success']:
+        return dedup.duplicate_result(payload, result['invoice_number'])
+    return result
+
+def fbr_headers(bearer_token):
+    return {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {bearer_token}'
     }
-    
-    return payload
-
-def build_sn026_payload(form_data):
-    """Build JSON payload for SN026 scenario"""
-    items = parse_items(form_data)
-    
-    payload = {
-        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
-        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
-        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
-        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
-        'sellerProvince': form_data.get('sellerProvince', ''),
-        'sellerAddress': form_data.get('sellerAddress', ''),
-        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
-        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
-        'buyerProvince': form_data.get('buyerProvince', ''),
-        'buyerAddress': form_data.get('buyerAddress', ''),
-        # 'buyerRegistrationType': form_data.get('buyerRegistrationType', 'Unregistered'),
-        "buyerRegistrationType": form_data["buyerType"],
-        'scenarioId': 'SN026',
-        'invoiceRefNo': form_data.get('invoiceRefNo', ''),
-        'items': items
+
+def invoice_result(payload, response):
+    """The result dict the submit route renders, from FBR's response (requests' or fbr_client.AsyncResponse)"""
+    # Safe JSON parsing
+    try:
+        response_data = response.json()
+    except ValueError:
+        response_data = {'raw_response': response.text}
+
+    result = {
+        'status_code': response.status_code,
+        'success': False,
+        'invoice_number': None,
+        'request_payload': payload,
+        'response_data': response_data,
+        'response_headers': dict(response.headers)
     }
-    
-    return payload
-
-def build_sn027_payload(form_data):
-    """Build JSON payload for SN027 scenario"""
-    items = parse_items(form_data)
-    
-    payload = {
-        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
-        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
-        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
-        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
-        'sellerProvince': form_data.get('sellerProvince', ''),
-        'sellerAddress': form_data.get('sellerAddress', ''),
-        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
-        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
-        'buyerProvince': form_data.get('buyerProvince', ''),
-        'buyerAddress': form_data.get('buyerAddress', ''),
-        # 'buyerRegistrationType': form_data.get('buyerRegistrationType', 'Unregistered'),
-        "buyerRegistrationType": form_data["buyerType"],
-        'invoiceRefNo': form_data.get('invoiceRefNo', ''),
-        'scenarioId': 'SN027',
-        'items': items
+
+    if response.status_code == 200 and isinstance(response_data, dict):
+        invoice_number = response_data.get('invoiceNumber')
+
+        if invoice_number:
+            result['success'] = True
+            result['invoice_number'] = invoice_number
+            # Add QR path for rendering
+            result['qr_code'] = f'/qr/{invoice_number}'
+
+    return result
+
+def invoice_saved(invoice_number):
+    """Follow-up work once an accepted invoice is committed"""
+    # Render the PDF in the background so the download is instant
+    if pdfs.PRERENDER:
+        schedule_invoice_pdf(get_invoice_from_db(invoice_number))
+
+def save_invoice(invoice_number, scenario_id, payload):
+    """Store a submitted invoice with its line items through the single DB writer and wait for the commit"""
+    payload_hash = dedup.payload_hash(payload)
+    with metrics.timer('db_insert'):
+        storage.run_write(invoices.insert_invoice, invoice_number, scenario_id, payload, payload_hash)
+    dedup.remember(payload_hash, invoice_number)
+
+def find_duplicate(scenario_id, payload):
+    """Number of the invoice FBR already issued for this payload, or None"""
+    return dedup.issued_invoice(storage.get_connection(), dedup.payload_hash(payload))
+
+def invoice_pdf_hash(invoice):
+    return pdfs.content_hash(invoice['payload'], INVOICE_TEMPLATE_VERSION)
+
+def schedule_invoice_pdf(invoice):
+    """Render invoice.html now and queue the PDF conversion on the PDF process pool"""
+    return pdfs.submit(invoice['invoice_number'], invoice_pdf_hash(invoice), render_invoice_pdf_html(invoice))
+
+def render_invoice_pdf_html(invoice):
+    """invoice.html as fed to WeasyPrint: the stylesheet is supplied pre-parsed by the render process"""
+    # Embedded as a data URI, so WeasyPrint needs no file for it
+    invoice = dict(invoice, qr_code=qr.data_uri(invoice['invoice_number']))
+
+    # Bulk submissions and exports run outside a request, so make sure an app context exists
+    with app.app_context(), metrics.timer('render'):
+        return render_template("invoice.html", invoice=invoice, pdf=True)
+
+def invoice_pdf_status_data(invoice):
+    invoice_number = invoice['invoice_number']
+    if invoice['archive_period'] and archive.read_artifact(invoice['archive_period'],
+                                                           archive.pdf_member(invoice_number)) is not None:
+        pdf_status = 'ready'
+    else:
+        pdf_status = pdfs.status(invoice_number, invoice_pdf_hash(invoice))
+    data = {
+        'invoice_number': invoice_number,
+        'status': pdf_status,
+        'pdf_url': f'/invoice/{invoice_number}/pdf',
     }
-    
-    return payload
-
-def build_sn028_payload(form_data):
-    """Build JSON payload for SN028 scenario"""
-    items = parse_items(form_data)
-    
-    payload = {
-        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
-        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
-        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
-        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
-        'sellerProvince': form_data.get('sellerProvince', ''),
-        'sellerAddress': form_data.get('sellerAddress', ''),
-        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
-        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
-        'buyerProvince': form_data.get('buyerProvince', ''),
-        'buyerAddress': form_data.get('buyerAddress', ''),
-        'invoiceRefNo': form_data.get('invoiceRefNo', ''),
-        # 'buyerRegistrationType': form_data.get('buyerRegistrationType', 'Unregistered'),
-        "buyerRegistrationType": form_data["buyerType"],
-        'scenarioId': 'SN028',
-        'items': items
+    if pdf_status == 'failed':
+        data['error'] = pdfs.last_error(invoice_number)
+    return data
+
+def get_invoice_from_db(invoice_number):
+    """A saved invoice, from invoices.db or, if it was archived, from its month's archive file"""
+    with metrics.timer('db_read'):
+        conn = storage.get_connection()
+        row = conn.execute(
+            "SELECT * FROM invoices WHERE invoice_number = ?",
+            (invoice_number,)
+        ).fetchone()
+
+        period = None
+        if not row:
+            period = archive.period_of_invoice(conn, invoice_number)
+            if period is None:
+                return None
+            conn = archive.connection(period)
+            row = conn.execute("SELECT * FROM invoices WHERE invoice_number = ?", (invoice_number,)).fetchone()
+            if not row:
+                return None
+
+        invoice = invoice_from_row(row, conn)
+        invoice["archive_period"] = period
+        return invoice
+
+def invoice_exists(invoice_number):
+    return storage.get_connection().execute(
+        "SELECT 1 FROM invoices WHERE invoice_number = ?", (invoice_number,)
+    ).fetchone() is not None
+
+def invoice_from_row(row, conn=None):
+    conn = conn or storage.get_connection()
+    return {
+        "invoice_number": row["invoice_number"],
+        "scenario_id": row["scenario_id"],
+        "payload": payload_codec.decode(row["payload"], conn),
+        "created_at": row["created_at"],
+        "totals": invoices.stored_totals(conn, row)
     }
-    
-    return payload
+
+# ----------------- STARTUP -----------------
+def warm_up():
+    """Do now the one-off work the first invoice would otherwise wait for.
+
+    Compiles the templates, and loads the QR encoder and WeasyPrint with the
+    invoice stylesheet and fonts. wsgi.py calls this before gunicorn forks its
+    workers, so they all start warm and share that memory copy-on-write.
+    """
+    global WARMED_UP
+    started = time.perf_counter()
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+    qr.warm_up()
+    pdfs.warm_up()
+    WARMED_UP = True
+    log.info('Warmed up in %.0f ms', (time.perf_counter() - started) * 1000)
+
+def start_background_work():
+    """Drain invoices left in the outbox by a previous run, and everything queued from now on"""
+    if outbox.ENABLED:
+        outbox.start(post_invoice)
+
+# Under gunicorn (FBR_PRELOAD=1, see gunicorn.conf.py) the app is imported once
+# before forking, and each worker starts its own background work instead
+if os.environ.get('FBR_PRELOAD') != '1':
+    start_background_work()
 
 if __name__ == '__main__':
+    warm_up()
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
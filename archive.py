@@ -0,0 +1,301 @@
+"""Archiving of old invoices into per-month database files.
+
+``flask archive-invoices`` moves invoices saved more than
+FBR_ARCHIVE_AFTER_MONTHS months ago out of ``invoices.db``, a month at a time,
+into ``<FBR_ARCHIVE_DIR>/<YYYY-MM>.db``: SQLite files with the same
+``invoices`` and ``invoice_items`` tables, opened read-only once written. Their
+rendered PDFs and stored QR codes are packed into ``<YYYY-MM>.zip`` next to
+them. ``archived_invoices`` in the main database records which month each
+archived invoice went to, so an invoice page, PDF or QR code is still found
+with one indexed lookup, and the month's file is only opened when one is asked
+for. It keeps each invoice's payload hash too, so duplicate detection still
+sees archived invoices.
+
+The daily report totals are kept, so reports still cover archived invoices.
+Listing, search and bulk PDF export cover the invoices in ``invoices.db``.
+"""
+import glob
+import os
+import re
+import sqlite3
+import threading
+import zipfile
+from collections import OrderedDict
+from datetime import datetime, timezone
+from urllib.request import pathname2url
+
+import dedup
+import payload_codec
+import pdfs
+import storage
+
+ARCHIVE_DIR = os.path.abspath(os.environ.get('FBR_ARCHIVE_DIR', 'archive'))
+ARCHIVE_AFTER_MONTHS = int(os.environ.get('FBR_ARCHIVE_AFTER_MONTHS', 12))
+# Archive files kept open per thread (reads) and per process (artifacts)
+OPEN_ARCHIVES = int(os.environ.get('FBR_ARCHIVE_OPEN_FILES', 8))
+# Invoices moved per transaction; also bounds the SQL parameters of one query
+ARCHIVE_BATCH_SIZE = 500
+
+# Tables and indexes of invoices.db copied into each archive file
+ARCHIVED_SCHEMA = ('invoices', 'invoice_items', 'idx_invoice_items_invoice_id', 'payload_dictionaries')
+
+_PERIOD_RE = re.compile(r'^\d{4}-\d{2}$')
+
+
+# ---------------- PERIODS -----------------
+def cutoff(months=ARCHIVE_AFTER_MONTHS, today=None):
+    """The first month kept in invoices.db (``YYYY-MM``); invoices saved before it are archived"""
+    today = today or datetime.now(timezone.utc).date()
+    index = today.year * 12 + today.month - 1 - months
+    return f'{index // 12:04d}-{index % 12 + 1:02d}'
+
+def due_periods(conn, before):
+    """``(month, invoice count)`` for each month before ``before`` that still has invoices in invoices.db"""
+    return [tuple(row) for row in conn.execute(
+        "SELECT substr(created_at, 1, 7) AS period, COUNT(*) FROM invoices WHERE created_at < ? "
+        "GROUP BY period ORDER BY period",
+        (f'{before}-01',)
+    )]
+
+def periods():
+    """Months with an archive file, oldest first"""
+    return sorted(os.path.basename(path)[:-3] for path in glob.glob(os.path.join(ARCHIVE_DIR, '*.db'))
+                  if _PERIOD_RE.match(os.path.basename(path)[:-3]))
+
+def database_path(period):
+    return os.path.join(ARCHIVE_DIR, f'{_checked(period)}.db')
+
+def artifacts_path(period):
+    return os.path.join(ARCHIVE_DIR, f'{_checked(period)}.zip')
+
+def pdf_member(invoice_number):
+    return f'pdf/{invoice_number}.pdf'
+
+def qr_member(invoice_number, fmt):
+    return f'qr/{invoice_number}.{fmt}'
+
+def _checked(period):
+    # Periods become file names
+    if not _PERIOD_RE.match(period or ''):
+        raise ValueError(f'Invalid archive period {period!r}, expected YYYY-MM')
+    return period
+
+def _next_period(period):
+    year, month = map(int, period.split('-'))
+    return f'{year + month // 12:04d}-{month % 12 + 1:02d}'
+
+
+# ---------------- ARCHIVING -----------------
+def archive_period(period, batch_size=ARCHIVE_BATCH_SIZE, progress=None):
+    """Move the invoices saved in one month into its archive file, a batch at a time.
+
+    Each batch is committed to the archive file and its artifacts packed
+    before it is deleted from invoices.db, so an interrupted run loses
+    nothing and can simply be run again. ``progress(invoices moved)`` is
+    called after each batch. Returns the number of invoices moved.
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    hot = storage.get_connection()
+    target = _open_for_writing(period, hot)
+    start, end = f'{period}-01', f'{_next_period(period)}-01'
+    moved = 0
+    try:
+        while True:
+            rows = hot.execute(
+                "SELECT * FROM invoices WHERE created_at >= ? AND created_at < ? ORDER BY id LIMIT ?",
+                (start, end, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            ids = [row["id"] for row in rows]
+            numbers = [row["invoice_number"] for row in rows if row["invoice_number"]]
+            hashes = [row["payload_hash"] for row in rows if row["invoice_number"]]
+            _copy(hot, target, rows)
+            pdf_paths = _pack_artifacts(hot, period, numbers)
+            storage.run_write(_forget, period, ids, numbers, hashes)
+            for path in pdf_paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            moved += len(rows)
+            if progress:
+                progress(moved)
+    finally:
+        target.close()
+    # Nothing writes to a month once it is archived
+    os.chmod(database_path(period), 0o444)
+    return moved
+
+def _open_for_writing(period, hot):
+    path = database_path(period)
+    if os.path.exists(path):
+        os.chmod(path, 0o644)
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    # A rollback journal rather than WAL: read-only connections then need no -shm file
+    conn.execute('PRAGMA journal_mode = DELETE')
+    existing = {row["name"] for row in conn.execute("SELECT name FROM sqlite_master")}
+    for name in ARCHIVED_SCHEMA:
+        if name not in existing:
+            conn.execute(hot.execute("SELECT sql FROM sqlite_master WHERE name = ?", (name,)).fetchone()["sql"])
+    return conn
+
+def _copy(hot, target, rows):
+    ids = [row["id"] for row in rows]
+    items = hot.execute(
+        f"SELECT * FROM invoice_items WHERE invoice_id IN ({','.join('?' * len(ids))})", ids
+    ).fetchall()
+    # Payloads compressed with a dictionary need it to be read back
+    dictionary_ids = sorted({payload_codec.codec_of(row["payload"])[1] for row in rows} - {0})
+    dictionaries = hot.execute(
+        f"SELECT * FROM payload_dictionaries WHERE id IN ({','.join('?' * len(dictionary_ids))})", dictionary_ids
+    ).fetchall() if dictionary_ids else []
+
+    target.execute('BEGIN IMMEDIATE')
+    try:
+        _insert_rows(target, 'payload_dictionaries', dictionaries)
+        _insert_rows(target, 'invoices', rows)
+        _insert_rows(target, 'invoice_items', items)
+        target.execute('COMMIT')
+    except BaseException:
+        target.execute('ROLLBACK')
+        raise
+
+def _insert_rows(conn, table, rows):
+    if not rows:
+        return
+    # Archive files written before a migration added a column lack it
+    known = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+    columns = [column for column in rows[0].keys() if column in known]
+    conn.executemany(
+        f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+        ([row[column] for column in columns] for row in rows)
+    )
+
+def _pack_artifacts(hot, period, numbers):
+    """Add the rendered PDFs and stored QR codes of invoices to the month's ZIP; returns the PDF files packed"""
+    pdf_paths = {}
+    for invoice_number in numbers:
+        path = _rendered_pdf(invoice_number)
+        if path:
+            pdf_paths[pdf_member(invoice_number)] = path
+    qr_rows = hot.execute(
+        f"SELECT invoice_number, format, image FROM qr_codes WHERE invoice_number IN ({','.join('?' * len(numbers))})",
+        numbers
+    ).fetchall() if numbers else []
+    if not pdf_paths and not qr_rows:
+        return []
+
+    with _artifact_lock, zipfile.ZipFile(artifacts_path(period), 'a') as artifacts:
+        packed = set(artifacts.namelist())
+        # PDFs and PNGs are compressed already
+        for name, path in pdf_paths.items():
+            if name not in packed:
+                artifacts.write(path, name, compress_type=zipfile.ZIP_STORED)
+        for row in qr_rows:
+            name = qr_member(row["invoice_number"], row["format"])
+            if name not in packed:
+                compression = zipfile.ZIP_DEFLATED if row["format"] == 'svg' else zipfile.ZIP_STORED
+                artifacts.writestr(name, bytes(row["image"]), compress_type=compression)
+    return list(pdf_paths.values())
+
+def _rendered_pdf(invoice_number):
+    # The newest render; plain <invoice_number>.pdf files predate hashed artifact names
+    paths = glob.glob(os.path.join(pdfs.PDF_FOLDER, f"{glob.escape(invoice_number)}-*.pdf"))
+    paths += glob.glob(os.path.join(pdfs.PDF_FOLDER, f"{glob.escape(invoice_number)}.pdf"))
+    return max(paths, key=os.path.getmtime, default=None)
+
+def _forget(conn, period, ids, numbers, hashes):
+    """Record where a batch of invoices went and delete them from invoices.db"""
+    conn.executemany("INSERT OR REPLACE INTO archived_invoices (invoice_number, period, payload_hash) VALUES (?, ?, ?)",
+                     [(invoice_number, period, digest) for invoice_number, digest in zip(numbers, hashes)])
+    placeholders = ','.join('?' * len(ids))
+    conn.execute(f"DELETE FROM invoices_fts WHERE rowid IN ({placeholders})", ids)
+    if numbers:
+        conn.execute(f"DELETE FROM qr_codes WHERE invoice_number IN ({','.join('?' * len(numbers))})", numbers)
+    # Their invoice_items rows go with them (ON DELETE CASCADE)
+    conn.execute(f"DELETE FROM invoices WHERE id IN ({placeholders})", ids)
+
+def backfill_hashes(conn, batch_size=ARCHIVE_BATCH_SIZE):
+    """Record the payload hashes of invoices archived before archived_invoices kept them.
+
+    Invoices archived before hashes were stored at all are hashed from their payloads.
+    """
+    for period in periods():
+        archived = connection(period)
+        last_id = 0
+        while True:
+            rows = archived.execute(
+                "SELECT * FROM invoices WHERE id > ? AND invoice_number IS NOT NULL ORDER BY id LIMIT ?",
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            updates = []
+            for row in rows:
+                digest = row["payload_hash"] if "payload_hash" in row.keys() else None
+                if digest is None:
+                    try:
+                        digest = dedup.payload_hash(payload_codec.decode(row["payload"], archived))
+                    except (TypeError, ValueError):
+                        continue
+                updates.append((digest, row["invoice_number"]))
+            conn.executemany("UPDATE archived_invoices SET payload_hash = ? WHERE invoice_number = ?", updates)
+            last_id = rows[-1]["id"]
+
+
+# ---------------- READING -----------------
+_local = threading.local()
+_artifact_files = OrderedDict()   # (pid, path) -> (mtime, ZipFile)
+_artifact_lock = threading.Lock()
+
+def period_of_invoice(conn, invoice_number):
+    """The month an invoice was archived to, or None if it never was"""
+    row = conn.execute("SELECT period FROM archived_invoices WHERE invoice_number = ?", (invoice_number,)).fetchone()
+    return row["period"] if row else None
+
+def connection(period):
+    """This thread's read-only connection to a month's archive file, opened on first use"""
+    connections = getattr(_local, 'connections', None)
+    if connections is None or _local.pid != os.getpid():
+        connections = _local.connections = OrderedDict()
+        _local.pid = os.getpid()
+    conn = connections.get(period)
+    if conn is not None:
+        connections.move_to_end(period)
+        return conn
+
+    path = database_path(period)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'Archive file {path} is missing')
+    conn = sqlite3.connect(f'file:{pathname2url(path)}?mode=ro', uri=True, check_same_thread=False,
+                           isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    connections[period] = conn
+    while len(connections) > OPEN_ARCHIVES:
+        connections.popitem(last=False)[1].close()
+    return conn
+
+def read_artifact(period, name):
+    """Bytes of a packed PDF or QR code, or None if the month's ZIP doesn't have it"""
+    path = artifacts_path(period)
+    with _artifact_lock:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        # Kept open: reading the central directory of a large ZIP costs more than the member
+        key = (os.getpid(), path)
+        cached = _artifact_files.get(key)
+        if cached is None or cached[0] != mtime:
+            if cached is not None:
+                cached[1].close()
+            cached = _artifact_files[key] = (mtime, zipfile.ZipFile(path))
+            while len(_artifact_files) > OPEN_ARCHIVES:
+                _artifact_files.popitem(last=False)[1][1].close()
+        _artifact_files.move_to_end(key)
+        try:
+            return cached[1].read(name)
+        except KeyError:
+            return None
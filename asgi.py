@@ -0,0 +1,298 @@
+"""ASGI entry point with an asyncio submission path.
+
+    uvicorn asgi:app --port 5000
+
+JSON submissions (``POST /submit/<scenario_id>`` that app.wants_json() would
+answer with JSON) are handled on the event loop. The payload is built and
+validated exactly as in app.py, then sent through one shared AsyncFBRClient,
+so a single process can keep hundreds of FBR requests in flight without a
+thread per request. Database writes still go through the single writer thread
+and are awaited rather than blocked on. Every other request, browser form
+posts included, is handed to the Flask app unchanged, on a pool of
+FBR_WSGI_THREADS threads (default 32) so a browser submission waiting on the
+outbox does not hold up other pages. Its response is streamed chunk by chunk,
+so large exports are not held in memory.
+
+Needs aiohttp, and an ASGI server such as uvicorn.
+"""
+import asyncio
+import io
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import app as flask_app
+import dedup
+import fbr_client
+import invoices
+import metrics
+import outbox
+import payloads
+import pdfs
+import storage
+import validation
+
+SUBMIT_PATH = re.compile(r'/submit/([^/]+)')
+# Largest submission body accepted
+MAX_BODY_BYTES = 16 * 1024 * 1024
+
+WSGI_THREADS = int(os.environ.get('FBR_WSGI_THREADS', '32'))
+
+_wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='wsgi')
+_client = None
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+    if scope['type'] == 'http' and scope['method'] == 'POST' and _wants_json(scope):
+        match = SUBMIT_PATH.fullmatch(scope['path'])
+        if match:
+            timing = metrics.start_request()
+            status = await _submit(match.group(1), scope, receive, send)
+            metrics.finish_request(timing, 'submit', status)
+            return
+    if scope['type'] == 'http':
+        await _wsgi(scope, receive, send)
+
+async def _lifespan(receive, send):
+    global _client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await asyncio.get_running_loop().run_in_executor(_wsgi_executor, flask_app.warm_up)
+            _client = fbr_client.AsyncFBRClient()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if _client is not None:
+                await _client.close()
+            _wsgi_executor.shutdown(wait=False)
+            pdfs.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+def _get_client():
+    global _client
+    # Servers run without lifespan events still get a client, on first use
+    if _client is None:
+        _client = fbr_client.AsyncFBRClient()
+    return _client
+
+
+# ---------------- SUBMISSION -----------------
+async def _submit(scenario_id, scope, receive, send):
+    """Handle one JSON submission; returns the response status"""
+    try:
+        form_data = _parse_body(scope, await _read_body(receive))
+    except ValueError as e:
+        return await _respond(send, {'error': str(e)}, 400)
+    if scenario_id not in payloads.BUILDERS:
+        return await _respond(send, {'error': f'Scenario {scenario_id} not implemented yet'}, 400)
+
+    payload = None
+    try:
+        with metrics.timer('payload_build'):
+            payload = payloads.build(scenario_id, form_data)
+        with metrics.timer('validate'):
+            errors = validation.validate(scenario_id, payload)
+        if errors:
+            return await _respond(send, {
+                'success': False,
+                'error': f'{len(errors)} problem(s) found before sending to FBR',
+                'validation_errors': errors,
+                'request_payload': payload
+            }, 422)
+
+        payload_hash = None
+        if str(form_data.get('allow_duplicate', '')).lower() not in ('1', 'true', 'on', 'yes'):
+            with metrics.timer('dedup'):
+                payload_hash = dedup.payload_hash(payload)
+                invoice_number = dedup.issued_invoice(storage.get_connection(), payload_hash)
+            if invoice_number:
+                return await _respond(send, dedup.duplicate_result(payload, invoice_number), 200)
+
+        api_url, bearer_token = form_data.get('api_url'), form_data.get('bearer_token')
+        if outbox.ENABLED:
+            result, status = await _submit_through_outbox(
+                scenario_id, payload, api_url, bearer_token, form_data.get('idempotency_key'), payload_hash)
+        else:
+            result, status = await post_invoice(scenario_id, payload, api_url, bearer_token), 200
+    except fbr_client.ASYNC_REQUEST_ERRORS as e:
+        result, status = {'success': False, 'error': str(e), 'request_payload': payload}, 200
+    except Exception as e:
+        result, status = {'success': False, 'error': f'Application error: {e}', 'request_payload': payload}, 200
+    return await _respond(send, result, status)
+
+async def _submit_through_outbox(scenario_id, payload, api_url, bearer_token, idempotency_key, payload_hash=None):
+    """Persist the invoice, then send it from this request instead of waiting for a worker.
+
+    Attempts that fail are left to the outbox workers to retry, as for the Flask path.
+    """
+    with metrics.timer('outbox_enqueue'):
+        try:
+            entry = await _write(outbox.add, idempotency_key or payload_hash or outbox.new_key(), scenario_id,
+                                 json.dumps(payload), api_url or '', bearer_token or '', time.time(), payload_hash)
+        except outbox.KeyConflict as e:
+            return {'success': False, 'error': str(e), 'request_payload': payload}, 409
+    key = entry['idempotency_key']
+    claimed = await _write(outbox.claim, key, time.time())
+    if claimed is not None:
+        try:
+            outcome = outbox.classify(await post_invoice(scenario_id, payload, claimed['api_url'], claimed['bearer_token']))
+        except fbr_client.ASYNC_REQUEST_ERRORS as e:
+            outcome = outbox.not_sent(e) if fbr_client.async_never_sent(e) else outbox.no_answer(e)
+        except Exception as e:
+            outcome = outbox.app_error(e)
+        await _write(outbox.settle, claimed, time.time(), outcome)
+        entry = await _read(outbox.get, key)
+    else:
+        # Sent before, or being sent by someone else: report how it stands
+        entry = await _read(outbox.wait, key)
+    return outbox.result(entry), 200 if entry['status'] in outbox.SETTLED else 202
+
+async def post_invoice(scenario_id, payload, api_url, bearer_token):
+    """app.post_invoice on the event loop"""
+    with metrics.timer('fbr_call'):
+        response = await _get_client().post(api_url, json=payload, headers=flask_app.fbr_headers(bearer_token))
+    result = flask_app.invoice_result(payload, response)
+    if result['success']:
+        payload_hash = dedup.payload_hash(payload)
+        with metrics.timer('db_insert'):
+            await _write(invoices.insert_invoice, result['invoice_number'], scenario_id, payload, payload_hash)
+        dedup.remember(payload_hash, result['invoice_number'])
+        # Template rendering for the PDF is CPU work: keep it off the event loop
+        asyncio.get_running_loop().run_in_executor(None, flask_app.invoice_saved, result['invoice_number'])
+    return result
+
+
+# ---------------- FLASK -----------------
+async def _wsgi(scope, receive, send):
+    """Run the Flask app for one request on the WSGI thread pool"""
+    try:
+        body = await _read_body(receive)
+    except ValueError as e:
+        await _respond(send, {'error': str(e)}, 413)
+        return
+    response = {}
+    result, chunks, chunk = await _read(_start_wsgi, _environ(scope, body), response)
+    try:
+        await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+        # Each chunk is produced on the pool, so a streamed export never blocks the loop
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await _read(next, chunks, None)
+    finally:
+        if hasattr(result, 'close'):
+            await _read(result.close)
+    await send({'type': 'http.response.body', 'body': b''})
+
+def _start_wsgi(environ, response):
+    """Call the Flask app and produce the first chunk; streamed responses only start_response by then"""
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    result = flask_app.app(environ, start_response)
+    try:
+        chunks = iter(result)
+        return result, chunks, next(chunks, None)
+    except BaseException:
+        if hasattr(result, 'close'):
+            result.close()
+        raise
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_LENGTH':
+            continue
+        if name != 'CONTENT_TYPE':
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+
+# ---------------- HELPERS -----------------
+def _write(func, *args):
+    """Queue a write on the storage writer thread; await the result"""
+    return asyncio.wrap_future(storage.write(func, *args))
+
+def _read(func, *args):
+    """Run blocking work (a database read, a WSGI chunk) on the WSGI thread pool; await the result"""
+    return asyncio.get_running_loop().run_in_executor(_wsgi_executor, func, *args)
+
+def _wants_json(scope):
+    """app.wants_json() for a raw ASGI request, so both servers answer a request the same way"""
+    accept = ','.join(value.decode('latin-1') for name, value in scope['headers'] if name == b'accept')
+    args = dict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+    return flask_app.json_requested(args, parse_accept_header(accept, MIMEAccept))
+
+def _header(scope, wanted):
+    for name, value in scope['headers']:
+        if name == wanted:
+            return value.decode('latin-1')
+    return ''
+
+async def _read_body(receive):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise ValueError('Request body too large')
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+def _parse_body(scope, body):
+    content_type = _header(scope, b'content-type').split(';')[0].strip().lower()
+    if content_type == 'application/json':
+        try:
+            form_data = json.loads(body or b'null')
+        except ValueError:
+            raise ValueError('Request body is not valid JSON')
+        if not isinstance(form_data, dict):
+            raise ValueError('JSON body must be an object')
+        return form_data
+    return dict(parse_qsl(body.decode('utf-8'), keep_blank_values=True))
+
+async def _respond(send, data, status):
+    body = json.dumps(data, default=str).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+    return status
@@ -0,0 +1,134 @@
+"""Static assets held in memory, for pages and PDF rendering.
+
+Images, fonts and stylesheets under ``static/`` are read once, when first
+needed (the app and each PDF render process preload them at startup), and
+served from memory from then on:
+
+- ``data_uri(name)`` inlines an asset into a page, e.g. the FBR logo in PDFs;
+- ``url_fetcher()`` is given to WeasyPrint, so that ``/static/...`` and
+  ``data:`` URLs resolve from memory and nothing else is fetched: rendering a
+  PDF touches neither the filesystem nor the network, and behaves the same on
+  any host.
+
+Documents are rendered with ``BASE_URL`` as their base, so relative URLs
+resolve the same way wherever the app is installed.
+"""
+import base64
+import logging
+import mimetypes
+import os
+import threading
+from urllib.parse import unquote, unquote_to_bytes, urlsplit
+
+log = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, "static")
+# Generated files, not assets
+SKIP_DIRS = {"pdfs", "qrcodes"}
+ASSET_EXTENSIONS = {".css", ".gif", ".jpeg", ".jpg", ".png", ".svg", ".webp",
+                    ".otf", ".ttf", ".woff", ".woff2"}
+# Virtual origin for documents; only its /static/ paths resolve
+BASE_URL = "https://fbr-di.invalid/"
+
+_assets = None
+_data_uris = {}
+_lock = threading.Lock()
+
+
+def preload():
+    """Read every asset under static/ into memory"""
+    global _assets
+    with _lock:
+        if _assets is None:
+            _assets = _read_all(STATIC_DIR)
+    return _assets
+
+def get(name):
+    """Bytes of ``static/<name>``, or None if there is no such asset"""
+    return (_assets if _assets is not None else preload()).get(name)
+
+def data_uri(name):
+    """``static/<name>`` as a data: URI, built once"""
+    uri = _data_uris.get(name)
+    if uri is None:
+        data = get(name)
+        if data is None:
+            raise KeyError(f"No asset static/{name}")
+        uri = _data_uris[name] = f"data:{_mime_type(name)};base64,{base64.b64encode(data).decode('ascii')}"
+    return uri
+
+def url_fetcher():
+    """WeasyPrint URL fetcher serving static assets and data: URLs from memory, and refusing everything else.
+
+    WeasyPrint 65 and later take a ``URLFetcher`` instance; earlier versions a
+    function returning a dict.
+    """
+    try:
+        from weasyprint.urls import URLFetcher, URLFetcherResponse
+    except ImportError:
+        return _fetch_dict
+
+    class MemoryURLFetcher(URLFetcher):
+        def fetch(self, url, headers=None):
+            data, mime_type = fetch(url)
+            return URLFetcherResponse(url, body=data, headers={"Content-Type": mime_type})
+
+    return MemoryURLFetcher()
+
+def fetch(url):
+    """``(bytes, mime type)`` of a data: URL or bundled static asset; ValueError for anything else"""
+    if url.startswith("data:"):
+        mime_type, data = _decode_data_uri(url)
+        return data, mime_type
+
+    name = static_name(url)
+    data = get(name) if name else None
+    if data is None:
+        # WeasyPrint logs this and renders the document without the resource
+        raise ValueError(f"{url} is not a bundled static asset")
+    return data, _mime_type(name)
+
+def static_name(url):
+    """``images/logo.jpg`` for .../static/images/logo.jpg on BASE_URL or in the app's static folder"""
+    parts = urlsplit(url)
+    if url.startswith(BASE_URL):
+        prefix = "/static/"
+    elif parts.scheme == "file":
+        prefix = STATIC_DIR.replace(os.sep, "/") + "/"
+    else:
+        return None
+    path = unquote(parts.path)
+    return path[len(prefix):] if path.startswith(prefix) else None
+
+
+def _fetch_dict(url, timeout=10, ssl_context=None, **kwargs):
+    data, mime_type = fetch(url)
+    return {"string": data, "mime_type": mime_type, "redirected_url": url}
+
+def _read_all(static_dir):
+    assets = {}
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = [d for d in dirs if not (root == static_dir and d in SKIP_DIRS)]
+        for filename in files:
+            if os.path.splitext(filename)[1].lower() not in ASSET_EXTENSIONS:
+                continue
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, static_dir).replace(os.sep, "/")
+            try:
+                with open(path, "rb") as asset:
+                    assets[name] = asset.read()
+            except OSError as e:
+                log.warning("Could not load asset %s: %s", name, e)
+    return assets
+
+def _mime_type(name):
+    return mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+def _decode_data_uri(url):
+    header, _, payload = url[len("data:"):].partition(",")
+    params = header.split(";")
+    mime_type = params[0] or "text/plain"
+    if "base64" in params[1:]:
+        return mime_type, base64.b64decode(payload)
+    return mime_type, unquote_to_bytes(payload)
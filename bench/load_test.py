@@ -0,0 +1,153 @@
+"""Load test: JSON invoice submission, Flask (threads) vs the asyncio path.
+
+Starts the mock FBR API (bench/mock_fbr.py), then the app twice, each with a fresh database: once
+under the Flask server (``flask run``) and once under uvicorn (``asgi:app``).
+Each is sent the same number of ``POST /submit/SN001`` requests at a fixed
+concurrency, and requests/second and latency percentiles are reported.
+
+    python bench/load_test.py --requests 2000 --concurrency 200 --latency 0.2
+
+Needs aiohttp and uvicorn. PDFs are not pre-rendered during the test.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from payload_build import sample_row, as_items_array  # noqa: E402
+
+SERVERS = {
+    'flask (threads)': [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', '{port}'],
+    'asgi (asyncio)': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', '{port}',
+                       '--log-level', 'warning', '--no-access-log'],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def server_env(outbox, concurrency, **extra):
+    return dict(os.environ,
+                PYTHONPATH=os.pathsep.join(filter(None, [APP_DIR, BENCH_DIR, os.environ.get('PYTHONPATH')])),
+                FBR_PDF_PRERENDER='0',
+                FBR_OUTBOX='1' if outbox else '0',
+                # Enough outbox workers for the Flask path to keep up with the load
+                FBR_OUTBOX_WORKERS=str(concurrency),
+                FBR_OUTBOX_RATE='0',
+                **extra)
+
+def start_server(command, port, workdir, log, env):
+    return subprocess.Popen([part.format(port=port) for part in command], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+def stop_server(process):
+    # Interrupted rather than terminated, so the app shuts its PDF worker processes down too
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+async def wait_until_up(url, process, log, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                log.seek(0)
+                raise RuntimeError(f'Server exited with status {process.returncode}: {log.read()[-2000:]}')
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                return
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f'Server at {url} did not start')
+
+async def drive(base_url, fbr_url, total, concurrency):
+    """Send ``total`` submissions, ``concurrency`` at a time. Returns (seconds, latencies, failures)."""
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as session:
+        latencies, failures = [], 0
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(number):
+            nonlocal failures
+            body = dict(as_items_array(sample_row(number, 3)), api_url=fbr_url, bearer_token='load-test')
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    async with session.post(base_url + '/submit/SN001', json=body,
+                                            headers={'Accept': 'application/json'}) as response:
+                        ok = response.status == 200 and (await response.json()).get('success')
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    ok = False
+                latencies.append(time.perf_counter() - started)
+                if not ok:
+                    failures += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(number) for number in range(total)))
+        return time.perf_counter() - started, sorted(latencies), failures
+
+async def run(args):
+    # In its own process, so the load generator and the stand-in don't share a CPU
+    fbr_port = free_port()
+    fbr = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'mock_fbr.py'), '--port', str(fbr_port),
+                            '--latency', str(args.latency)], stdout=subprocess.DEVNULL)
+    fbr_url = f'http://127.0.0.1:{fbr_port}/'
+    print(f"{args.requests} submissions, {args.concurrency} concurrent, mock FBR latency {args.latency * 1000:.0f} ms, "
+          f"outbox {'on' if args.outbox else 'off'}")
+    print(f"  {'server':<18}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'failed':>8}")
+
+    try:
+        for name, command in SERVERS.items():
+            await run_server(name, command, fbr_url, args)
+    finally:
+        fbr.terminate()
+
+async def run_server(name, command, fbr_url, args):
+    with tempfile.TemporaryDirectory() as workdir:
+        port = free_port()
+        # Logged to a file: a pipe nobody reads would block the server once it fills
+        with open(os.path.join(workdir, 'server.log'), 'w+') as log:
+            process = start_server(command, port, workdir, log, server_env(args.outbox, args.concurrency))
+            base_url = f'http://127.0.0.1:{port}'
+            try:
+                await wait_until_up(base_url + '/', process, log)
+                await drive(base_url, fbr_url, min(50, args.requests), min(10, args.concurrency))   # warm up
+                seconds, latencies, failures = await drive(base_url, fbr_url, args.requests, args.concurrency)
+            finally:
+                stop_server(process)
+    print(f"  {name:<18}{args.requests / seconds:>10.1f}{percentile(latencies, 0.50) * 1000:>10.1f}"
+          f"{percentile(latencies, 0.95) * 1000:>10.1f}{percentile(latencies, 0.99) * 1000:>10.1f}{failures:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.2, help='Mock FBR response time in seconds')
+    parser.add_argument('--outbox', action='store_true', help='Send through the outbox (FBR_OUTBOX=1)')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""Stand-in for the FBR invoice API, for load tests and benchmarks.
+
+Answers every POST with ``{"invoiceNumber": ...}`` after a configurable
+delay. It runs on asyncio, so thousands of slow requests can be open at once
+without the stand-in becoming the bottleneck. Point the app at it by using
+its URL as the API URL; no real invoices are ever issued.
+
+    python bench/mock_fbr.py --port 9000 --latency 0.2 --jitter 0.05 \
+        --error-rate 0.02 --reject-rate 0.01 --rate-limit 100
+
+- ``--error-rate``: fraction of requests answered ``500`` (FBR failed)
+- ``--reject-rate``: fraction answered ``200`` with validation status ``01``
+  and no invoice number (FBR refused the invoice)
+- ``--rate-limit``: requests per second accepted; the rest are answered
+  ``429`` with ``Retry-After``, as FBR's gateway does
+
+``GET /stats`` returns what has been answered so far. ``GET .../itemdesccode``
+and ``GET .../uom`` answer like FBR's reference API, with ``--hs-codes``
+made-up HS codes and FBR's units of measure, for ``flask refresh-refdata
+--url http://127.0.0.1:9000/pdi/v1/``.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+
+UOMS = ('Numbers, pieces, units', 'Kilogram', 'KG', 'MT', 'Liter', 'Meter', 'Square Metre', 'Pair', 'Dozen', 'SET')
+HS_CODE_WORDS = ('cotton', 'yarn', 'woven', 'fabric', 'polyester', 'denim', 'steel', 'bars', 'cement', 'pipes',
+                 'copper', 'wire', 'plastic', 'sheets', 'machinery', 'parts', 'live', 'animals', 'fresh', 'frozen')
+
+
+def reference_lists(hs_codes=2000, seed=1):
+    """What the reference endpoints answer, by the last part of their path"""
+    rng = random.Random(seed)
+    codes = sorted({f'{rng.randint(100, 9799):04d}.{rng.randint(0, 9999):04d}' for _ in range(hs_codes)})
+    return {
+        b'itemdesccode': [{'hS_CODE': code, 'description': ' '.join(rng.sample(HS_CODE_WORDS, 4)).capitalize()}
+                          for code in codes],
+        b'uom': [{'uoM_ID': number, 'description': uom} for number, uom in enumerate(UOMS, start=1)],
+    }
+
+
+class MockFBR:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, reject_rate=0.0, rate_limit=0, seed=None,
+                 hs_codes=2000):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.rate_limit = rate_limit
+        self.requests = 0
+        self.answered = {'accepted': 0, 'rejected': 0, 'errors': 0, 'rate_limited': 0}
+        self._numbers = itertools.count(1)
+        self._random = random.Random(seed)
+        self.reference = reference_lists(hs_codes)
+        # Token bucket holding up to one second's worth of requests
+        self._tokens = float(rate_limit)
+        self._refilled = time.monotonic()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length') or 0))
+
+                method, path = request_line.split(b' ')[:2]
+                status, data, extra_headers = await self.answer(method, path, body)
+                payload = json.dumps(data).encode()
+                head = ''.join(f'{name}: {value}\r\n' for name, value in extra_headers.items())
+                writer.write(
+                    f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n{head}'
+                    f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n\r\n'.encode() + payload
+                )
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, method, path, body):
+        if method == b'GET' and path == b'/stats':
+            return 200, dict(self.answered, requests=self.requests), {}
+        if method == b'GET':
+            reference = self.reference.get(path.split(b'?')[0].rstrip(b'/').rsplit(b'/', 1)[-1])
+            if reference is not None:
+                return 200, reference, {}
+        if method != b'POST':
+            return 405, {'error': 'POST only'}, {}
+        self.requests += 1
+
+        # Rate limiting is decided on arrival, before any latency, like a gateway
+        if self.rate_limit and not self._take_token():
+            self.answered['rate_limited'] += 1
+            return 429, {'error': 'Too many requests'}, {'Retry-After': '1'}
+
+        delay = self.latency + (self._random.uniform(-self.jitter, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        roll = self._random.random()
+        if roll < self.error_rate:
+            self.answered['errors'] += 1
+            return 500, {'error': 'Internal server error'}, {}
+        if roll < self.error_rate + self.reject_rate:
+            self.answered['rejected'] += 1
+            return 200, {
+                'dated': '2025-01-15 00:00:00',
+                'validationResponse': {'statusCode': '01', 'status': 'Invalid', 'errorCode': '0052',
+                                       'error': 'Provide proper HS Code with invoice no. 1'},
+            }, {}
+
+        self.answered['accepted'] += 1
+        number = next(self._numbers)
+        return 200, {
+            'invoiceNumber': f'MOCK{number:010d}',
+            'dated': '2025-01-15 00:00:00',
+            'validationResponse': {'statusCode': '00', 'status': 'Valid', 'error': ''},
+        }, {}
+
+    def _take_token(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate_limit, self._tokens + (now - self._refilled) * self.rate_limit)
+        self._refilled = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def serve(self, host='127.0.0.1', port=0):
+        """Start listening and return the asyncio server (port 0 picks a free port)"""
+        return await asyncio.start_server(self.handle, host, port, backlog=4096)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds before each answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Latency varies by up to this many seconds either way')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered 500')
+    parser.add_argument('--reject-rate', type=float, default=0.0, help='Fraction of invoices refused')
+    parser.add_argument('--rate-limit', type=float, default=0, help='Requests per second before answering 429 (0: no limit)')
+    parser.add_argument('--seed', type=int, help='Random seed, for repeatable runs')
+    parser.add_argument('--hs-codes', type=int, default=2000, help='HS codes in the reference list')
+    args = parser.parse_args()
+
+    async def run():
+        mock = MockFBR(args.latency, args.jitter, args.error_rate, args.reject_rate, args.rate_limit, args.seed,
+                       args.hs_codes)
+        server = await mock.serve(args.host, args.port)
+        print(f"Mock FBR API on http://{args.host}:{args.port}/", flush=True)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
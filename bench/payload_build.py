@@ -0,0 +1,152 @@
+"""Microbenchmark: cost of building one invoice payload.
+
+Compares the compiled builders in payloads.py with the hand-written
+build_snXXX_payload functions they replaced (reproduced below), on the kind
+of rows a large bulk import produces.
+
+    python bench/payload_build.py [--invoices 20000] [--items 3]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import payloads  # noqa: E402
+
+
+# ---------------- PREVIOUS IMPLEMENTATION -----------------
+def safe_float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
+
+def safe_float_or_empty(value):
+    if value is None or str(value).strip() == "":
+        return ""
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return ""
+
+def legacy_parse_items(form_data):
+    items = []
+    index = 0
+    while f'item_{index}_hsCode' in form_data:
+        item = {
+            'hsCode': form_data.get(f'item_{index}_hsCode', ''),
+            'productDescription': form_data.get(f'item_{index}_productDescription', ''),
+            'rate': form_data.get(f'item_{index}_rate', '18%'),
+            'uoM': form_data.get(f'item_{index}_uoM', ''),
+            'quantity': safe_float(form_data.get(f'item_{index}_quantity')),
+            'totalValues': safe_float(form_data.get(f'item_{index}_totalValues')),
+            'valueSalesExcludingST': safe_float(form_data.get(f'item_{index}_valueSalesExcludingST')),
+            'fixedNotifiedValueOrRetailPrice': safe_float(form_data.get(f'item_{index}_fixedNotifiedValueOrRetailPrice')),
+            'salesTaxApplicable': safe_float(form_data.get(f'item_{index}_salesTaxApplicable')),
+            'salesTaxWithheldAtSource': safe_float(form_data.get(f'item_{index}_salesTaxWithheldAtSource')),
+            'extraTax': safe_float_or_empty(form_data.get(f'item_{index}_extraTax')),
+            'furtherTax': safe_float(form_data.get(f'item_{index}_furtherTax')),
+            'sroScheduleNo': form_data.get(f'item_{index}_sroScheduleNo', ''),
+            'fedPayable': safe_float(form_data.get(f'item_{index}_fedPayable')),
+            'discount': safe_float(form_data.get(f'item_{index}_discount')),
+            'saleType': form_data.get(f'item_{index}_saleType', 'Goods at standard rate (default)'),
+            'sroItemSerialNo': form_data.get(f'item_{index}_sroItemSerialNo', '')
+        }
+        items.append(item)
+        index += 1
+    return items
+
+def legacy_build_sn001_payload(form_data):
+    items = legacy_parse_items(form_data)
+    return {
+        'invoiceType': form_data.get('invoiceType', 'Sale Invoice'),
+        'invoiceDate': form_data.get('invoiceDate', datetime.now().strftime('%Y-%m-%d')),
+        'sellerBusinessName': form_data.get('sellerBusinessName', ''),
+        'sellerProvince': form_data.get('sellerProvince', ''),
+        'sellerNTNCNIC': form_data.get('sellerNTNCNIC', ''),
+        'sellerAddress': form_data.get('sellerAddress', ''),
+        'buyerNTNCNIC': form_data.get('buyerNTNCNIC', ''),
+        'buyerBusinessName': form_data.get('buyerBusinessName', ''),
+        'buyerProvince': form_data.get('buyerProvince', ''),
+        'buyerAddress': form_data.get('buyerAddress', ''),
+        'invoiceRefNo': form_data.get('invoiceRefNo', ''),
+        'scenarioId': 'SN001',
+        "buyerRegistrationType": form_data["buyerType"],
+        'items': items
+    }
+
+
+# ---------------- BENCHMARK -----------------
+def sample_row(number, item_count):
+    row = {
+        'invoiceType': 'Sale Invoice',
+        'invoiceDate': '2025-01-15',
+        'sellerNTNCNIC': '1234567',
+        'sellerBusinessName': 'Seller Pvt Ltd',
+        'sellerProvince': 'Punjab',
+        'sellerAddress': 'Lahore',
+        'buyerNTNCNIC': '7654321',
+        'buyerBusinessName': f'Buyer {number}',
+        'buyerProvince': 'Sindh',
+        'buyerAddress': 'Karachi',
+        'buyerType': 'Registered',
+    }
+    for index in range(item_count):
+        row.update({
+            f'item_{index}_hsCode': '0101.2100',
+            f'item_{index}_productDescription': f'Product {index}',
+            f'item_{index}_rate': '18%',
+            f'item_{index}_uoM': 'Numbers, pieces, units',
+            f'item_{index}_quantity': '2',
+            f'item_{index}_valueSalesExcludingST': '1000',
+            f'item_{index}_salesTaxApplicable': '180',
+        })
+    return row
+
+def as_items_array(row):
+    """The same invoice with its items as an "items" list of objects"""
+    header = {key: value for key, value in row.items() if not key.startswith('item_')}
+    items = {}
+    for key, value in row.items():
+        if key.startswith('item_'):
+            _, index, field = key.split('_', 2)
+            items.setdefault(int(index), {})[field] = value
+    header['items'] = [items[index] for index in sorted(items)]
+    return header
+
+def measure(build, rows, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for row in rows:
+            build(row)
+        best = min(best, time.perf_counter() - start)
+    return best / len(rows) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--invoices', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=3, help='Items per invoice')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rows = [sample_row(number, args.items) for number in range(args.invoices)]
+    builder = payloads.BUILDERS['SN001']
+    assert builder(rows[0]) == legacy_build_sn001_payload(rows[0])
+
+    json_rows = [as_items_array(row) for row in rows]
+    assert builder(json_rows[0]) == builder(rows[0])
+
+    legacy = measure(legacy_build_sn001_payload, rows, args.repeat)
+    compiled = measure(builder, rows, args.repeat)
+    compiled_json = measure(builder, json_rows, args.repeat)
+    print(f"{args.invoices} invoices x {args.items} items, best of {args.repeat}")
+    print(f"  hand-written builder:        {legacy:8.2f} us/invoice")
+    print(f"  compiled builder:            {compiled:8.2f} us/invoice  ({legacy / compiled:.2f}x)")
+    print(f"  compiled, items JSON array:  {compiled_json:8.2f} us/invoice  ({legacy / compiled_json:.2f}x)")
+
+if __name__ == '__main__':
+    main()
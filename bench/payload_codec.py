@@ -0,0 +1,201 @@
+"""Benchmark: stored invoice payload codecs.
+
+Fills one database per codec with the same synthetic invoices, then reports
+the database size, the time to read and decode one invoice's payload, and the
+time to serve an invoice page that is not cached yet (read, decode, render).
+Codecs whose package isn't installed are skipped.
+
+    python bench/payload_codec.py [--invoices 1000000] [--items 3] [--workdir DIR]
+
+Each compressing codec runs twice, without and with a dictionary trained on
+the first invoices (``+dict``).
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+PROVINCES = ('Punjab', 'Sindh', 'Khyber Pakhtunkhwa', 'Balochistan', 'Islamabad Capital Territory')
+PRODUCTS = ('Cotton yarn 20s', 'Polyester fabric', 'Printed lawn', 'Denim roll', 'Bedsheet set', 'Towel bale',
+            'Steel bar 12mm', 'Cement bag 50kg', 'PVC pipe 4in', 'Copper wire 2.5mm')
+INSERT_BATCH = 1000
+
+
+def invoice_forms(count, items, seed=1):
+    """Form data for ``count`` invoices: a few hundred buyers, a small product catalogue"""
+    rng = random.Random(seed)
+    for number in range(count):
+        buyer = rng.randrange(500)
+        form = {
+            'invoiceDate': f'2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+            'sellerNTNCNIC': '1234567', 'sellerBusinessName': 'Crescent Textile Mills Ltd',
+            'sellerProvince': 'Punjab', 'sellerAddress': '12 Industrial Estate, Faisalabad',
+            'buyerNTNCNIC': f'{4000000 + buyer}', 'buyerBusinessName': f'Buyer Trading Company {buyer}',
+            'buyerProvince': PROVINCES[buyer % len(PROVINCES)], 'buyerAddress': f'Shop {buyer}, Main Bazaar',
+            'buyerType': 'Registered', 'invoiceRefNo': f'SI-{number:08d}',
+        }
+        for index in range(items):
+            value = rng.randrange(1000, 500000)
+            form.update({
+                f'item_{index}_hsCode': f'{rng.randint(1000, 9999)}.{rng.randint(1000, 9999)}',
+                f'item_{index}_productDescription': rng.choice(PRODUCTS),
+                f'item_{index}_rate': '18%', f'item_{index}_uoM': 'Numbers, pieces, units',
+                f'item_{index}_quantity': str(rng.randint(1, 500)),
+                f'item_{index}_valueSalesExcludingST': str(value),
+                f'item_{index}_salesTaxApplicable': f'{value * 0.18:.2f}',
+                f'item_{index}_totalValues': f'{value * 1.18:.2f}',
+            })
+        yield f'BENCH{number:09d}', form
+
+
+def load(path, codec, dictionary, count, items):
+    import invoices
+    import payload_codec
+    import payloads
+    import storage
+
+    payload_codec.CODEC = codec
+    payload_codec._active.clear()
+    storage.init_db(path)
+    conn = storage.connect(path)
+    started = time.perf_counter()
+    batch = []
+
+    def flush():
+        conn.execute('BEGIN')
+        for invoice_number, form in batch:
+            invoices.insert_invoice(conn, invoice_number, 'SN001', payloads.build('SN001', form))
+        conn.execute('COMMIT')
+        batch.clear()
+
+    trained = not dictionary
+    for loaded, (invoice_number, form) in enumerate(invoice_forms(count, items), start=1):
+        batch.append((invoice_number, form))
+        if len(batch) >= INSERT_BATCH:
+            flush()
+            if not trained and loaded >= payload_codec.TRAINING_SAMPLES:
+                # Train on the first invoices, as recode-payloads --train would, then recode them
+                conn.execute('BEGIN')
+                payload_codec.train(conn, codec)
+                last_id = 0
+                while True:
+                    last_id, read, _ = payload_codec.recode_batch(conn, codec, last_id)
+                    if not read:
+                        break
+                conn.execute('COMMIT')
+                trained = True
+    if batch:
+        flush()
+    load_seconds = time.perf_counter() - started
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    payload_bytes = conn.execute("SELECT SUM(length(CAST(payload AS BLOB))) FROM invoices").fetchone()[0]
+    conn.close()
+    return load_seconds, os.path.getsize(path), payload_bytes
+
+
+def read_latencies(path, numbers):
+    import payload_codec
+    import storage
+
+    storage.init_db(path)
+    payload_codec._dictionaries.clear()
+    conn = storage.get_connection()
+    timings = []
+    for invoice_number in numbers:
+        started = time.perf_counter()
+        row = conn.execute("SELECT payload FROM invoices WHERE invoice_number = ?", (invoice_number,)).fetchone()
+        payload_codec.decode(row["payload"])
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def render_latencies(flask_app, path, numbers):
+    import render_cache
+    import storage
+
+    storage.init_db(path)
+    # Every page rendered, not served from the previous codec's cache
+    flask_app.invoice_pages = render_cache.RenderCache(flask_app.INVOICE_TEMPLATE_VERSION, directory=None)
+    client = flask_app.app.test_client()
+    timings = []
+    for invoice_number in numbers:
+        started = time.perf_counter()
+        response = client.get(f'/invoice/{invoice_number}')
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200, response.status_code
+    return timings
+
+
+def _remove_database(path):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def summary_ms(timings):
+    timings = sorted(timings)
+    return (statistics.mean(timings) * 1000, timings[len(timings) // 2] * 1000,
+            timings[int(len(timings) * 0.95)] * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--invoices', type=int, default=100000)
+    parser.add_argument('--items', type=int, default=3, help='Line items per invoice')
+    parser.add_argument('--reads', type=int, default=20000, help='Random invoices read per codec')
+    parser.add_argument('--renders', type=int, default=2000, help='Invoice pages served per codec')
+    parser.add_argument('--codecs', default='json,zlib,zlib+dict,zstd,zstd+dict,msgpack')
+    parser.add_argument('--workdir', help='Where to keep the databases (default: a temporary directory)')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='payload-codec-')
+    os.makedirs(workdir, exist_ok=True)
+    # app.py opens invoices.db in the working directory; keep it out of the way
+    os.chdir(workdir)
+    os.environ.setdefault('FBR_OUTBOX', '0')
+    os.environ.setdefault('FBR_PDF_PRERENDER', '0')
+    os.environ.setdefault('FBR_PDF_DIR', os.path.join(workdir, 'pdfs'))
+    os.environ.setdefault('FBR_LOG_LEVEL', 'WARNING')
+    import app as flask_app
+    import payload_codec
+
+    rng = random.Random(2)
+    numbers = [f'BENCH{n:09d}' for n in range(args.invoices)]
+    reads = [rng.choice(numbers) for _ in range(args.reads)]
+    renders = rng.sample(numbers, min(args.renders, len(numbers)))
+
+    print(f"{args.invoices} invoices, {args.items} items each, in {workdir}")
+    print(f"{'codec':<12} {'load s':>8} {'db MB':>8} {'payload B':>10} "
+          f"{'read ms mean/p50/p95':>22} {'page ms mean/p50/p95':>22}")
+    try:
+        for variant in args.codecs.split(','):
+            codec, _, dictionary = variant.partition('+')
+            try:
+                payload_codec.CODECS[codec].check()
+            except RuntimeError as e:
+                print(f"{variant:<12} skipped: {e}")
+                continue
+            path = os.path.join(workdir, f'{variant}.db')
+            _remove_database(path)
+            load_seconds, db_bytes, payload_bytes = load(path, codec, bool(dictionary), args.invoices, args.items)
+            read = summary_ms(read_latencies(path, reads))
+            page = summary_ms(render_latencies(flask_app, path, renders))
+            print(f"{variant:<12} {load_seconds:>8.1f} {db_bytes / 1e6:>8.1f} {payload_bytes / args.invoices:>10.0f} "
+                  f"{'%.3f / %.3f / %.3f' % read:>22} {'%.2f / %.2f / %.2f' % page:>22}", flush=True)
+            if not args.workdir:
+                # A million invoices take gigabytes per codec
+                _remove_database(path)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Benchmark: reference data lookups.
+
+Loads made-up HS codes (as bench/mock_fbr.py serves them) into a fresh
+database, then reports the time to look entries up by code prefix and by
+description word, directly and through ``/ref/hs_codes``, and the time to
+validate an invoice against the loaded lists.
+
+    python bench/refdata.py [--hs-codes 20000] [--lookups 5000]
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIR)
+
+from mock_fbr import HS_CODE_WORDS, reference_lists  # noqa: E402
+
+
+def summary_ms(timings):
+    timings = sorted(timings)
+    return (statistics.mean(timings) * 1000, timings[len(timings) // 2] * 1000,
+            timings[int(len(timings) * 0.95)] * 1000)
+
+
+def queries(codes, count, seed=2):
+    """Code prefixes of 2 to 8 digits, typed with or without the dot, and description words"""
+    rng = random.Random(seed)
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.6:
+            digits = rng.choice(codes).replace('.', '')
+            yield digits[:rng.randint(2, 8)]
+        elif roll < 0.8:
+            yield rng.choice(codes)[:rng.randint(5, 9)]
+        else:
+            yield ' '.join(word[:rng.randint(3, len(word))] for word in rng.sample(HS_CODE_WORDS, rng.randint(1, 2)))
+
+
+def timed(func, args):
+    timings = []
+    for arg in args:
+        started = time.perf_counter()
+        func(arg)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hs-codes', type=int, default=20000)
+    parser.add_argument('--lookups', type=int, default=5000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='refdata-')
+    # app.py opens invoices.db in the working directory; keep it out of the way
+    os.chdir(workdir)
+    os.environ.setdefault('FBR_OUTBOX', '0')
+    os.environ.setdefault('FBR_PDF_PRERENDER', '0')
+    os.environ.setdefault('FBR_PDF_DIR', os.path.join(workdir, 'pdfs'))
+    os.environ.setdefault('FBR_LOG_LEVEL', 'WARNING')
+    try:
+        import app as flask_app
+        import payloads
+        import refdata
+        import storage
+        import validation
+
+        lists = reference_lists(args.hs_codes)
+        started = time.perf_counter()
+        loaded = refdata.load('hs_codes', lists[b'itemdesccode'], 'bench')
+        refdata.load('uoms', lists[b'uom'], 'bench')
+        print(f"{loaded} HS codes loaded in {time.perf_counter() - started:.2f}s")
+
+        codes = [row['hS_CODE'] for row in lists[b'itemdesccode']]
+        lookups = list(queries(codes, args.lookups))
+        conn = storage.get_connection()
+        client = flask_app.app.test_client()
+
+        def lookup_over_http(query):
+            assert client.get('/ref/hs_codes', query_string={'q': query}).status_code == 200
+
+        form = {
+            'invoiceDate': '2025-01-15', 'sellerNTNCNIC': '1234567', 'sellerBusinessName': 'Seller',
+            'sellerProvince': 'Punjab', 'sellerAddress': 'Lahore', 'buyerNTNCNIC': '7654321',
+            'buyerBusinessName': 'Buyer', 'buyerProvince': 'Sindh', 'buyerAddress': 'Karachi',
+            'buyerType': 'Registered',
+        }
+        for index, code in enumerate(random.Random(3).sample(codes, 3)):
+            form.update({
+                f'item_{index}_hsCode': code, f'item_{index}_productDescription': 'Goods',
+                f'item_{index}_rate': '18%', f'item_{index}_uoM': 'KG', f'item_{index}_quantity': '1',
+                f'item_{index}_valueSalesExcludingST': '1000', f'item_{index}_salesTaxApplicable': '180',
+            })
+        payload = payloads.build('SN001', form)
+        assert not validation.validate('SN001', payload), validation.validate('SN001', payload)
+
+        print(f"{'':<22} {'ms mean/p50/p95':>24}")
+        for name, func, func_args in (
+            ('refdata.search', lambda query: refdata.search(conn, 'hs_codes', query), lookups),
+            ('GET /ref/hs_codes', lookup_over_http, lookups),
+            ('validate (3 items)', lambda _: validation.validate('SN001', payload), range(args.lookups)),
+        ):
+            print(f"{name:<22} {'%.3f / %.3f / %.3f' % summary_ms(timed(func, func_args)):>24}", flush=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""Benchmark suite: submit, view and download invoices against a stand-in FBR.
+
+Starts the mock FBR API (bench/mock_fbr.py) and the app on a fresh database,
+then runs each phase at a fixed concurrency:
+
+- submit: ``POST /submit/SN001`` (JSON)
+- view: ``GET /invoice/<id>`` for the invoices submitted
+- view (repeat): the same pages again
+- pdf: ``GET /invoice/<id>/pdf``, rendering each PDF for the first time
+- pdf (cached): the same downloads again
+
+For each phase it reports throughput and p50/p95/p99 latency, and how the time
+went: per stage (payload build, validation, FBR call, DB insert and read, QR
+encode, template render, PDF render), the milliseconds spent per request and
+as a share of the mean latency. Stage timings are read from the app's own
+``/metrics`` before and after each phase, so p95 is estimated from the
+histogram buckets. Stages can contain others (pdf_render includes qr_encode
+and render), so the shares need not add up to 100%.
+
+    python bench/suite.py --requests 1000 --concurrency 50 --latency 0.2
+    python bench/suite.py --server asgi --error-rate 0.05 --rate-limit 200 --json results.json
+
+``--json`` saves the numbers, to compare before and after a change. Needs
+aiohttp (and uvicorn for ``--server asgi``).
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from load_test import free_port, percentile, server_env, start_server, stop_server, wait_until_up  # noqa: E402
+from payload_build import sample_row, as_items_array  # noqa: E402
+
+SERVERS = {
+    'flask': [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', '{port}'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:app', '--port', '{port}',
+             '--log-level', 'warning', '--no-access-log'],
+}
+
+STAGE_ORDER = ('payload_build', 'validate', 'outbox_enqueue', 'outbox_wait', 'fbr_call', 'db_insert', 'db_read',
+               'qr_encode', 'render', 'pdf_render')
+STAGE_SAMPLE = re.compile(r'fbr_stage_seconds_(bucket|sum|count)\{stage="([^"]+)"(?:,le="([^"]+)")?\} (\S+)')
+
+
+async def drive(session, base_url, requests, concurrency, ok):
+    """Send (method, path, json_body) requests, ``concurrency`` at a time.
+
+    Returns (seconds, sorted latencies, failures, bodies of the successful responses).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, bodies, failures = [], [], 0
+
+    async def one(method, path, body):
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                async with session.request(method, base_url + path, json=body,
+                                           headers={'Accept': 'application/json'}) as response:
+                    content = await response.read()
+                    succeeded = ok(response.status, content)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                succeeded = False
+            latencies.append(time.perf_counter() - started)
+            if succeeded:
+                bodies.append(content)
+            else:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(*request) for request in requests))
+    return time.perf_counter() - started, sorted(latencies), failures, bodies
+
+def submitted(status, content):
+    return status == 200 and json.loads(content).get('success')
+
+def downloaded(status, content):
+    return status == 200
+
+async def stage_histograms(session, base_url):
+    """{stage: {'buckets': {le: cumulative count}, 'sum': seconds, 'count': n}} from /metrics"""
+    async with session.get(base_url + '/metrics') as response:
+        text = await response.text()
+    histograms = {}
+    for kind, stage, bound, value in STAGE_SAMPLE.findall(text):
+        histogram = histograms.setdefault(stage, {'buckets': {}, 'sum': 0.0, 'count': 0})
+        if kind == 'bucket':
+            histogram['buckets'][float(bound)] = float(value)
+        else:
+            histogram[kind] = float(value)
+    return histograms
+
+def stage_summary(before, after):
+    """Per-stage count, total and mean, and p95 estimated from the buckets, for what happened in between"""
+    stages = {}
+    for stage, histogram in after.items():
+        earlier = before.get(stage, {'buckets': {}, 'sum': 0.0, 'count': 0})
+        count = histogram['count'] - earlier['count']
+        if not count:
+            continue
+        total = histogram['sum'] - earlier['sum']
+        buckets = sorted((bound, cumulative - earlier['buckets'].get(bound, 0))
+                         for bound, cumulative in histogram['buckets'].items())
+        stages[stage] = {
+            'count': int(count),
+            'total_seconds': total,
+            'mean_ms': total / count * 1000,
+            'p95_ms': bucket_percentile(buckets, count, 0.95) * 1000,
+        }
+    return stages
+
+def bucket_percentile(buckets, count, fraction):
+    """Interpolated within the bucket holding the percentile, as Prometheus' histogram_quantile does"""
+    wanted, lower, below = count * fraction, 0.0, 0
+    for bound, cumulative in buckets:
+        if cumulative >= wanted:
+            if bound == float('inf'):
+                return lower
+            return lower + (bound - lower) * (wanted - below) / ((cumulative - below) or 1)
+        lower, below = bound, cumulative
+    return lower
+
+async def fbr_stats(session, fbr_url):
+    async with session.get(fbr_url + 'stats') as response:
+        return await response.json()
+
+async def run_phase(session, base_url, name, requests, concurrency, ok):
+    before = await stage_histograms(session, base_url)
+    seconds, latencies, failures, bodies = await drive(session, base_url, requests, concurrency, ok)
+    # Give background work started by the phase (PDF renders, DB writes) a moment to be counted
+    await asyncio.sleep(0.5)
+    phase = {
+        'name': name,
+        'requests': len(requests),
+        'failed': failures,
+        'seconds': seconds,
+        'throughput': len(requests) / seconds if seconds else 0.0,
+        'mean_ms': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'stages': stage_summary(before, await stage_histograms(session, base_url)),
+    }
+    return phase, bodies
+
+async def run(args):
+    fbr_port = free_port()
+    fbr = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'mock_fbr.py'), '--port', str(fbr_port),
+                            '--latency', str(args.latency), '--jitter', str(args.jitter),
+                            '--error-rate', str(args.error_rate), '--reject-rate', str(args.reject_rate),
+                            '--rate-limit', str(args.rate_limit), '--seed', '1'], stdout=subprocess.DEVNULL)
+    fbr_url = f'http://127.0.0.1:{fbr_port}/'
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            port = free_port()
+            with open(os.path.join(workdir, 'server.log'), 'w+') as log:
+                process = start_server(SERVERS[args.server], port, workdir, log,
+                                       server_env(args.outbox, args.concurrency,
+                                                  FBR_PDF_DIR=os.path.join(workdir, 'pdfs')))
+                try:
+                    return await run_phases(f'http://127.0.0.1:{port}', fbr_url, process, log, args)
+                finally:
+                    stop_server(process)
+    finally:
+        fbr.terminate()
+
+async def run_phases(base_url, fbr_url, process, log, args):
+    await wait_until_up(base_url + '/', process, log)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=300)) as session:
+        def submissions(count, offset=0):
+            return [('POST', '/submit/SN001', dict(as_items_array(sample_row(offset + number, args.items)),
+                                                   api_url=fbr_url, bearer_token='benchmark'))
+                    for number in range(count)]
+
+        # Warm up imports, pools and template caches; not reported
+        await drive(session, base_url, submissions(min(20, args.requests), offset=args.requests),
+                    min(10, args.concurrency), submitted)
+
+        phases = []
+        fbr_before = await fbr_stats(session, fbr_url)
+        phase, bodies = await run_phase(session, base_url, 'submit', submissions(args.requests),
+                                        args.concurrency, submitted)
+        phases.append(phase)
+        fbr_after = await fbr_stats(session, fbr_url)
+        phase['fbr'] = {name: fbr_after[name] - fbr_before[name] for name in fbr_after}
+
+        invoice_numbers = [json.loads(body)['invoice_number'] for body in bodies]
+        if not invoice_numbers:
+            raise RuntimeError('No invoices were accepted, so there is nothing to view or download')
+        views = [('GET', f'/invoice/{invoice_numbers[n % len(invoice_numbers)]}', None) for n in range(args.requests)]
+        for name in ('view', 'view (repeat)'):
+            phases.append((await run_phase(session, base_url, name, views, args.concurrency, downloaded))[0])
+
+        downloads = [('GET', f'/invoice/{number}/pdf', None) for number in invoice_numbers[:args.pdf_requests]]
+        for name in ('pdf', 'pdf (cached)'):
+            phases.append((await run_phase(session, base_url, name, downloads,
+                                           min(args.concurrency, args.pdf_concurrency), downloaded))[0])
+        return phases
+
+def report(phases, args):
+    print(f"server {args.server}, {args.requests} requests, {args.concurrency} concurrent, "
+          f"mock FBR {args.latency * 1000:.0f} ms (+/- {args.jitter * 1000:.0f}), "
+          f"{args.error_rate:.0%} errors, {args.reject_rate:.0%} rejected, "
+          f"rate limit {args.rate_limit or 'none'}, outbox {'on' if args.outbox else 'off'}")
+    print()
+    print(f"  {'phase':<14}{'requests':>9}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'failed':>8}")
+    for phase in phases:
+        print(f"  {phase['name']:<14}{phase['requests']:>9}{phase['throughput']:>9.1f}{phase['p50_ms']:>9.1f}"
+              f"{phase['p95_ms']:>9.1f}{phase['p99_ms']:>9.1f}{phase['failed']:>8}")
+    if 'fbr' in phases[0]:
+        fbr = phases[0]['fbr']
+        print(f"\n  mock FBR: {fbr['requests']} requests, {fbr['accepted']} accepted, {fbr['rejected']} rejected, "
+              f"{fbr['errors']} errors, {fbr['rate_limited']} rate limited")
+
+    for phase in phases:
+        print(f"\n  {phase['name']}: time per request by stage (mean latency {phase['mean_ms']:.1f} ms)")
+        print(f"    {'stage':<18}{'calls':>7}{'mean ms':>10}{'p95 ms':>10}{'ms/req':>10}{'share':>8}")
+        for stage in sorted(phase['stages'], key=lambda s: STAGE_ORDER.index(s) if s in STAGE_ORDER else len(STAGE_ORDER)):
+            numbers = phase['stages'][stage]
+            per_request = numbers['total_seconds'] / phase['requests'] * 1000
+            share = per_request / phase['mean_ms'] if phase['mean_ms'] else 0.0
+            print(f"    {stage:<18}{numbers['count']:>7}{numbers['mean_ms']:>10.2f}{numbers['p95_ms']:>10.2f}"
+                  f"{per_request:>10.2f}{share:>8.0%}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=sorted(SERVERS), default='flask')
+    parser.add_argument('--requests', type=int, default=1000, help='Submissions, and invoice views')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--items', type=int, default=3, help='Line items per invoice')
+    parser.add_argument('--pdf-requests', type=int, default=50, help='PDFs downloaded')
+    parser.add_argument('--pdf-concurrency', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.2, help='Mock FBR response time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Mock FBR latency varies by up to this much')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of FBR requests answered 500')
+    parser.add_argument('--reject-rate', type=float, default=0.0, help='Fraction of invoices FBR refuses')
+    parser.add_argument('--rate-limit', type=float, default=0, help='FBR requests per second before 429s')
+    parser.add_argument('--outbox', action='store_true', help='Send through the outbox (FBR_OUTBOX=1)')
+    parser.add_argument('--json', metavar='FILE', help='Also save the results as JSON')
+    args = parser.parse_args()
+
+    phases = asyncio.run(run(args))
+    report(phases, args)
+    if args.json:
+        with open(args.json, 'w') as results:
+            json.dump({'settings': vars(args), 'phases': phases}, results, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Microbenchmark: local validation throughput.
+
+Builds payloads for a mix of valid and invalid invoices once, then measures
+how many ``validation.validate`` can check per second.
+
+    python bench/validation.py [--invoices 20000] [--items 3]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import payloads  # noqa: E402
+import validation  # noqa: E402
+from payload_build import sample_row  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--invoices', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=3, help='Items per invoice')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    invoices = []
+    for number in range(args.invoices):
+        row = sample_row(number, args.items)
+        if number % 10 == 0:
+            row['item_0_salesTaxApplicable'] = '100'   # does not match value x rate
+        invoices.append(payloads.build('SN001', row))
+    assert not validation.validate('SN001', invoices[1])
+    assert validation.validate('SN001', invoices[0])
+
+    best = float('inf')
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        invalid = sum(1 for payload in invoices if validation.validate('SN001', payload))
+        best = min(best, time.perf_counter() - start)
+    print(f"{args.invoices} invoices x {args.items} items, best of {args.repeat}")
+    print(f"  {best / args.invoices * 1e6:8.2f} us/invoice, {args.invoices / best:,.0f} invoices/s ({invalid} invalid)")
+
+if __name__ == '__main__':
+    main()
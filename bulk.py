@@ -0,0 +1,197 @@
+"""Bulk invoice submission.
+
+Reads a CSV or JSON-lines file of invoices (one invoice per row/line, using the
+same field names as the HTML form, e.g. ``buyerType`` or ``item_0_hsCode``) and
+posts them to FBR through a bounded worker pool.
+"""
+import csv
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+import fbr_client
+
+DEFAULT_WORKERS = 8
+MAX_WORKERS = 64
+DEFAULT_RETRIES = 3
+BACKOFF_SECONDS = 1.0
+
+
+# ---------------- READING INVOICE FILES -----------------
+def read_invoices(stream, filename):
+    """Yield one record per invoice from an open CSV or JSON-lines file.
+
+    Each record is ``{'row': n, 'scenario_id': ..., 'form_data': {...}}``. Empty
+    CSV cells are dropped so the payload builders fall back to their defaults
+    and unused ``item_<n>_*`` columns don't create empty items.
+    """
+    if filename.lower().endswith(('.jsonl', '.ndjson', '.json')):
+        rows = _read_jsonl(stream)
+    else:
+        rows = _read_csv(stream)
+
+    for row_number, form_data in rows:
+        scenario_id = form_data.pop('scenario_id', None) or form_data.get('scenarioId')
+        yield {'row': row_number, 'scenario_id': scenario_id, 'form_data': form_data}
+
+def _read_csv(stream):
+    reader = csv.DictReader(stream)
+    # Row 1 is the header
+    for row_number, row in enumerate(reader, start=2):
+        yield row_number, {key: value for key, value in row.items() if key and value not in (None, '')}
+
+def _read_jsonl(stream):
+    for row_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            form_data = json.loads(line)
+        except ValueError as e:
+            form_data = {'_error': f'Invalid JSON: {e}'}
+        if not isinstance(form_data, dict):
+            form_data = {'_error': 'Each line must be a JSON object'}
+        yield row_number, form_data
+
+
+# ---------------- CONCURRENT SUBMISSION -----------------
+def submit_batch(records, build_payload, post_invoice, workers=DEFAULT_WORKERS,
+                 retries=DEFAULT_RETRIES, backoff=BACKOFF_SECONDS, validate=None, find_duplicate=None):
+    """Submit records concurrently and yield one status dict per invoice as it finishes.
+
+    ``build_payload(scenario_id, form_data)`` builds the FBR payload and
+    ``post_invoice(scenario_id, payload)`` sends it, returning the same result
+    dict the submit route renders. At most ``workers * 2`` invoices are held in
+    memory at a time, so arbitrarily large files can be streamed through.
+
+    ``validate(scenario_id, payload)``, when given, returns a list of errors;
+    invoices with any are reported as ``invalid`` and never sent.
+
+    ``find_duplicate(scenario_id, payload)``, when given, returns the number of
+    an invoice FBR already issued for the same payload; such invoices are
+    reported as ``duplicate`` with that number and not sent again.
+    """
+    workers = max(1, workers)
+    seq = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bulk') as pool:
+        pending = set()
+        for record in records:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    seq += 1
+                    yield dict(future.result(), seq=seq)
+            pending.add(pool.submit(_submit_one, record, build_payload, post_invoice, retries, backoff, validate,
+                                    find_duplicate))
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                seq += 1
+                yield dict(future.result(), seq=seq)
+
+def _submit_one(record, build_payload, post_invoice, retries, backoff, validate=None, find_duplicate=None):
+    status = {
+        'row': record['row'],
+        'scenario_id': record['scenario_id'],
+        'status': 'failed',
+        'invoice_number': None,
+        'status_code': None,
+        'attempts': 0,
+        'error': None,
+    }
+    form_data = record['form_data']
+
+    if '_error' in form_data:
+        status['error'] = form_data['_error']
+        return status
+    if not record['scenario_id']:
+        status['error'] = 'Missing scenario_id'
+        return status
+
+    try:
+        payload = build_payload(record['scenario_id'], form_data)
+    except Exception as e:
+        status['error'] = f'Could not build payload: {e}'
+        return status
+
+    if validate is not None:
+        errors = validate(record['scenario_id'], payload)
+        if errors:
+            status.update(status='invalid', errors=errors, error='; '.join(
+                f"{error['field']}: {error['message']}" for error in errors))
+            return status
+
+    if find_duplicate is not None:
+        invoice_number = find_duplicate(record['scenario_id'], payload)
+        if invoice_number:
+            status.update(status='duplicate', invoice_number=invoice_number,
+                          error=f'Already issued as {invoice_number}')
+            return status
+
+    for attempt in range(retries + 1):
+        status['attempts'] = attempt + 1
+        try:
+            result = post_invoice(record['scenario_id'], payload)
+        except requests.exceptions.RequestException as e:
+            # fbr_client has already retried whatever was safe to resend
+            status['error'] = str(e)
+            return status
+        except Exception as e:
+            status['error'] = f'Application error: {e}'
+            return status
+        else:
+            status['status_code'] = result['status_code']
+            if result.get('duplicate'):
+                status.update(status='duplicate', invoice_number=result['invoice_number'],
+                              error=f"Already issued as {result['invoice_number']}")
+                return status
+            if result['success']:
+                status.update(status='submitted', invoice_number=result['invoice_number'], error=None)
+                return status
+            status['error'] = _error_message(result)
+            # "Not processed, try later": fbr_client already retried these briefly,
+            # the batch retries them again with a longer backoff
+            if result['status_code'] not in fbr_client.RETRY_ALWAYS_STATUS:
+                status['status'] = 'rejected'
+                return status
+
+        if attempt < retries:
+            time.sleep(backoff * (2 ** attempt))
+
+    return status
+
+def _error_message(result):
+    response_data = result.get('response_data')
+    if isinstance(response_data, dict):
+        validation = response_data.get('validationResponse')
+        if isinstance(validation, dict) and validation.get('error'):
+            return validation['error']
+        return response_data.get('errorMessage') or response_data.get('error') or json.dumps(response_data)
+    return str(response_data)
+
+
+# ---------------- REPORTING -----------------
+def with_summary(results):
+    """Pass results through and finish with a ``{'summary': {...}}`` line"""
+    started = time.monotonic()
+    counts = {'submitted': 0, 'duplicate': 0, 'invalid': 0, 'rejected': 0, 'failed': 0}
+    for result in results:
+        counts[result['status']] += 1
+        yield result
+
+    elapsed = time.monotonic() - started
+    total = sum(counts.values())
+    yield {'summary': dict(
+        counts,
+        total=total,
+        elapsed_seconds=round(elapsed, 3),
+        invoices_per_second=round(total / elapsed, 2) if elapsed else None,
+    )}
+
+def format_summary(summary):
+    return (f"{summary['total']} invoices in {summary['elapsed_seconds']}s: "
+            f"{summary['submitted']} submitted, {summary['duplicate']} already issued, {summary['invalid']} invalid, "
+            f"{summary['rejected']} rejected, {summary['failed']} failed")
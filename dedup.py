@@ -0,0 +1,182 @@
+"""Duplicate submission detection.
+
+FBR has no idempotency support, so sending the same invoice twice (a
+double-clicked submit button, a bulk file run again after a failure) issues
+two invoice numbers for one sale. Every payload therefore gets a canonical
+hash: keys in sorted order, blank fields dropped, whitespace collapsed and
+amounts formatted one way, so ``100``, ``100.0`` and ``"100.00"`` hash the
+same. The hash is stored with each saved invoice under a unique index, and
+with each archived one in ``archived_invoices``, and submissions look it up
+before anything is sent.
+
+The hashes of recently issued invoices are also kept in a per-process LRU
+cache, so repeats of recent invoices are answered without a query, and a
+payload being sent is marked in flight, so a second request for it waits for
+the first one's answer instead of sending it again.
+
+    FBR_DEDUP_CACHE_SIZE   issued payload hashes remembered per process (default 100000)
+"""
+import hashlib
+import json
+import math
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from decimal import Decimal, InvalidOperation
+
+import payload_codec
+import payloads
+
+CACHE_SIZE = int(os.environ.get('FBR_DEDUP_CACHE_SIZE', 100000))
+BACKFILL_BATCH_SIZE = 1000
+
+# Item fields compared as amounts rather than text
+NUMERIC_KEYS = frozenset(key for key, kind, _ in payloads.ITEM_FIELDS if kind != 'text')
+# Decimal places kept: finer than any quantity or amount, coarser than float noise
+_PLACES = Decimal('0.000001')
+
+
+# ---------------- HASHING -----------------
+def payload_hash(payload):
+    """Hex SHA-256 of the canonical form of a payload"""
+    canonical = json.dumps(_canonical(payload), sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+def _canonical(value, key=None):
+    if isinstance(value, dict):
+        # A field left blank and a field left out are the same invoice
+        return {str(name): _canonical(item, name) for name, item in value.items() if item not in (None, '')}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if key in NUMERIC_KEYS and not isinstance(value, bool):
+        number = _amount(value)
+        if number is not None:
+            return number
+    if isinstance(value, str):
+        return ' '.join(value.split())
+    return value
+
+def _amount(value):
+    """An amount as a plain decimal string without trailing zeros, or None if it isn't one"""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    try:
+        number = Decimal(str(value).strip()).quantize(_PLACES)
+    except (InvalidOperation, ValueError):
+        return None
+    return format(number.normalize(), 'f') if number else '0'
+
+
+# ---------------- LOOKUPS -----------------
+class RecentHashes:
+    """Thread-safe LRU map of payload hash -> invoice number, bounded by entry count"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+_issued = RecentHashes(CACHE_SIZE)
+_in_flight = {}   # payload hash -> Future of the result of the request sending it
+_in_flight_lock = threading.Lock()
+
+def issued_invoice(conn, digest):
+    """Number of the invoice FBR already issued for a payload hash, or None"""
+    invoice_number = _issued.get(digest)
+    if invoice_number is None:
+        row = conn.execute("SELECT invoice_number FROM invoices WHERE payload_hash = ?", (digest,)).fetchone()
+        if row is None:
+            # Moved out to an archive file (see archive.py)
+            row = conn.execute(
+                "SELECT invoice_number FROM archived_invoices WHERE payload_hash = ? LIMIT 1", (digest,)
+            ).fetchone()
+        if row is not None:
+            invoice_number = row["invoice_number"]
+            _issued.put(digest, invoice_number)
+    return invoice_number
+
+def remember(digest, invoice_number):
+    """Note an invoice issued for a payload hash, once it is saved"""
+    _issued.put(digest, invoice_number)
+
+def send_once(digest, send):
+    """``(send(), False)``, or ``(result, True)`` with the result of the request already sending the same payload.
+
+    Only requests in this process are seen; the stored hashes catch the rest.
+    """
+    with _in_flight_lock:
+        future = _in_flight.get(digest)
+        sending = future is None
+        if sending:
+            future = _in_flight[digest] = Future()
+    if not sending:
+        return future.result(), True
+    try:
+        result = send()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result, False
+    finally:
+        with _in_flight_lock:
+            _in_flight.pop(digest, None)
+
+def duplicate_result(payload, invoice_number):
+    """The submit route's result for a payload FBR already issued an invoice for"""
+    return {
+        'success': True,
+        'duplicate': True,
+        'status_code': None,
+        'invoice_number': invoice_number,
+        'qr_code': f'/qr/{invoice_number}',
+        'request_payload': payload,
+        'response_data': None,
+    }
+
+
+# ---------------- STORED HASHES -----------------
+def backfill(conn, batch_size=BACKFILL_BATCH_SIZE):
+    """Hash the payloads of invoices saved before hashes were stored, a batch at a time.
+
+    Of invoices already saved twice, only the first keeps its hash.
+    """
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, payload FROM invoices WHERE payload_hash IS NULL AND id > ? ORDER BY id LIMIT ?",
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            return
+        updates = []
+        for row in rows:
+            try:
+                payload = payload_codec.decode(row["payload"], conn)
+            except (TypeError, ValueError):
+                continue
+            updates.append((payload_hash(payload), row["id"]))
+        conn.executemany("UPDATE OR IGNORE invoices SET payload_hash = ? WHERE id = ?", updates)
+        last_id = rows[-1]["id"]
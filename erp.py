@@ -0,0 +1,247 @@
+"""Streaming import of ERP sales exports.
+
+An ERP export has one row per invoice line, as CSV or XLSX. Rows are read one
+at a time and consecutive rows with the same key (e.g. the ERP's document
+number) are grouped into one invoice, so only the invoice being read is held in
+memory, however large the file. Lines of an invoice must be next to each other,
+as they are in exports sorted by document; a key that comes back later is
+reported as an error rather than sent twice.
+
+A JSON column mapping says which column holds which field:
+
+    {
+        "key": ["Doc No"],
+        "scenario": "SN001",
+        "header": {"invoiceDate": "Doc Date", "buyerNTNCNIC": "Customer NTN"},
+        "items": {"hsCode": "HS Code", "quantity": "Qty", "valueSalesExcludingST": "Net"},
+        "defaults": {"sellerNTNCNIC": "1234567", "sellerProvince": "Punjab"},
+        "date_format": "%d/%m/%Y"
+    }
+
+Header fields use the invoice form's names (``buyerType``, ``invoiceDate``, ...)
+and are read from the first line of each invoice; item fields use the payload
+item names (``hsCode``, ``quantity``, ...). Columns named exactly like a field
+need no mapping. ``scenario_column`` may name a column holding the scenario
+instead of a fixed ``scenario``. Without a ``key`` every row is an invoice.
+
+Invoices are yielded as bulk.read_invoices() records, their lines as an
+``items`` list, so they go through the same payload builders, validation and
+bulk submission as invoices from the form.
+"""
+import csv
+import json
+from datetime import date, datetime
+
+import payloads
+import validation
+
+HEADER_KEYS = tuple(form_key for _, form_key, _ in payloads.HEADER_FIELDS)
+ITEM_KEYS = tuple(key for key, _, _ in payloads.ITEM_FIELDS)
+# Extensions read as Excel workbooks; anything else is read as CSV
+XLSX_EXTENSIONS = ('.xlsx', '.xlsm')
+
+
+# ---------------- COLUMN MAPPING -----------------
+class ColumnMapping:
+    """Which export column holds each invoice field"""
+
+    def __init__(self, key=(), header=None, items=None, scenario=None, scenario_column=None,
+                 defaults=None, date_format=None):
+        self.key = [key] if isinstance(key, str) else list(key)
+        self.header = dict(header or {})
+        self.items = dict(items or {})
+        self.scenario = scenario
+        self.scenario_column = scenario_column
+        self.defaults = dict(defaults or {})
+        self.date_format = date_format
+
+        unknown = sorted(set(self.header) - set(HEADER_KEYS)) + sorted(set(self.items) - set(ITEM_KEYS))
+        if unknown:
+            raise ValueError(f"Unknown invoice fields in mapping: {', '.join(unknown)}")
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as mapping_file:
+            data = json.load(mapping_file)
+        if not isinstance(data, dict):
+            raise ValueError('The column mapping must be a JSON object')
+        try:
+            return cls(**data)
+        except TypeError as e:
+            raise ValueError(f'Invalid column mapping: {e}')
+
+    def bind(self, columns):
+        """Resolve column names to positions in the header row ``columns``"""
+        positions = {}
+        for position, name in enumerate(columns):
+            name = _cell(name)
+            if name:
+                positions.setdefault(name, position)
+
+        missing = []
+
+        def position_of(column):
+            if column not in positions:
+                missing.append(column)
+            return positions.get(column)
+
+        def fields(mapped, names):
+            # Mapped fields, plus any field with a column of its own name
+            return [(field, position_of(mapped[field])) if field in mapped else (field, positions[field])
+                    for field in names if field in mapped or field in positions]
+
+        plan = _Plan(
+            key=[position_of(column) for column in self.key],
+            header=fields(self.header, HEADER_KEYS),
+            items=fields(self.items, ITEM_KEYS),
+            scenario=self.scenario,
+            scenario_position=position_of(self.scenario_column) if self.scenario_column else positions.get('scenario_id'),
+            defaults=self.defaults,
+            date_format=self.date_format,
+        )
+        if missing:
+            raise ValueError(f"Columns not found in the export: {', '.join(missing)}")
+        if plan.scenario is None and plan.scenario_position is None:
+            raise ValueError('The mapping needs a scenario, or a scenario_column (or a scenario_id column)')
+        return plan
+
+
+class _Plan:
+    """A mapping bound to one file's columns: turns rows into invoice fields by position"""
+
+    def __init__(self, key, header, items, scenario, scenario_position, defaults, date_format):
+        self.key = key
+        self.header = header
+        self.items = items
+        self.scenario = scenario
+        self.scenario_position = scenario_position
+        self.defaults = defaults
+        self.date_format = date_format
+
+    def invoice_key(self, values):
+        return tuple(_cell(_at(values, position)) for position in self.key)
+
+    def start_invoice(self, row_number, values):
+        form_data = dict(self.defaults)
+        for field, position in self.header:
+            value = _cell(_at(values, position))
+            if value:
+                form_data[field] = value
+        if self.date_format and 'invoiceDate' in form_data:
+            try:
+                form_data['invoiceDate'] = datetime.strptime(form_data['invoiceDate'], self.date_format).strftime('%Y-%m-%d')
+            except ValueError:
+                pass   # Left as it is for validation to report
+        form_data['items'] = []
+        scenario_id = self.scenario
+        if self.scenario_position is not None:
+            scenario_id = _cell(_at(values, self.scenario_position)) or scenario_id
+        return {'row': row_number, 'scenario_id': scenario_id, 'form_data': form_data}
+
+    def item(self, values):
+        item = {}
+        for field, position in self.items:
+            value = _cell(_at(values, position))
+            if value:
+                item[field] = value
+        return item
+
+
+# ---------------- READING EXPORTS -----------------
+def read_rows(path, sheet=None, delimiter=','):
+    """Yield ``(row number, values)`` for every row of a CSV or XLSX file, header row first"""
+    if path.lower().endswith(XLSX_EXTENSIONS):
+        return _read_xlsx(path, sheet)
+    return _read_csv(path, delimiter)
+
+def read_invoices(rows, mapping):
+    """Group rows from read_rows() into invoices, yielding one bulk record per invoice"""
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return
+    plan = mapping.bind(header[1])
+
+    record = current_key = None
+    # Hashes of the keys already read, to catch an invoice whose lines are split up
+    seen = set()
+    for row_number, values in rows:
+        if not any(_cell(value) for value in values):
+            continue
+        key = plan.invoice_key(values) if plan.key else row_number
+        if record is None or key != current_key:
+            if record is not None:
+                yield record
+            record, current_key = plan.start_invoice(row_number, values), key
+            if plan.key and not any(key):
+                record['form_data']['_error'] = 'Missing invoice key'
+            elif hash(key) in seen:
+                record['form_data']['_error'] = (f"Lines of invoice {' / '.join(map(str, key))} are not together "
+                                                 f"in the export")
+            seen.add(hash(key))
+        record['form_data']['items'].append(plan.item(values))
+    if record is not None:
+        yield record
+
+def check(records, build_payload, validate=validation.validate):
+    """Yield ``(record, errors)`` per invoice: what stops it being submitted, an empty list if nothing"""
+    for record in records:
+        form_data = record['form_data']
+        if '_error' in form_data:
+            yield record, [form_data['_error']]
+            continue
+        if not record['scenario_id']:
+            yield record, ['Missing scenario_id']
+            continue
+        try:
+            payload = build_payload(record['scenario_id'], form_data)
+        except Exception as e:
+            yield record, [f'Could not build payload: {e}']
+            continue
+        errors = validate(record['scenario_id'], payload) if validate is not None else []
+        yield record, [f"{error['field']}: {error['message']}" for error in errors]
+
+def as_json_line(record):
+    """A record as a line bulk-submit reads back"""
+    return json.dumps(dict(record['form_data'], scenario_id=record['scenario_id']), default=str)
+
+
+def check_xlsx_support():
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        raise RuntimeError('Reading XLSX exports needs the openpyxl package (pip install openpyxl); '
+                           'or export the sheet as CSV')
+
+def _read_csv(path, delimiter):
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        yield from enumerate(csv.reader(stream, delimiter=delimiter), start=1)
+
+def _read_xlsx(path, sheet):
+    check_xlsx_support()
+    from openpyxl import load_workbook
+
+    # Read-only mode parses the sheet as it is iterated instead of loading the workbook
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if sheet else workbook.active
+        yield from enumerate(worksheet.iter_rows(values_only=True), start=1)
+    finally:
+        workbook.close()
+
+def _at(values, position):
+    # Short CSV rows and trailing empty XLSX cells leave positions missing
+    return values[position] if position < len(values) else None
+
+def _cell(value):
+    """A cell as the text the form would have sent"""
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, (datetime, date)):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, float) and value.is_integer():
+        # Excel stores every number as a float: NTNs and codes must not gain a ".0"
+        return str(int(value))
+    return str(value)
@@ -0,0 +1,158 @@
+"""Bulk PDF export.
+
+Renders many stored invoices across a process pool and packs them into a
+streamed ZIP or one merged PDF. Invoices are read from the database in batches
+and at most ``workers * 2`` documents are in flight at once, so memory stays
+bounded no matter how many invoices are exported.
+"""
+import io
+import os
+import zipfile
+from collections import deque
+
+import pdfs
+
+EXPORT_WORKERS = int(os.environ.get('FBR_EXPORT_WORKERS', os.cpu_count() or 1))
+SELECT_BATCH_SIZE = 500
+
+
+# ---------------- SELECTING INVOICES -----------------
+def select_invoices(conn, date_from=None, date_to=None, scenario_ids=None, invoice_numbers=None):
+    """Yield invoice rows matching the filters, oldest first, a batch at a time.
+
+    Dates are ``YYYY-MM-DD`` strings compared against the invoice date
+    (inclusive), as in invoices.list_invoices().
+    """
+    conditions, params = [], []
+    if date_from:
+        conditions.append("invoice_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("invoice_date <= ?")
+        params.append(date_to)
+    if scenario_ids:
+        conditions.append(f"scenario_id IN ({','.join('?' * len(scenario_ids))})")
+        params.extend(scenario_ids)
+
+    if invoice_numbers:
+        # Looked up in chunks to stay under SQLite's bound-parameter limit
+        invoice_numbers = list(dict.fromkeys(invoice_numbers))
+        for start in range(0, len(invoice_numbers), SELECT_BATCH_SIZE):
+            chunk = invoice_numbers[start:start + SELECT_BATCH_SIZE]
+            where = conditions + [f"invoice_number IN ({','.join('?' * len(chunk))})"]
+            yield from conn.execute(
+                f"SELECT * FROM invoices WHERE {' AND '.join(where)} ORDER BY id", params + chunk
+            )
+        return
+
+    # Keyset pagination on id: no long-lived cursor and no OFFSET rescans
+    last_id = 0
+    while True:
+        where = conditions + ["id > ?"]
+        rows = conn.execute(
+            f"SELECT * FROM invoices WHERE {' AND '.join(where)} ORDER BY id LIMIT ?",
+            params + [last_id, SELECT_BATCH_SIZE],
+        ).fetchall()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1]["id"]
+
+
+# ---------------- RENDERING -----------------
+def render_pdfs(invoices, to_html, cached_path=None, workers=EXPORT_WORKERS):
+    """Yield ``(invoice_number, pdf_bytes, error)`` for each invoice, in input order.
+
+    ``to_html(invoice)`` renders the invoice template for PDF output.
+    ``cached_path(invoice)`` may return the path of an already rendered, up to
+    date PDF, which is read from disk instead of being rendered again.
+    """
+    workers = max(1, workers)
+    with pdfs.make_pool(workers) as pool:
+        window = deque()
+        for invoice in invoices:
+            invoice_number = invoice['invoice_number']
+            path = cached_path(invoice) if cached_path else None
+            if path and os.path.exists(path):
+                with open(path, 'rb') as pdf_file:
+                    window.append((invoice_number, pdf_file.read()))
+            else:
+                window.append((invoice_number, pool.submit(pdfs.render_html, to_html(invoice))))
+
+            if len(window) >= workers * 2:
+                yield _result(*window.popleft())
+
+        while window:
+            yield _result(*window.popleft())
+
+def _result(invoice_number, pdf):
+    if isinstance(pdf, bytes):
+        return invoice_number, pdf, None
+    try:
+        return invoice_number, pdf.result(), None
+    except Exception as e:
+        return invoice_number, None, str(e) or type(e).__name__
+
+
+# ---------------- OUTPUT FORMATS -----------------
+class _ChunkSink(io.RawIOBase):
+    """Write-only, unseekable stream: zipfile falls back to streaming mode and we hand out what it wrote"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def stream_zip(rendered):
+    """Yield the bytes of a ZIP archive holding one PDF per invoice.
+
+    PDFs are already compressed, so entries are stored rather than deflated.
+    Failed renders are recorded as ``<invoice>.error.txt`` entries.
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for invoice_number, pdf, error in rendered:
+            if error is not None:
+                archive.writestr(f'{invoice_number}.error.txt', error)
+            else:
+                archive.writestr(f'Invoice_{invoice_number}.pdf', pdf)
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
+
+def check_merge_support():
+    try:
+        import pypdf  # noqa: F401
+    except ImportError:
+        raise RuntimeError('Merged PDF export needs the pypdf package (pip install pypdf); use the ZIP format instead')
+
+def write_merged_pdf(rendered, target):
+    """Append every rendered PDF into one document written to ``target``.
+
+    Returns the list of ``(invoice_number, error)`` for invoices that failed to
+    render. Pages are held until the merged file is written, so prefer ZIP
+    output for very large exports.
+    """
+    check_merge_support()
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    failed = []
+    for invoice_number, pdf, error in rendered:
+        if error is not None:
+            failed.append((invoice_number, error))
+        else:
+            writer.append(io.BytesIO(pdf))
+    writer.write(target)
+    return failed
@@ -0,0 +1,278 @@
+"""Shared HTTP client for the FBR API.
+
+One keep-alive ``requests.Session`` is kept per API origin (scheme + host), so
+invoices posted to the same ``api_url`` reuse pooled TCP/TLS connections instead
+of handshaking on every request. Settings come from the environment:
+
+    FBR_CONNECT_TIMEOUT   seconds to establish a connection (default 5)
+    FBR_READ_TIMEOUT      seconds to wait for FBR to answer (default 60)
+    FBR_POOL_SIZE         connections kept per host (default 32)
+    FBR_HOST_POOL_SIZES   per-host overrides, e.g. "gw.fbr.gov.pk=64,esp.fbr.gov.pk=8"
+    FBR_MAX_RETRIES       retries after the first attempt (default 3)
+    FBR_BACKOFF_FACTOR    base of the exponential backoff in seconds (default 0.5)
+    FBR_ASYNC_POOL_SIZE   connections kept per host by the asyncio client (default 500)
+
+``AsyncFBRClient`` applies the same timeouts and retry rules from an asyncio
+event loop (used by asgi.py), so one process can have hundreds of requests in
+flight without a thread per request. It needs aiohttp.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError, ConnectTimeoutError
+
+try:
+    import aiohttp
+except ImportError:   # only needed by AsyncFBRClient
+    aiohttp = None
+
+CONNECT_TIMEOUT = float(os.environ.get('FBR_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('FBR_READ_TIMEOUT', 60))
+POOL_SIZE = int(os.environ.get('FBR_POOL_SIZE', 32))
+MAX_RETRIES = int(os.environ.get('FBR_MAX_RETRIES', 3))
+BACKOFF_FACTOR = float(os.environ.get('FBR_BACKOFF_FACTOR', 0.5))
+ASYNC_POOL_SIZE = int(os.environ.get('FBR_ASYNC_POOL_SIZE', 500))
+
+# FBR answered but did not process the request, so even a POST can be resent
+RETRY_ALWAYS_STATUS = {429, 503}
+# The request may or may not have been processed; only resent for idempotent calls
+RETRY_IDEMPOTENT_STATUS = {500, 502, 504}
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _parse_host_pool_sizes(value):
+    sizes = {}
+    for entry in (value or '').split(','):
+        host, _, size = entry.partition('=')
+        if host.strip() and size.strip().isdigit():
+            sizes[host.strip().lower()] = int(size)
+    return sizes
+
+
+class ClientMetrics:
+    """Thread-safe counters and a latency histogram for FBR requests"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+    def observe(self, seconds, error=False):
+        with self._lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+            self.latency_sum += seconds
+            self.latency_counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def retried(self):
+        with self._lock:
+            self.retries += 1
+
+    def snapshot(self):
+        with self._lock:
+            buckets = {str(bound): count for bound, count in zip(LATENCY_BUCKETS, self.latency_counts)}
+            buckets['+Inf'] = self.latency_counts[-1]
+            return {
+                'requests': self.requests,
+                'retries': self.retries,
+                'errors': self.errors,
+                'latency_seconds': {
+                    'sum': round(self.latency_sum, 6),
+                    'count': self.requests,
+                    'buckets': buckets,
+                },
+            }
+
+
+class FBRClient:
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, pool_size=POOL_SIZE,
+                 host_pool_sizes=None, max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR):
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.host_pool_sizes = host_pool_sizes if host_pool_sizes is not None else \
+            _parse_host_pool_sizes(os.environ.get('FBR_HOST_POOL_SIZES'))
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.metrics = ClientMetrics()
+        self._sessions = {}
+        self._adapters = {}
+        self._lock = threading.Lock()
+
+    def session_for(self, url):
+        """Return the pooled session for the origin of ``url``, creating it on first use"""
+        parts = urlsplit(url)
+        origin = f'{parts.scheme}://{parts.netloc}'.lower()
+        session = self._sessions.get(origin)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(origin)
+                if session is None:
+                    size = self.host_pool_sizes.get((parts.hostname or '').lower(), self.pool_size)
+                    # Retries are handled in post() so they can respect idempotency
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size, max_retries=0)
+                    session = requests.Session()
+                    session.mount(origin + '/', adapter)
+                    self._adapters[origin] = adapter
+                    self._sessions[origin] = session
+        return session
+
+    def post(self, url, json=None, headers=None, idempotent=False, timeout=None):
+        """POST to FBR with timeouts and exponential-backoff retries.
+
+        Connection failures where nothing reached FBR, and 429/503 answers, are
+        always retried. Read timeouts, dropped connections and other 5xx answers
+        are only retried when ``idempotent`` is true, because FBR may already
+        have issued an invoice number for the first attempt.
+        """
+        session = self.session_for(url)
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            started = time.perf_counter()
+            try:
+                response = session.post(url, json=json, headers=headers, timeout=timeout or self.timeout)
+            except requests.exceptions.RequestException as e:
+                self.metrics.observe(time.perf_counter() - started, error=True)
+                if last_attempt or not (idempotent or never_sent(e)):
+                    raise
+            else:
+                self.metrics.observe(time.perf_counter() - started, error=response.status_code >= 500)
+                retryable = response.status_code in RETRY_ALWAYS_STATUS or \
+                    (idempotent and response.status_code in RETRY_IDEMPOTENT_STATUS)
+                if last_attempt or not retryable:
+                    return response
+                response.close()
+
+            self.metrics.retried()
+            time.sleep(self.backoff_factor * (2 ** attempt))
+
+    def pool_stats(self):
+        """Connections opened vs requests served per origin, from urllib3's pool counters"""
+        stats = {}
+        with self._lock:
+            adapters = list(self._adapters.items())
+        for origin, adapter in adapters:
+            pools = adapter.poolmanager.pools
+            connections = requests_served = 0
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    requests_served += pool.num_requests
+            stats[origin] = {
+                'pool_size': adapter._pool_maxsize,
+                'handshakes': connections,
+                'requests': requests_served,
+                'pool_hits': max(requests_served - connections, 0),
+            }
+        return stats
+
+    def metrics_snapshot(self):
+        snapshot = self.metrics.snapshot()
+        snapshot['pools'] = self.pool_stats()
+        snapshot['handshakes'] = sum(p['handshakes'] for p in snapshot['pools'].values())
+        snapshot['pool_hits'] = sum(p['pool_hits'] for p in snapshot['pools'].values())
+        return snapshot
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._adapters.clear()
+
+
+class AsyncResponse:
+    """The parts of a requests.Response the app reads, for an answer read by AsyncFBRClient"""
+
+    def __init__(self, status_code, headers, text):
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncFBRClient:
+    """asyncio counterpart of FBRClient: one aiohttp connection pool, created on first use in the event loop"""
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, pool_size=ASYNC_POOL_SIZE,
+                 max_retries=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, metrics=None):
+        if aiohttp is None:
+            raise RuntimeError('The asyncio FBR client needs aiohttp: pip install aiohttp')
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        # Counted with the threaded client's requests by default, so /fbr/metrics covers both
+        self.metrics = metrics if metrics is not None else client.metrics
+        self._session = None
+
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def post(self, url, json=None, headers=None, idempotent=False):
+        """POST to FBR, retrying on the same terms as FBRClient.post. Returns an AsyncResponse."""
+        session = self.session()
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            started = time.perf_counter()
+            try:
+                async with session.post(url, json=json, headers=headers) as response:
+                    answer = AsyncResponse(response.status, dict(response.headers), await response.text())
+            except ASYNC_REQUEST_ERRORS as e:
+                self.metrics.observe(time.perf_counter() - started, error=True)
+                if last_attempt or not (idempotent or async_never_sent(e)):
+                    raise
+            else:
+                self.metrics.observe(time.perf_counter() - started, error=answer.status_code >= 500)
+                retryable = answer.status_code in RETRY_ALWAYS_STATUS or \
+                    (idempotent and answer.status_code in RETRY_IDEMPOTENT_STATUS)
+                if last_attempt or not retryable:
+                    return answer
+
+            self.metrics.retried()
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+def never_sent(error):
+    """True when the request failed before any bytes could reach FBR"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = error.args[0] if error.args else None
+        reason = getattr(reason, 'reason', reason)
+        return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+    return False
+
+
+# What AsyncFBRClient.post raises when FBR can't be reached or doesn't answer in time
+ASYNC_REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError) if aiohttp else ()
+
+def async_never_sent(error):
+    """True when an AsyncFBRClient request failed before any bytes could reach FBR"""
+    return isinstance(error, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError))
+
+
+# Shared by the web routes and bulk submission
+client = FBRClient()
@@ -0,0 +1,46 @@
+"""gunicorn settings for running the app in production.
+
+    gunicorn -c gunicorn.conf.py
+
+The app is loaded and warmed up once in the master process (see wsgi.py), then
+forked into FBR_WEB_WORKERS worker processes (default: one per CPU), each
+serving FBR_WEB_THREADS requests at a time (default 8) on threads, as most of
+a submission is spent waiting on FBR. Each worker then starts its own outbox
+workers and PDF render processes; the CPUs are shared out between the
+workers' render processes unless FBR_PDF_WORKERS is set.
+"""
+import multiprocessing
+import os
+
+# Tells app.py to leave threads and processes to the workers: none may run in
+# the master while it forks
+os.environ['FBR_PRELOAD'] = '1'
+
+cpus = multiprocessing.cpu_count()
+
+wsgi_app = 'wsgi:create_app()'
+preload_app = True
+bind = os.environ.get('FBR_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('FBR_WEB_WORKERS', cpus))
+worker_class = 'gthread'
+threads = int(os.environ.get('FBR_WEB_THREADS', 8))
+# Sends in progress get to finish when a worker is stopped
+graceful_timeout = int(os.environ.get('FBR_GRACEFUL_TIMEOUT', 60))
+accesslog = '-'
+
+os.environ.setdefault('FBR_PDF_WORKERS', str(max(1, cpus // workers)))
+
+
+def post_worker_init(worker):
+    import app
+    import pdfs
+
+    app.start_background_work()
+    if pdfs.PRERENDER:
+        pdfs.start()
+
+
+def worker_exit(server, worker):
+    import pdfs
+
+    pdfs.shutdown()
@@ -0,0 +1,250 @@
+"""Normalised invoice storage.
+
+Besides the raw JSON payload, each saved invoice gets searchable header
+columns on ``invoices`` and one ``invoice_items`` row per line item, so
+lookups by buyer, seller, date, scenario or HS code use indexes instead of
+scanning and parsing every payload. Buyer names and product descriptions are
+also indexed in the ``invoices_fts`` full-text table.
+"""
+import base64
+import json
+import re
+
+import dedup
+import payload_codec
+import reports
+import totals
+
+# (column, payload key) for the header columns on invoices
+HEADER_COLUMNS = (
+    ('invoice_type', 'invoiceType'),
+    ('invoice_date', 'invoiceDate'),
+    ('invoice_ref_no', 'invoiceRefNo'),
+    ('seller_ntn_cnic', 'sellerNTNCNIC'),
+    ('seller_business_name', 'sellerBusinessName'),
+    ('seller_province', 'sellerProvince'),
+    ('buyer_ntn_cnic', 'buyerNTNCNIC'),
+    ('buyer_business_name', 'buyerBusinessName'),
+    ('buyer_province', 'buyerProvince'),
+    ('buyer_registration_type', 'buyerRegistrationType'),
+)
+
+# (column, payload key, numeric) for invoice_items
+ITEM_COLUMNS = (
+    ('hs_code', 'hsCode', False),
+    ('product_description', 'productDescription', False),
+    ('rate', 'rate', False),
+    ('uom', 'uoM', False),
+    ('quantity', 'quantity', True),
+    ('total_values', 'totalValues', True),
+    ('value_sales_excluding_st', 'valueSalesExcludingST', True),
+    ('fixed_notified_value', 'fixedNotifiedValueOrRetailPrice', True),
+    ('sales_tax_applicable', 'salesTaxApplicable', True),
+    ('sales_tax_withheld_at_source', 'salesTaxWithheldAtSource', True),
+    ('extra_tax', 'extraTax', True),
+    ('further_tax', 'furtherTax', True),
+    ('fed_payable', 'fedPayable', True),
+    ('discount', 'discount', True),
+    ('sro_schedule_no', 'sroScheduleNo', False),
+    ('sro_item_serial_no', 'sroItemSerialNo', False),
+    ('sale_type', 'saleType', False),
+)
+
+BACKFILL_BATCH_SIZE = 1000
+LIST_PAGE_SIZE = 50
+LIST_MAX_PAGE_SIZE = 500
+
+# (column, key in totals.invoice_totals()) for the stored invoice totals, in paisa
+TOTAL_COLUMNS = (
+    ('total_value_excl_st', 'value_excl_st'),
+    ('total_sales_tax', 'sales_tax'),
+    ('total_further_tax', 'further_tax'),
+    ('total_discount', 'discount'),
+    ('grand_total', 'grand_total'),
+)
+
+_LIST_COLUMNS = (
+    "id", "invoice_number", "scenario_id", "created_at", "invoice_date", "invoice_ref_no",
+    "buyer_ntn_cnic", "buyer_business_name", "buyer_province", "item_count", "grand_total",
+)
+_SEARCH_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+_UPDATE_HEADER_SQL = (
+    f"UPDATE invoices SET {', '.join(f'{column} = ?' for column, _ in HEADER_COLUMNS + TOTAL_COLUMNS)}, "
+    f"item_count = ? WHERE id = ?"
+)
+_INSERT_ITEM_SQL = (
+    f"INSERT INTO invoice_items (invoice_id, line_no, {', '.join(column for column, _, _ in ITEM_COLUMNS)}, "
+    f"unit_price, line_total) VALUES (?, ?, {', '.join('?' * len(ITEM_COLUMNS))}, ?, ?)"
+)
+
+
+def insert_invoice(conn, invoice_number, scenario_id, payload, payload_hash=None):
+    """Insert an invoice with its header columns, items and report aggregates; returns its id, or None if already saved"""
+    payload_hash = payload_hash or dedup.payload_hash(payload)
+    if conn.execute("SELECT 1 FROM invoices WHERE payload_hash = ?", (payload_hash,)).fetchone():
+        # Sent again on purpose (or by another process): FBR issued it, so it is saved, unhashed
+        payload_hash = None
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO invoices (invoice_number, scenario_id, payload, payload_hash) VALUES (?, ?, ?, ?)",
+        (invoice_number, scenario_id, payload_codec.encode(payload, conn), payload_hash)
+    )
+    if cursor.rowcount == 0:
+        return None
+    write_normalised(conn, cursor.lastrowid, payload)
+    reports.add_invoice(conn, scenario_id, payload)
+    return cursor.lastrowid
+
+def write_normalised(conn, invoice_id, payload):
+    """(Re)write the header columns and item rows of one invoice from its payload"""
+    items = [item for item in payload.get('items') or [] if isinstance(item, dict)]
+    lines, invoice_totals = totals.invoice_totals(items)
+    conn.execute(
+        _UPDATE_HEADER_SQL,
+        [_text(payload.get(key)) for _, key in HEADER_COLUMNS]
+        + [totals.to_paisa(invoice_totals[key]) for _, key in TOTAL_COLUMNS]
+        + [len(items), invoice_id]
+    )
+    conn.execute("DELETE FROM invoice_items WHERE invoice_id = ?", (invoice_id,))
+    conn.executemany(_INSERT_ITEM_SQL, (
+        [invoice_id, line_no] + [_number(item.get(key)) if numeric else _text(item.get(key))
+                                 for _, key, numeric in ITEM_COLUMNS]
+        + [totals.to_paisa(line['unit_price']), totals.to_paisa(line['line_total'])]
+        for line_no, (item, line) in enumerate(zip(items, lines), start=1)
+    ))
+    conn.execute("DELETE FROM invoices_fts WHERE rowid = ?", (invoice_id,))
+    conn.execute(
+        "INSERT INTO invoices_fts (rowid, buyer_business_name, product_descriptions) VALUES (?, ?, ?)",
+        (invoice_id, _text(payload.get('buyerBusinessName')),
+         ' '.join(str(item['productDescription']) for item in items if item.get('productDescription')))
+    )
+
+def backfill(conn, batch_size=BACKFILL_BATCH_SIZE):
+    """Normalise invoices saved before the header, item and total columns existed, a batch at a time"""
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, payload FROM invoices WHERE grand_total IS NULL AND id > ? ORDER BY id LIMIT ?",
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            try:
+                payload = payload_codec.decode(row["payload"] or '{}', conn)
+            except ValueError:
+                payload = {}
+            write_normalised(conn, row["id"], payload if isinstance(payload, dict) else {})
+        last_id = rows[-1]["id"]
+
+def stored_totals(conn, row):
+    """Totals of a saved invoice row as Decimals, with one dict of line figures per item under 'lines'"""
+    result = {key: totals.from_paisa(row[column]) for column, key in TOTAL_COLUMNS}
+    result['lines'] = [
+        {
+            'value_excl_st': totals.to_decimal(line["value_sales_excluding_st"]),
+            'sales_tax': totals.to_decimal(line["sales_tax_applicable"]),
+            'further_tax': totals.to_decimal(line["further_tax"]),
+            'discount': totals.to_decimal(line["discount"]),
+            'unit_price': totals.from_paisa(line["unit_price"]),
+            'line_total': totals.from_paisa(line["line_total"]),
+        }
+        for line in conn.execute(
+            "SELECT value_sales_excluding_st, sales_tax_applicable, further_tax, discount, unit_price, line_total "
+            "FROM invoice_items WHERE invoice_id = ? ORDER BY line_no",
+            (row["id"],)
+        )
+    ]
+    return result
+
+
+# ---------------- LISTING -----------------
+def list_invoices(conn, scenario_id=None, date_from=None, date_to=None, buyer_ntn_cnic=None,
+                  min_amount=None, max_amount=None, search=None, cursor=None, limit=LIST_PAGE_SIZE):
+    """One page of invoices matching the filters, newest first.
+
+    Returns ``(rows, next_cursor)``; pass ``next_cursor`` back to get the
+    following page, it is None on the last one. Dates are ``YYYY-MM-DD`` and
+    compared against the invoice date (inclusive). ``search`` matches words in
+    the buyer name or item descriptions, prefix-wise.
+    """
+    limit = max(1, min(int(limit), LIST_MAX_PAGE_SIZE))
+    conditions, params = [], []
+    if scenario_id:
+        conditions.append("scenario_id = ?")
+        params.append(scenario_id)
+    if date_from:
+        conditions.append("invoice_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("invoice_date <= ?")
+        params.append(date_to)
+    if buyer_ntn_cnic:
+        conditions.append("buyer_ntn_cnic = ?")
+        params.append(buyer_ntn_cnic)
+    if min_amount is not None:
+        conditions.append("grand_total >= ?")
+        params.append(totals.to_paisa(min_amount))
+    if max_amount is not None:
+        conditions.append("grand_total <= ?")
+        params.append(totals.to_paisa(max_amount))
+    if search:
+        match = _match_expression(search)
+        if match is None:
+            return [], None
+        conditions.append("id IN (SELECT rowid FROM invoices_fts WHERE invoices_fts MATCH ?)")
+        params.append(match)
+    if cursor:
+        # Keyset pagination: seek past the last row of the previous page instead of using OFFSET
+        created_at, last_id = decode_cursor(cursor)
+        conditions.append("(created_at, id) < (?, ?)")
+        params.extend([created_at, last_id])
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    rows = conn.execute(
+        f"SELECT {', '.join(_LIST_COLUMNS)} FROM invoices {where} "
+        f"ORDER BY created_at DESC, id DESC LIMIT ?",
+        params + [limit + 1]
+    ).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"])
+    return rows, next_cursor
+
+def encode_cursor(created_at, invoice_id):
+    return base64.urlsafe_b64encode(json.dumps([created_at, invoice_id]).encode()).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """``(created_at, id)`` from a cursor; raises ValueError if it is malformed"""
+    try:
+        created_at, invoice_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError) as e:
+        raise ValueError('Invalid cursor') from e
+    if not isinstance(invoice_id, int):
+        raise ValueError('Invalid cursor')
+    return created_at, invoice_id
+
+def _match_expression(search):
+    # Quote each word so FTS5 query syntax in user input is taken literally
+    tokens = _SEARCH_TOKEN_RE.findall(search)
+    if not tokens:
+        return None
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+def _text(value):
+    if value is None or value == '':
+        return None
+    return str(value)
+
+def _number(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
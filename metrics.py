@@ -0,0 +1,228 @@
+"""Per-stage request timings, exposed in Prometheus text format on /metrics.
+
+Code that does one step of handling an invoice wraps it in ``timer()``:
+
+    with metrics.timer('fbr_call'):
+        response = fbr_client.client.post(...)
+
+Each stage feeds the ``fbr_stage_seconds`` histogram, and is also added to
+the breakdown of the request it ran in. With FBR_LOG_LEVEL=DEBUG every
+request is logged with that breakdown, e.g.
+``submit 200 in 312.4 ms (payload_build 0.1, validate 0.1, fbr_call 305.2, db_insert 1.4, render 2.0)``.
+
+A sampling profiler can also be attached to a fraction of requests: with
+FBR_PROFILE_RATE=0.01, one request in a hundred has its thread's stack sampled
+every FBR_PROFILE_INTERVAL_MS (default 5) milliseconds. If the request takes at
+least FBR_PROFILE_MIN_MS (default 0), the samples are written in collapsed-stack
+format (for flamegraph.pl or speedscope) to FBR_PROFILE_DIR (default profiles/).
+"""
+import contextvars
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the histogram buckets; stages range from microseconds to FBR timeouts
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PROFILE_RATE = float(os.environ.get('FBR_PROFILE_RATE', 0))
+PROFILE_INTERVAL = float(os.environ.get('FBR_PROFILE_INTERVAL_MS', 5)) / 1000
+PROFILE_MIN_SECONDS = float(os.environ.get('FBR_PROFILE_MIN_MS', 0)) / 1000
+PROFILE_DIR = os.environ.get('FBR_PROFILE_DIR', 'profiles')
+
+
+class Histogram:
+    """Thread-safe Prometheus-style histogram, one series per label value"""
+
+    def __init__(self, name, help_text, label, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, label_value, seconds):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, seconds)] += 1
+            series[1] += seconds
+
+    def exposition(self):
+        with self._lock:
+            series = {value: (list(counts), total) for value, (counts, total) in self._series.items()}
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for value, (counts, total) in sorted(series.items()):
+            label = f'{self.label}="{_escape(value)}"'
+            lines.extend(_histogram_lines(self.name, label, self.buckets, counts, total))
+        return lines
+
+
+class Counters:
+    """Thread-safe counters keyed by a tuple of label values"""
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+        self._values = Counter()
+
+    def inc(self, *label_values):
+        with self._lock:
+            self._values[label_values] += 1
+
+    def exposition(self):
+        with self._lock:
+            values = dict(self._values)
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        for label_values, count in sorted(values.items()):
+            labels = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(self.labels, label_values))
+            lines.append(f'{self.name}{{{labels}}} {count}')
+        return lines
+
+
+stage_seconds = Histogram('fbr_stage_seconds', 'Time spent in each stage of handling an invoice', 'stage')
+request_seconds = Histogram('fbr_http_request_seconds', 'Time to answer HTTP requests, by endpoint', 'endpoint')
+requests_total = Counters('fbr_http_requests_total', 'HTTP requests answered, by endpoint and status',
+                          ('endpoint', 'status'))
+
+# Stage timings of the request being handled in this thread or task, or None outside a request
+_request_stages = contextvars.ContextVar('request_stages', default=None)
+
+
+# ----------------- TIMING -----------------
+@contextmanager
+def timer(stage):
+    """Time the enclosed block as ``stage``"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+def observe(stage, seconds):
+    stage_seconds.observe(stage, seconds)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages[stage] = stages.get(stage, 0.0) + seconds
+
+def start_request():
+    """Begin collecting stage timings for a request; returns the token for finish_request()"""
+    _request_stages.set({})
+    sampler = None
+    if PROFILE_RATE and random.random() < PROFILE_RATE:
+        sampler = StackSampler(threading.get_ident(), PROFILE_INTERVAL)
+        sampler.start()
+    return time.perf_counter(), sampler
+
+def finish_request(token, endpoint, status):
+    started, sampler = token
+    seconds = time.perf_counter() - started
+    request_seconds.observe(endpoint, seconds)
+    requests_total.inc(endpoint, str(status))
+    stages = _request_stages.get() or {}
+    _request_stages.set(None)
+
+    if log.isEnabledFor(logging.DEBUG):
+        breakdown = ', '.join(f'{stage} {value * 1000:.1f}' for stage, value in stages.items())
+        log.debug('%s %s in %.1f ms%s', endpoint, status, seconds * 1000, f' ({breakdown})' if breakdown else '')
+    if sampler is not None:
+        sampler.stop()
+        if seconds >= PROFILE_MIN_SECONDS:
+            sampler.save(endpoint)
+
+
+# ----------------- PROFILING -----------------
+class StackSampler(threading.Thread):
+    """Samples one thread's stack at a fixed interval while a request runs.
+
+    Under asgi.py the sampled thread is the event loop's, so samples from other
+    requests handled meanwhile are included.
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='stack-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def save(self, endpoint):
+        if not self.samples:
+            return None
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f'{time.strftime("%Y%m%d-%H%M%S")}-{endpoint}-{self.thread_id}.folded')
+        with open(path, 'w') as profile:
+            for stack, count in self.samples.most_common():
+                profile.write(f'{stack} {count}\n')
+        log.info('Profile of %s written to %s', endpoint, path)
+        return path
+
+
+# ----------------- EXPOSITION -----------------
+def exposition(*extra_lines):
+    """Everything above in Prometheus text format, followed by ``extra_lines``"""
+    lines = stage_seconds.exposition() + request_seconds.exposition() + requests_total.exposition()
+    lines.extend(extra_lines)
+    return '\n'.join(lines) + '\n'
+
+def histogram_lines(name, help_text, buckets, counts, total):
+    """A histogram kept elsewhere (per-bucket counts, not cumulative) in exposition format"""
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} histogram'] + \
+        _histogram_lines(name, '', buckets, counts, total)
+
+def gauge_lines(name, help_text, values, label=None):
+    """A gauge: ``values`` is a number, or a dict of label value -> number when ``label`` is given"""
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+    if label is None:
+        lines.append(f'{name} {_number(values)}')
+    else:
+        lines.extend(f'{name}{{{label}="{_escape(key)}"}} {_number(value)}' for key, value in sorted(values.items()))
+    return lines
+
+def counter_lines(name, help_text, value):
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} counter', f'{name} {_number(value)}']
+
+def _histogram_lines(name, label, buckets, counts, total):
+    prefix = label + ',' if label else ''
+    suffix = f'{{{label}}}' if label else ''
+    lines, cumulative = [], 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+    cumulative += counts[-1]
+    lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+    lines.append(f'{name}_sum{suffix} {total:.6f}')
+    lines.append(f'{name}_count{suffix} {cumulative}')
+    return lines
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    return 'NaN' if value is None else f'{value:g}' if isinstance(value, float) else str(value)
@@ -0,0 +1,439 @@
+"""Durable outbox for FBR submissions.
+
+A submitted invoice is written to the ``outbox`` table, with its built payload,
+before anything is sent, so it survives restarts and FBR outages. Background
+workers drain the table at a limited rate and record what FBR answered:
+
+    pending   waiting to be sent (again), at ``next_attempt_at``
+    sending   claimed by a worker; the claim lapses after LEASE_SECONDS
+    sent      FBR issued an invoice number and the invoice was saved
+    rejected  FBR answered and refused the invoice
+    held      FBR may or may not have processed it (no answer, or an ambiguous
+              5xx, or the process died mid-send). Never resent automatically,
+              because FBR has no idempotency support of its own; requeue with
+              retry() once you have checked it was not issued.
+    dead      still failing after MAX_ATTEMPTS attempts
+
+Every entry has a unique idempotency key (the invoice form carries one), so a
+form that is posted twice, e.g. after a browser timeout, is only queued once.
+A key posted again after FBR rejected its invoice, or it went dead, is a new
+attempt, queued under a fresh key; while the first attempt is live or sent,
+the same invoice gets that entry back and a different one is refused with
+KeyConflict.
+Entries also carry the canonical hash of their payload (see dedup.py), so the
+same invoice entered again on a fresh form isn't queued twice either.
+
+Settings come from the environment:
+
+    FBR_OUTBOX                0 sends invoices directly from the request instead (default 1)
+    FBR_OUTBOX_WORKERS        concurrent sends per process (default 4)
+    FBR_OUTBOX_RATE           sends per second per process, 0 for no limit (default 5)
+    FBR_OUTBOX_MAX_ATTEMPTS   attempts before an invoice is dead-lettered (default 10)
+    FBR_OUTBOX_BACKOFF        base of the exponential backoff between attempts in seconds (default 2)
+    FBR_OUTBOX_LEASE_SECONDS  how long a send may take before it is presumed lost (default 300)
+    FBR_OUTBOX_WAIT_SECONDS   how long the submit page waits for FBR before showing "queued" (default 10)
+"""
+import atexit
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import fbr_client
+import storage
+
+log = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('FBR_OUTBOX', '1') != '0'
+WORKERS = int(os.environ.get('FBR_OUTBOX_WORKERS', 4))
+RATE = float(os.environ.get('FBR_OUTBOX_RATE', 5))
+MAX_ATTEMPTS = int(os.environ.get('FBR_OUTBOX_MAX_ATTEMPTS', 10))
+BACKOFF_SECONDS = float(os.environ.get('FBR_OUTBOX_BACKOFF', 2))
+MAX_BACKOFF_SECONDS = 600
+LEASE_SECONDS = float(os.environ.get('FBR_OUTBOX_LEASE_SECONDS', 300))
+WAIT_SECONDS = float(os.environ.get('FBR_OUTBOX_WAIT_SECONDS', 10))
+# How often idle workers look for entries queued by other processes or now due
+POLL_SECONDS = 1.0
+
+PENDING, SENDING, SENT, REJECTED, HELD, DEAD = 'pending', 'sending', 'sent', 'rejected', 'held', 'dead'
+STATUSES = (PENDING, SENDING, SENT, REJECTED, HELD, DEAD)
+# Nothing more will happen to these without someone stepping in
+SETTLED = {SENT, REJECTED, HELD, DEAD}
+# Statuses retry() can requeue
+RETRYABLE = {HELD, DEAD}
+# Never issued, and never sent again on their own: their key may be reused for a corrected invoice
+FAILED = {REJECTED, DEAD}
+# Nothing more will happen to these at all, so their form needs a new key
+FINAL = {SENT, REJECTED, DEAD}
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+_waiters = {}   # idempotency key -> Event set when its entry settles
+_waiters_lock = threading.Lock()
+
+
+class KeyConflict(ValueError):
+    """An idempotency key was posted with a different invoice while its entry is live, sent or held"""
+
+    def __init__(self, entry):
+        self.entry = entry
+        super().__init__(f"This form was already submitted with a different invoice, which is {entry['status']}; "
+                         f"open a new form to submit another")
+
+
+def new_key():
+    return uuid.uuid4().hex
+
+
+# ---------------- QUEUEING -----------------
+def enqueue(scenario_id, payload, api_url, bearer_token, idempotency_key=None, payload_hash=None):
+    """Persist an invoice for sending and return its outbox entry.
+
+    When an entry with the same idempotency key or payload hash is waiting,
+    being sent, sent or held, that entry is returned and nothing new is
+    queued; the key defaults to ``payload_hash``. Raises KeyConflict for a key
+    already taken by a different payload (see add()).
+    """
+    entry = storage.run_write(add, idempotency_key or payload_hash or new_key(), scenario_id, json.dumps(payload),
+                              api_url or '', bearer_token or '', time.time(), payload_hash)
+    if _dispatcher is not None:
+        _dispatcher.wake.set()
+    return entry
+
+def add(conn, key, scenario_id, payload, api_url, bearer_token, now, payload_hash=None):
+    """Insert an entry (payload as JSON text) unless its key or payload hash is taken, and return the entry.
+
+    A key whose entry was rejected or went dead is replaced with a fresh one,
+    so the invoice (corrected, or with a new API URL or token) is sent again.
+    A key still live or sent raises KeyConflict when taken by a different payload.
+    """
+    if payload_hash:
+        # Rejected and dead entries were never issued, so the same payload may be queued again
+        row = conn.execute(
+            "SELECT * FROM outbox WHERE payload_hash = ? AND status IN ('pending', 'sending', 'sent', 'held') "
+            "ORDER BY id DESC LIMIT 1", (payload_hash,)
+        ).fetchone()
+        if row is not None:
+            return dict(row)
+    row = conn.execute("SELECT * FROM outbox WHERE idempotency_key = ?", (key,)).fetchone()
+    if row is not None:
+        if row["status"] not in FAILED:
+            if _same_payload(row, payload, payload_hash):
+                return dict(row)
+            raise KeyConflict(dict(row))
+        # Never issued, so this is a new attempt; the failed entry keeps its history
+        key = new_key()
+    conn.execute(
+        "INSERT INTO outbox (idempotency_key, scenario_id, payload, api_url, bearer_token, "
+        "next_attempt_at, created_at, updated_at, payload_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (idempotency_key) DO NOTHING",
+        (key, scenario_id, payload, api_url, bearer_token, now, now, now, payload_hash)
+    )
+    return dict(conn.execute("SELECT * FROM outbox WHERE idempotency_key = ?", (key,)).fetchone())
+
+def _same_payload(row, payload, payload_hash):
+    if payload_hash and row["payload_hash"]:
+        return row["payload_hash"] == payload_hash
+    # Sent with allow_duplicate, or queued before payloads were hashed
+    return row["payload"] == payload
+
+def get(key, conn=None):
+    row = (conn or storage.get_connection()).execute(
+        "SELECT * FROM outbox WHERE idempotency_key = ?", (key,)
+    ).fetchone()
+    return dict(row) if row else None
+
+def wait(key, timeout=WAIT_SECONDS):
+    """The entry once it settles, or as it stands after ``timeout`` seconds"""
+    deadline = time.monotonic() + timeout
+    with _waiters_lock:
+        event = _waiters.setdefault(key, threading.Event())
+    try:
+        while True:
+            entry = get(key)
+            remaining = deadline - time.monotonic()
+            if entry is None or entry['status'] in SETTLED or remaining <= 0:
+                return entry
+            # Entries sent by another process never set the event, so keep polling too
+            event.wait(min(remaining, 0.5))
+    finally:
+        with _waiters_lock:
+            _waiters.pop(key, None)
+
+def retry(conn, keys=None, status=None):
+    """Requeue held / dead entries, by key or all with a status. Returns how many were requeued."""
+    now = time.time()
+    sql = ("UPDATE outbox SET status = 'pending', next_attempt_at = ?, updated_at = ?, "
+           "attempts = CASE WHEN status = 'dead' THEN 0 ELSE attempts END "
+           "WHERE status IN ('held', 'dead')")
+    params = [now, now]
+    if keys:
+        sql += f" AND idempotency_key IN ({', '.join('?' * len(keys))})"
+        params += list(keys)
+    if status:
+        sql += " AND status = ?"
+        params.append(status)
+    count = conn.execute(sql, params).rowcount
+    if count and _dispatcher is not None:
+        _dispatcher.wake.set()
+    return count
+
+def result(entry):
+    """The entry as the result dict the submit route renders"""
+    try:
+        response_data = json.loads(entry['response']) if entry['response'] else None
+    except ValueError:
+        response_data = {'raw_response': entry['response']}
+    result = {
+        'status_code': entry['status_code'],
+        'success': entry['status'] == SENT,
+        'invoice_number': entry['invoice_number'],
+        'request_payload': json.loads(entry['payload']),
+        'response_data': response_data,
+        'outbox_status': entry['status'],
+        'idempotency_key': entry['idempotency_key'],
+    }
+    if entry['status'] == SENT:
+        result['qr_code'] = f"/qr/{entry['invoice_number']}"
+    elif entry['last_error']:
+        result['error'] = entry['last_error']
+    return result
+
+
+# ---------------- STATUS -----------------
+def stats(conn):
+    """Queue depth per status, age of the oldest waiting entry and recent drain rate"""
+    now = time.time()
+    counts = dict.fromkeys(STATUSES, 0)
+    for row in conn.execute("SELECT status, COUNT(*) AS count FROM outbox GROUP BY status"):
+        counts[row['status']] = row['count']
+    oldest = conn.execute("SELECT MIN(created_at) FROM outbox WHERE status IN ('pending', 'sending')").fetchone()[0]
+    sent_last_minute, sent_last_hour = conn.execute(
+        "SELECT COUNT(*) FILTER (WHERE updated_at >= ?), COUNT(*) FROM outbox "
+        "WHERE status = 'sent' AND updated_at >= ?", (now - 60, now - 3600)
+    ).fetchone()
+    return {
+        'counts': counts,
+        'queue_depth': counts[PENDING] + counts[SENDING],
+        'oldest_waiting_seconds': round(now - oldest, 1) if oldest else None,
+        'sent_last_minute': sent_last_minute,
+        'sent_last_hour': sent_last_hour,
+        'drain_rate_per_second': round(sent_last_minute / 60, 2),
+        'workers': WORKERS,
+        'rate_limit_per_second': RATE or None,
+    }
+
+def entries(conn, statuses, limit=50):
+    """Most recently updated entries with the given statuses, without their tokens"""
+    rows = conn.execute(
+        f"SELECT id, idempotency_key, scenario_id, status, attempts, next_attempt_at, status_code, "
+        f"invoice_number, last_error, created_at, updated_at FROM outbox "
+        f"WHERE status IN ({', '.join('?' * len(statuses))}) ORDER BY updated_at DESC LIMIT ?",
+        list(statuses) + [limit]
+    )
+    return [dict(row) for row in rows]
+
+
+# ---------------- SENDING -----------------
+class TokenBucket:
+    """Allows ``rate`` acquisitions per second on average, in bursts of up to ``burst``"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+class _Dispatcher(threading.Thread):
+    """Claims due entries and hands them to a pool of sending threads"""
+
+    def __init__(self, send, workers, rate):
+        super().__init__(name='outbox-dispatcher', daemon=True)
+        self.send = send
+        self.workers = max(1, workers)
+        self.bucket = TokenBucket(rate, burst=self.workers)
+        self.pid = os.getpid()
+        self.wake = threading.Event()
+        self.stopping = False
+        self.busy = 0
+        self._lock = threading.Lock()
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='outbox') as pool:
+            while not self.stopping:
+                self.wake.clear()
+                with self._lock:
+                    free = self.workers - self.busy
+                claimed = []
+                if free:
+                    try:
+                        claimed = storage.run_write(_claim, time.time(), free, LEASE_SECONDS)
+                    except Exception:
+                        log.exception('Could not claim outbox entries')
+                for entry in claimed:
+                    with self._lock:
+                        self.busy += 1
+                    pool.submit(self._deliver, entry)
+                if len(claimed) < free or not free:
+                    self.wake.wait(POLL_SECONDS)
+
+    def _deliver(self, entry):
+        try:
+            self.bucket.acquire()
+            outcome = self._send(entry)
+            storage.run_write(settle, entry, time.time(), outcome)
+        except Exception:
+            # Left 'sending': the lapsed lease moves it to 'held'
+            log.exception('Outbox entry %s could not be recorded', entry['idempotency_key'])
+        finally:
+            with self._lock:
+                self.busy -= 1
+            self.wake.set()
+            with _waiters_lock:
+                event = _waiters.get(entry['idempotency_key'])
+            if event is not None:
+                event.set()
+
+    def _send(self, entry):
+        try:
+            result = self.send(entry['scenario_id'], json.loads(entry['payload']), entry['api_url'], entry['bearer_token'])
+        except requests.exceptions.RequestException as e:
+            return not_sent(e) if fbr_client.never_sent(e) else no_answer(e)
+        except Exception as e:
+            return app_error(e)
+        return classify(result)
+
+
+# An outcome is (status, status_code, response_data, invoice_number, error, retry_after)
+def classify(result):
+    """The outcome of an attempt FBR answered, from the submit route's result dict"""
+    status_code = result['status_code']
+    response_data = result.get('response_data')
+    if result['success']:
+        return SENT, status_code, response_data, result['invoice_number'], None, None
+    if status_code in fbr_client.RETRY_ALWAYS_STATUS:
+        retry_after = (result.get('response_headers') or {}).get('Retry-After')
+        return PENDING, status_code, response_data, None, f'FBR answered {status_code}', retry_after
+    if status_code in fbr_client.RETRY_IDEMPOTENT_STATUS:
+        return HELD, status_code, response_data, None, \
+            f'FBR answered {status_code}, it may have accepted the invoice', None
+    return REJECTED, status_code, response_data, None, f'FBR rejected the invoice ({status_code})', None
+
+def not_sent(error):
+    """The outcome of an attempt that never reached FBR"""
+    return PENDING, None, None, None, f'Could not reach FBR: {error}', None
+
+def no_answer(error):
+    """The outcome of an attempt FBR may have processed without answering"""
+    return HELD, None, None, None, f'No answer from FBR, it may have accepted the invoice: {error}', None
+
+def app_error(error):
+    # e.g. saving failed after FBR issued the number: don't send it again
+    return HELD, None, None, None, f'Application error: {error}', None
+
+
+def _claim(conn, now, limit, lease_seconds):
+    # Claims whose worker died mid-send: FBR may have issued a number, so hold rather than resend
+    conn.execute(
+        "UPDATE outbox SET status = 'held', updated_at = ?, "
+        "last_error = 'Interrupted while sending, FBR may have accepted the invoice' "
+        "WHERE status = 'sending' AND lease_until < ?", (now, now)
+    )
+    rows = conn.execute(
+        "SELECT * FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+        "ORDER BY next_attempt_at, id LIMIT ?", (now, limit)
+    ).fetchall()
+    if not rows:
+        return []
+    ids = [row['id'] for row in rows]
+    conn.execute(
+        f"UPDATE outbox SET status = 'sending', attempts = attempts + 1, lease_until = ?, updated_at = ? "
+        f"WHERE id IN ({', '.join('?' * len(ids))})", [now + lease_seconds, now] + ids
+    )
+    return [dict(row, attempts=row['attempts'] + 1) for row in rows]
+
+def claim(conn, key, now, lease_seconds=LEASE_SECONDS):
+    """Claim one pending entry to send it right away. Returns it, or None when it isn't pending."""
+    updated = conn.execute(
+        "UPDATE outbox SET status = 'sending', attempts = attempts + 1, lease_until = ?, updated_at = ? "
+        "WHERE idempotency_key = ? AND status = 'pending'", (now + lease_seconds, now, key)
+    ).rowcount
+    return get(key, conn) if updated else None
+
+def settle(conn, entry, now, outcome):
+    """Record the outcome of one attempt at sending a claimed entry"""
+    status, status_code, response_data, invoice_number, error, retry_after = outcome
+    next_attempt_at = now
+    if status == PENDING:
+        if entry['attempts'] >= MAX_ATTEMPTS:
+            status, error = DEAD, f"{error} (gave up after {entry['attempts']} attempts)"
+        else:
+            next_attempt_at = now + _backoff(entry['attempts'], retry_after)
+    conn.execute(
+        "UPDATE outbox SET status = ?, status_code = ?, response = ?, invoice_number = ?, last_error = ?, "
+        "next_attempt_at = ?, lease_until = NULL, updated_at = ?, "
+        # The token is only kept while the entry may still be sent
+        "bearer_token = CASE WHEN ? IN ('sent', 'rejected') THEN '' ELSE bearer_token END "
+        "WHERE id = ?",
+        (status, status_code, json.dumps(response_data) if response_data is not None else None,
+         invoice_number, error, next_attempt_at, now, status, entry['id'])
+    )
+    return status
+
+def _backoff(attempts, retry_after=None):
+    try:
+        return min(float(retry_after), MAX_BACKOFF_SECONDS)
+    except (TypeError, ValueError):
+        pass
+    # Jittered so entries that failed together don't all come back together
+    return min(BACKOFF_SECONDS * 2 ** (attempts - 1), MAX_BACKOFF_SECONDS) * random.uniform(0.5, 1)
+
+
+def start(send, workers=WORKERS, rate=RATE):
+    """Start draining the outbox in this process with ``send(scenario_id, payload, api_url, bearer_token)``"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None or _dispatcher.pid != os.getpid() or not _dispatcher.is_alive():
+            _dispatcher = _Dispatcher(send, workers, rate)
+            _dispatcher.start()
+    return _dispatcher
+
+def running():
+    """Whether this process is draining the outbox"""
+    dispatcher = _dispatcher
+    return dispatcher is not None and dispatcher.pid == os.getpid() and dispatcher.is_alive()
+
+def stop():
+    """Stop claiming new entries and let sends in progress finish"""
+    global _dispatcher
+    with _dispatcher_lock:
+        dispatcher, _dispatcher = _dispatcher, None
+    if dispatcher is not None and dispatcher.pid == os.getpid():
+        dispatcher.stopping = True
+        dispatcher.wake.set()
+        dispatcher.join()
+
+
+atexit.register(stop)
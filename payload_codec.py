@@ -0,0 +1,294 @@
+"""Encoding of the invoice payloads stored in ``invoices.payload``.
+
+Payloads used to be stored as JSON text and parsed on every read. New rows are
+encoded with the codec named by FBR_PAYLOAD_CODEC:
+
+    json     JSON text, as before
+    zlib     compact JSON, deflated (the default; standard library only)
+    zstd     compact JSON, compressed with zstd (needs ``pip install zstandard``)
+    msgpack  MessagePack (needs ``pip install msgpack``)
+
+Encoded payloads are BLOBs that start with a one-byte codec tag and a two-byte
+dictionary id. Rows written with different codecs, and JSON text rows from
+before, can sit side by side in the table, and ``decode()`` reads them all;
+``flask recode-payloads`` rewrites existing rows a batch at a time.
+
+zlib and zstd can compress with a dictionary trained on stored payloads
+(``recode-payloads --train``). Invoices repeat the same keys, seller details
+and item descriptions, which a payload of a few hundred bytes cannot exploit on
+its own but a shared dictionary can. Dictionaries are kept in the
+``payload_dictionaries`` table and never change once written; new rows use the
+newest one for their codec (running processes pick up a new one on restart).
+"""
+import json
+import os
+import struct
+import threading
+import zlib
+
+import storage
+
+CODEC = os.environ.get('FBR_PAYLOAD_CODEC', 'zlib')
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+# zlib uses at most the last 32 KB of a dictionary
+ZLIB_DICTIONARY_BYTES = 32 * 1024
+ZSTD_DICTIONARY_BYTES = 64 * 1024
+TRAINING_SAMPLES = 5000
+RECODE_BATCH_SIZE = 1000
+
+_HEADER = struct.Struct('>cH')  # codec tag, dictionary id (0: none)
+
+
+# ---------------- CODECS -----------------
+class JSONCodec:
+    """JSON text, stored as TEXT rather than a tagged BLOB"""
+    name = 'json'
+    tag = None
+    trainable = False
+
+    def check(self):
+        pass
+
+    def encode(self, payload, dictionary=None):
+        return json.dumps(payload)
+
+    def decode(self, data, dictionary=None):
+        return json.loads(data)
+
+
+class ZlibCodec:
+    name = 'zlib'
+    tag = b'z'
+    trainable = True
+
+    def __init__(self, level=ZLIB_LEVEL):
+        self.level = level
+
+    def check(self):
+        pass
+
+    def encode(self, payload, dictionary=None):
+        data = _compact_json(payload)
+        if dictionary is None:
+            return zlib.compress(data, self.level)
+        compressor = zlib.compressobj(self.level, zdict=dictionary)
+        return compressor.compress(data) + compressor.flush()
+
+    def decode(self, data, dictionary=None):
+        if dictionary is None:
+            return json.loads(zlib.decompress(data))
+        decompressor = zlib.decompressobj(zdict=dictionary)
+        return json.loads(decompressor.decompress(data) + decompressor.flush())
+
+    def train(self, samples):
+        # zlib has no trainer: the dictionary is sample payloads, the most
+        # recent last, where zlib finds its matches most cheaply
+        return b''.join(samples)[-ZLIB_DICTIONARY_BYTES:]
+
+
+class ZstdCodec:
+    name = 'zstd'
+    tag = b's'
+    trainable = True
+
+    def __init__(self, level=ZSTD_LEVEL):
+        self.level = level
+        # Parsed dictionaries by content; compressors aren't thread-safe, so one per thread
+        self._dictionaries = {}
+        self._local = threading.local()
+
+    def check(self):
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise RuntimeError('The zstd payload codec needs the zstandard package (pip install zstandard)')
+
+    def encode(self, payload, dictionary=None):
+        return self._coders(dictionary)[0].compress(_compact_json(payload))
+
+    def decode(self, data, dictionary=None):
+        return json.loads(self._coders(dictionary)[1].decompress(data))
+
+    def train(self, samples):
+        import zstandard
+        return zstandard.train_dictionary(ZSTD_DICTIONARY_BYTES, samples).as_bytes()
+
+    def _coders(self, dictionary):
+        import zstandard
+        coders = getattr(self._local, 'coders', None)
+        if coders is None:
+            coders = self._local.coders = {}
+        pair = coders.get(dictionary)
+        if pair is None:
+            parsed = None
+            if dictionary is not None:
+                parsed = self._dictionaries.get(dictionary)
+                if parsed is None:
+                    parsed = self._dictionaries[dictionary] = zstandard.ZstdCompressionDict(dictionary)
+                    parsed.precompute_compress(level=self.level)
+            pair = coders[dictionary] = (
+                zstandard.ZstdCompressor(level=self.level, dict_data=parsed, write_content_size=True),
+                zstandard.ZstdDecompressor(dict_data=parsed),
+            )
+        return pair
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    tag = b'm'
+    trainable = False
+
+    def check(self):
+        try:
+            import msgpack  # noqa: F401
+        except ImportError:
+            raise RuntimeError('The msgpack payload codec needs the msgpack package (pip install msgpack)')
+
+    def encode(self, payload, dictionary=None):
+        import msgpack
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, data, dictionary=None):
+        import msgpack
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS = {}
+_CODECS_BY_TAG = {}
+
+def register(codec):
+    """Make a codec available by name for writing, and by tag for reading"""
+    CODECS[codec.name] = codec
+    if codec.tag is not None:
+        _CODECS_BY_TAG[codec.tag] = codec
+
+for _codec in (JSONCodec(), ZlibCodec(), ZstdCodec(), MsgpackCodec()):
+    register(_codec)
+
+if CODEC not in CODECS:
+    raise ValueError(f"FBR_PAYLOAD_CODEC must be one of {', '.join(sorted(CODECS))}, not {CODEC!r}")
+
+
+# ---------------- ENCODING -----------------
+def encode(payload, conn=None, codec=None):
+    """A payload as stored: JSON text for the json codec, otherwise a tagged BLOB"""
+    codec = CODECS[codec or CODEC]
+    if codec.tag is None:
+        return codec.encode(payload)
+    dictionary_id, dictionary = active_dictionary(codec.name, conn) if codec.trainable else (0, None)
+    return _HEADER.pack(codec.tag, dictionary_id) + codec.encode(payload, dictionary)
+
+def decode(value, conn=None):
+    """A stored payload, whichever codec wrote it"""
+    if isinstance(value, str):
+        return json.loads(value)
+    value = bytes(value)
+    if len(value) < _HEADER.size:
+        raise ValueError('Truncated payload')
+    tag, dictionary_id = _HEADER.unpack_from(value)
+    codec = _CODECS_BY_TAG.get(tag)
+    if codec is None:
+        raise ValueError(f'Unknown payload codec tag {tag!r}')
+    dictionary = get_dictionary(dictionary_id, conn) if dictionary_id else None
+    try:
+        return codec.decode(value[_HEADER.size:], dictionary)
+    except ValueError:
+        raise
+    except Exception as e:
+        # zlib.error, zstd errors, ...: reported like unparseable JSON
+        raise ValueError(f'Corrupt {codec.name} payload: {e}') from e
+
+def codec_of(value):
+    """Name of the codec a stored payload was written with, and its dictionary id"""
+    if value is None or isinstance(value, str) or len(value) < _HEADER.size:
+        return 'json', 0
+    tag, dictionary_id = _HEADER.unpack_from(bytes(value))
+    codec = _CODECS_BY_TAG.get(tag)
+    return (codec.name if codec else repr(tag)), dictionary_id
+
+def _compact_json(payload):
+    return json.dumps(payload, separators=(',', ':')).encode()
+
+
+# ---------------- DICTIONARIES -----------------
+_dictionaries = {}   # id -> bytes; a dictionary never changes once written
+_active = {}         # codec name -> (id, bytes) of the dictionary new rows use
+_lock = threading.Lock()
+
+def get_dictionary(dictionary_id, conn=None):
+    dictionary = _dictionaries.get(dictionary_id)
+    if dictionary is None:
+        row = (conn or storage.get_connection()).execute(
+            "SELECT dictionary FROM payload_dictionaries WHERE id = ?", (dictionary_id,)
+        ).fetchone()
+        if row is None:
+            raise ValueError(f'Payload dictionary {dictionary_id} is missing')
+        dictionary = _dictionaries[dictionary_id] = bytes(row["dictionary"])
+    return dictionary
+
+def active_dictionary(codec_name, conn=None):
+    """``(id, bytes)`` of the newest dictionary for a codec, or ``(0, None)`` if it has none yet"""
+    active = _active.get(codec_name)
+    if active is None:
+        row = (conn or storage.get_connection()).execute(
+            "SELECT id, dictionary FROM payload_dictionaries WHERE codec = ? ORDER BY id DESC LIMIT 1",
+            (codec_name,)
+        ).fetchone()
+        active = (row["id"], bytes(row["dictionary"])) if row else (0, None)
+        with _lock:
+            _active[codec_name] = active
+            if row:
+                _dictionaries[row["id"]] = active[1]
+    return active
+
+def train(conn, codec_name, samples=TRAINING_SAMPLES):
+    """Train a dictionary on the most recent payloads and make it the codec's active one.
+
+    Returns its id, or None when there are no payloads to learn from.
+    """
+    codec = CODECS[codec_name]
+    codec.check()
+    if not codec.trainable:
+        raise ValueError(f'The {codec_name} codec does not use dictionaries')
+    rows = conn.execute("SELECT payload FROM invoices ORDER BY id DESC LIMIT ?", (samples,)).fetchall()
+    if not rows:
+        return None
+    dictionary = codec.train([_compact_json(decode(row["payload"], conn)) for row in reversed(rows)])
+    dictionary_id = conn.execute(
+        "INSERT INTO payload_dictionaries (codec, dictionary, created_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+        (codec_name, dictionary)
+    ).lastrowid
+    with _lock:
+        _dictionaries[dictionary_id] = dictionary
+        _active[codec_name] = (dictionary_id, dictionary)
+    return dictionary_id
+
+
+# ---------------- RECODING -----------------
+def recode_batch(conn, codec_name, after_id=0, batch_size=RECODE_BATCH_SIZE):
+    """Rewrite the payloads of the next ``batch_size`` invoices after ``after_id`` with a codec.
+
+    Rows already written with the codec and its active dictionary are left
+    alone. Returns ``(last id, rows read, rows rewritten)``; no rows read means
+    the table is done.
+    """
+    codec = CODECS[codec_name]
+    target = (codec.name, active_dictionary(codec.name, conn)[0] if codec.trainable else 0)
+    rows = conn.execute(
+        "SELECT id, payload FROM invoices WHERE id > ? ORDER BY id LIMIT ?", (after_id, batch_size)
+    ).fetchall()
+    rewritten = [(encode(decode(row["payload"], conn), conn, codec.name), row["id"])
+                 for row in rows if row["payload"] is not None and codec_of(row["payload"]) != target]
+    conn.executemany("UPDATE invoices SET payload = ? WHERE id = ?", rewritten)
+    return (rows[-1]["id"] if rows else after_id), len(rows), len(rewritten)
+
+def stats(conn):
+    """Invoice count and stored payload bytes per codec and dictionary"""
+    counts = {}
+    for row in conn.execute("SELECT payload, length(CAST(payload AS BLOB)) AS size FROM invoices"):
+        key = codec_of(row["payload"])
+        count, size = counts.get(key, (0, 0))
+        counts[key] = (count + 1, size + (row["size"] or 0))
+    return [{'codec': name, 'dictionary': dictionary_id, 'invoices': count, 'bytes': size}
+            for (name, dictionary_id), (count, size) in sorted(counts.items())]
@@ -0,0 +1,168 @@
+"""FBR invoice payload building.
+
+Every scenario produces the same payload shape and differs only in its
+``scenarioId`` and a few header defaults, so the payload is described once, as
+field specs, and turned into one specialised builder function per scenario at
+import time. A builder is a single dict literal of ``form_data.get`` calls: no
+per-request setup, and today's date is only looked up when the form has none.
+
+Builders accept any mapping of form-style fields (``request.form``, a CSV row,
+a JSON object), so the web form and bulk uploads share them. Items come either
+from ``item_<n>_<field>`` keys or from an ``items`` list (or JSON text of one).
+"""
+import json
+import math
+from datetime import date
+
+from scenarios import SCENARIOS
+
+# Marks a field whose default is computed when needed, not baked into the builder
+TODAY = object()
+
+# (payload key, form key, default) for the invoice header, in payload order
+HEADER_FIELDS = (
+    ('invoiceType', 'invoiceType', 'Sale Invoice'),
+    ('invoiceDate', 'invoiceDate', TODAY),
+    ('sellerNTNCNIC', 'sellerNTNCNIC', ''),
+    ('sellerBusinessName', 'sellerBusinessName', ''),
+    ('sellerProvince', 'sellerProvince', ''),
+    ('sellerAddress', 'sellerAddress', ''),
+    ('buyerNTNCNIC', 'buyerNTNCNIC', ''),
+    ('buyerBusinessName', 'buyerBusinessName', ''),
+    ('buyerProvince', 'buyerProvince', ''),
+    ('buyerAddress', 'buyerAddress', ''),
+    ('invoiceRefNo', 'invoiceRefNo', ''),
+    # Defaults to the scenario's buyer type
+    ('buyerRegistrationType', 'buyerType', None),
+)
+
+# (payload key, kind, default) for each item; kind is 'text', 'number' or 'number_or_empty'
+ITEM_FIELDS = (
+    ('hsCode', 'text', ''),
+    ('productDescription', 'text', ''),
+    ('rate', 'text', '18%'),
+    ('uoM', 'text', ''),
+    ('quantity', 'number', None),
+    ('totalValues', 'number', None),
+    ('valueSalesExcludingST', 'number', None),
+    ('fixedNotifiedValueOrRetailPrice', 'number', None),
+    ('salesTaxApplicable', 'number', None),
+    ('salesTaxWithheldAtSource', 'number', None),
+    # Sent as "" rather than 0 when left blank
+    ('extraTax', 'number_or_empty', None),
+    ('furtherTax', 'number', None),
+    ('sroScheduleNo', 'text', ''),
+    ('fedPayable', 'number', None),
+    ('discount', 'number', None),
+    ('saleType', 'text', 'Goods at standard rate (default)'),
+    ('sroItemSerialNo', 'text', ''),
+)
+
+
+def safe_float(value):
+    """Convert to float safely, return 0 if invalid"""
+    # Blank fields are the common case on long invoices: answered without raising
+    if value is None or value == '':
+        return 0.0
+    try:
+        number = float(value)
+    except (ValueError, TypeError):
+        return 0.0
+    return number if math.isfinite(number) else 0.0
+
+def safe_float_or_empty(value):
+    """Convert to float if valid, otherwise return empty string for API compatibility"""
+    if value is None or value == '':
+        return ""
+    try:
+        number = float(value)
+    except (ValueError, TypeError):
+        return ""
+    return number if math.isfinite(number) else ""
+
+def today():
+    return date.today().strftime('%Y-%m-%d')
+
+
+# ---------------- COMPILING -----------------
+def header_spec(scenario):
+    """The header field specs of one scenario, with its own defaults applied"""
+    overrides = dict(scenario.get('payload_defaults') or {})
+    overrides.setdefault('buyerRegistrationType', scenario.get('buyer_type', ''))
+    return [(key, form_key, overrides.get(key, default)) for key, form_key, default in HEADER_FIELDS]
+
+def compile_builder(scenario_id, scenario):
+    """Generate ``build(form_data) -> payload`` for one scenario"""
+    entries = []
+    for key, form_key, default in header_spec(scenario):
+        if default is TODAY:
+            value = f"get({form_key!r}) if {form_key!r} in form_data else today()"
+        else:
+            value = f"get({form_key!r}, {default!r})"
+        entries.append(f"        {key!r}: {value},")
+    entries.append(f"        'scenarioId': {scenario_id!r},")
+    entries.append("        'items': parse_items(form_data),")
+
+    source = "def build(form_data):\n    get = form_data.get\n    return {\n" + "\n".join(entries) + "\n    }\n"
+    namespace = {'today': today, 'parse_items': parse_items}
+    exec(compile(source, f'<payload builder {scenario_id}>', 'exec'), namespace)
+    build = namespace['build']
+    build.__name__ = build.__qualname__ = f'build_{scenario_id.lower()}_payload'
+    build.__doc__ = f"Build JSON payload for {scenario_id} scenario"
+    return build
+
+def compile_item_parser():
+    """Generate ``parse_item(get, prefix)``, building one payload item from the ``<prefix><field>`` keys"""
+    converters = {'number': 'safe_float', 'number_or_empty': 'safe_float_or_empty'}
+    entries = []
+    for key, kind, default in ITEM_FIELDS:
+        if kind == 'text':
+            entries.append(f"        {key!r}: get(prefix + {key!r}, {default!r}),")
+        else:
+            entries.append(f"        {key!r}: {converters[kind]}(get(prefix + {key!r})),")
+    source = "def parse_item(get, prefix=''):\n    return {\n" + "\n".join(entries) + "\n    }\n"
+    namespace = {'safe_float': safe_float, 'safe_float_or_empty': safe_float_or_empty}
+    exec(compile(source, '<item parser>', 'exec'), namespace)
+    return namespace['parse_item']
+
+
+# ---------------- BUILDING -----------------
+_parse_item = compile_item_parser()
+
+def parse_items(form_data):
+    """Parse items from form data safely.
+
+    Uses the ``items`` list when there is one. Otherwise one pass over the form
+    finds the ``item_<n>_hsCode`` keys, and each item is read with direct
+    lookups: items are ordered by index and gaps left by removed rows are
+    skipped.
+    """
+    items = form_data.get('items')
+    if items is not None:
+        if isinstance(items, str):
+            try:
+                items = json.loads(items) if items.strip() else []
+            except ValueError:
+                raise ValueError('items is not valid JSON')
+        if not isinstance(items, list):
+            raise ValueError('items must be a list of objects')
+        return [_parse_item(item.get) for item in items if isinstance(item, dict)]
+
+    indices = []
+    for key in form_data:
+        if key.endswith('_hsCode') and key.startswith('item_'):
+            index = key[5:-7]
+            if index.isdigit():
+                indices.append(int(index))
+    indices.sort()
+    get = form_data.get
+    return [_parse_item(get, f'item_{index}_') for index in indices]
+
+BUILDERS = {scenario_id: compile_builder(scenario_id, scenario) for scenario_id, scenario in SCENARIOS.items()}
+
+def build(scenario_id, form_data):
+    """Build the FBR payload for a scenario from form-style data"""
+    builder = BUILDERS.get(scenario_id)
+    if builder is None:
+        raise ValueError(f'Scenario {scenario_id} not implemented yet')
+    return builder(form_data)
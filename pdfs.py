@@ -0,0 +1,194 @@
+"""Background PDF rendering and cached PDF artifacts.
+
+WeasyPrint runs in a process pool so it never blocks a Flask worker. Each
+artifact is stored as ``static/pdfs/<invoice_number>-<hash>.pdf`` where the hash
+covers the invoice payload and the invoice template version: a PDF on disk is
+served as-is while it matches, and is re-rendered as soon as either changes.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import assets
+
+log = logging.getLogger(__name__)
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Made absolute: send_file() resolves relative paths against the app directory, not the cwd
+PDF_FOLDER = os.path.abspath(os.environ.get('FBR_PDF_DIR') or os.path.join(APP_DIR, "static", "pdfs"))
+# Stylesheet of templates/invoice.html, parsed once per render process
+INVOICE_CSS = "css/invoice.css"
+INVOICE_CSS_PATH = os.path.join(assets.STATIC_DIR, INVOICE_CSS)
+PDF_WORKERS = int(os.environ.get('FBR_PDF_WORKERS', min(4, os.cpu_count() or 1)))
+# How long a download request waits for a render before answering "pending"
+PDF_WAIT_SECONDS = float(os.environ.get('FBR_PDF_WAIT_SECONDS', 20))
+# Render each invoice's PDF as soon as it is saved; 0 renders on first download only
+PRERENDER = os.environ.get('FBR_PDF_PRERENDER', '1') != '0'
+
+_pool = None
+_pool_pid = None
+_pending = {}   # artifact path -> Future
+_failed = {}    # invoice number -> error message of the last failed render
+# Re-entrant: a done-callback runs inline when the future has already finished
+_lock = threading.RLock()
+
+
+def content_hash(payload, template_version):
+    """Hash identifying a rendered PDF: changes when the payload or template changes"""
+    digest = hashlib.sha256(template_version.encode())
+    digest.update(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode())
+    return digest.hexdigest()[:16]
+
+def artifact_path(invoice_number, pdf_hash):
+    return os.path.join(PDF_FOLDER, f"{invoice_number}-{pdf_hash}.pdf")
+
+def status(invoice_number, pdf_hash):
+    """'ready', 'pending', 'failed' or 'missing'"""
+    path = artifact_path(invoice_number, pdf_hash)
+    if os.path.exists(path):
+        return 'ready'
+    with _lock:
+        if path in _pending:
+            return 'pending'
+        if invoice_number in _failed:
+            return 'failed'
+    return 'missing'
+
+def last_error(invoice_number):
+    with _lock:
+        return _failed.get(invoice_number)
+
+def submit(invoice_number, pdf_hash, html, base_url=assets.BASE_URL):
+    """Queue a render unless a fresh artifact exists or one is already queued; returns a Future of the path"""
+    path = artifact_path(invoice_number, pdf_hash)
+    if os.path.exists(path):
+        future = Future()
+        future.set_result(path)
+        return future
+
+    with _lock:
+        future = _pending.get(path)
+        if future is None:
+            future = _get_pool().submit(_render, html, base_url, path)
+            _pending[path] = future
+            _failed.pop(invoice_number, None)
+            future.add_done_callback(lambda f: _finished(invoice_number, path, f))
+    return future
+
+def _finished(invoice_number, path, future):
+    with _lock:
+        _pending.pop(path, None)
+        error = future.exception()
+        if error is not None:
+            log.error("PDF render for %s failed: %s", invoice_number, error)
+            _failed[invoice_number] = str(error)
+            return
+    _remove_stale(invoice_number, path)
+
+def _remove_stale(invoice_number, keep_path):
+    pattern = os.path.join(PDF_FOLDER, f"{glob.escape(invoice_number)}-*.pdf")
+    # Plain <invoice_number>.pdf files were written before artifacts were hashed
+    stale = glob.glob(pattern) + glob.glob(os.path.join(PDF_FOLDER, f"{glob.escape(invoice_number)}.pdf"))
+    for path in stale:
+        if path != keep_path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def _get_pool():
+    global _pool, _pool_pid
+    # A pool inherited across fork() has no live workers in the child, and a
+    # pool whose worker crashed refuses new work
+    if _pool is None or _pool_pid != os.getpid() or getattr(_pool, '_broken', False):
+        _pool = make_pool(PDF_WORKERS)
+        _pool_pid = os.getpid()
+    return _pool
+
+def make_pool(workers):
+    """A process pool whose workers parse the invoice stylesheet and fonts once"""
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(INVOICE_CSS,))
+
+def start():
+    """Start the render processes now rather than on the first render"""
+    # Forking pools launch every process on the first submit
+    _get_pool().submit(os.getpid)
+
+def is_healthy():
+    """False once a render process of this process's pool has died"""
+    return _pool is None or _pool_pid != os.getpid() or not getattr(_pool, '_broken', False)
+
+def warm_up():
+    """Import WeasyPrint, set up fonts and parse the invoice CSS in this process.
+
+    Render processes forked from it later inherit all of that instead of doing it again.
+    """
+    _load(INVOICE_CSS)
+
+def shutdown():
+    global _pool
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.shutdown(wait=True)
+    _pool = None
+
+
+# ---------------- WORKER PROCESS -----------------
+_stylesheets = None
+_font_config = None
+_url_fetcher = None
+
+def _init_worker(css_name):
+    """Set up a render process, once instead of for every document"""
+    # Forked from a server, whose signal handlers would keep this process
+    # alive on SIGTERM: take the defaults, and leave Ctrl-C to the server
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    threading.Thread(target=_exit_with_parent, args=(os.getppid(),), name='parent-watch', daemon=True).start()
+    _load(css_name)
+
+def _exit_with_parent(parent_pid):
+    # A server killed outright never shuts its pool down; don't linger after it
+    while os.getppid() == parent_pid:
+        time.sleep(1)
+    os._exit(1)
+
+def _load(css_name):
+    """Load the static assets, parse the invoice CSS and set up fonts"""
+    global _stylesheets, _font_config, _url_fetcher
+    if _stylesheets is not None:
+        # Already done, or inherited from a process that warmed up before forking
+        return
+    from weasyprint import CSS
+    from weasyprint.text.fonts import FontConfiguration
+
+    assets.preload()
+    _url_fetcher = assets.url_fetcher()
+    _font_config = FontConfiguration()
+    _stylesheets = [CSS(string=assets.get(css_name).decode("utf-8"), base_url=assets.BASE_URL + "static/" + css_name,
+                        url_fetcher=_url_fetcher, font_config=_font_config)]
+
+def render_html(html, base_url=assets.BASE_URL, target=None):
+    """Convert invoice HTML (rendered with ``pdf=True``) to a PDF file, or to bytes if no target.
+
+    Everything the document refers to is served from memory by assets.url_fetcher().
+    """
+    from weasyprint import HTML
+
+    _load(INVOICE_CSS)
+    return HTML(string=html, base_url=base_url, url_fetcher=_url_fetcher).write_pdf(
+        target, stylesheets=_stylesheets, font_config=_font_config
+    )
+
+def _render(html, base_url, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write under a temporary name so a half-written PDF is never served
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    render_html(html, base_url, tmp_path)
+    os.replace(tmp_path, path)
+    return path
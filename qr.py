@@ -0,0 +1,126 @@
+"""Invoice QR codes, generated in memory.
+
+Images are produced as PNG or SVG bytes and kept in a size-bounded LRU cache.
+Set ``FBR_QR_PERSIST=1`` to also store them in the ``qr_codes`` table so they
+survive restarts without being re-encoded.
+"""
+import base64
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+import qrcode
+import qrcode.image.svg
+
+import metrics
+import storage
+
+QR_CACHE_BYTES = int(os.environ.get('FBR_QR_CACHE_BYTES', 16 * 1024 * 1024))
+QR_PERSIST = os.environ.get('FBR_QR_PERSIST') == '1'
+
+# Part of every ETag: bump when the QR settings below change the image
+QR_STYLE_VERSION = 'v2-L-3-4'
+
+MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+
+class LRUBytesCache:
+    """Thread-safe LRU cache bounded by the total size of its values"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def __len__(self):
+        return len(self._items)
+
+
+_cache = LRUBytesCache(QR_CACHE_BYTES)
+
+
+def image_bytes(invoice_number, fmt='png', persist=QR_PERSIST):
+    """QR code image for an invoice number as PNG or SVG bytes"""
+    key = (invoice_number, fmt)
+    data = _cache.get(key)
+    if data is not None:
+        return data
+
+    data = _load(invoice_number, fmt) if persist else None
+    if data is None:
+        with metrics.timer('qr_encode'):
+            data = _encode(invoice_number, fmt)
+            if persist:
+                storage.write(_store, invoice_number, fmt, data)
+    _cache.put(key, data)
+    return data
+
+def data_uri(invoice_number, fmt='png'):
+    """QR code as a data: URI, for embedding in rendered PDFs without a file"""
+    encoded = base64.b64encode(image_bytes(invoice_number, fmt)).decode('ascii')
+    return f"data:{MIMETYPES[fmt]};base64,{encoded}"
+
+def warm_up():
+    """Load the encoder and image writers now, so the first invoice doesn't wait for them"""
+    for fmt in MIMETYPES:
+        _encode('0', fmt)
+
+def etag(invoice_number, fmt='png'):
+    """Strong ETag, derived from the inputs so it can be checked without encoding the image"""
+    return hashlib.sha1(f"{invoice_number}:{fmt}:{QR_STYLE_VERSION}".encode()).hexdigest()
+
+
+def _encode(invoice_number, fmt):
+    # STRICT Version 2 (25x25 modules); fit=False keeps FBR's required size
+    qr = qrcode.QRCode(
+        version=2,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=3,
+        border=4,
+        image_factory=qrcode.image.svg.SvgPathImage if fmt == 'svg' else None,
+    )
+    qr.add_data(invoice_number)
+    qr.make(fit=False)
+
+    buffer = io.BytesIO()
+    if fmt == 'svg':
+        qr.make_image().save(buffer)
+    else:
+        qr.make_image(fill_color="black", back_color="white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def _load(invoice_number, fmt):
+    row = storage.get_connection().execute(
+        "SELECT image FROM qr_codes WHERE invoice_number = ? AND format = ?",
+        (invoice_number, fmt)
+    ).fetchone()
+    return bytes(row["image"]) if row else None
+
+def _store(conn, invoice_number, fmt, data):
+    conn.execute(
+        "INSERT OR IGNORE INTO qr_codes (invoice_number, format, image) VALUES (?, ?, ?)",
+        (invoice_number, fmt, data)
+    )
@@ -0,0 +1,322 @@
+"""Reference data: HS codes, units of measure, rates and SRO references.
+
+FBR refuses an invoice with an HS code, unit of measure or SRO reference it
+doesn't know, but only after a full round-trip. Its reference lists are kept
+in ``invoices.db`` instead, so the invoice form can suggest entries as they are
+typed (``/ref/<kind>``) and validation can check them without a network call.
+The lists (``KINDS``):
+
+- ``hs_codes``: HS codes with their descriptions
+- ``uoms``: units of measure
+- ``rates``: sales tax rates, per scenario
+- ``sro_schedules``: SRO schedules, per scenario
+- ``sro_items``: SRO item serial numbers, per SRO schedule
+
+Each list is replaced as a whole, from a CSV or JSON file (``flask
+load-refdata``) or, for the lists FBR publishes as a whole, from its reference
+API (``flask refresh-refdata``). Until then they hold the shipped defaults:
+common units of measure, and the rates and SRO references in scenarios.py.
+Entries are found by code prefix through an index, and by the words of their
+codes and descriptions through an FTS5 table, so a lookup takes well under a
+millisecond.
+
+Validation checks HS codes and units of measure only against lists loaded
+from a file or FBR, never against the defaults, and picks up a newly loaded
+list within RELOAD_SECONDS.
+
+    FBR_REFDATA_URL       base URL of FBR's reference API (default https://gw.fbr.gov.pk/pdi/v1/)
+    FBR_REFDATA_MAX_AGE   seconds browsers reuse a /ref answer before asking again (default 300)
+"""
+import csv
+import json
+import os
+import re
+import threading
+import time
+from urllib.parse import urljoin
+
+import fbr_client
+import storage
+from scenarios import SCENARIOS
+
+FBR_URL = os.environ.get('FBR_REFDATA_URL', 'https://gw.fbr.gov.pk/pdi/v1/')
+MAX_AGE = int(os.environ.get('FBR_REFDATA_MAX_AGE', 300))
+# Entries returned per lookup, by default and at most
+SUGGESTIONS = 20
+MAX_SUGGESTIONS = 500
+# How often validation looks for a newly loaded list, in seconds
+RELOAD_SECONDS = 5
+
+# Source recorded for lists holding the shipped defaults
+DEFAULTS = 'defaults'
+
+# kind -> what its entries are grouped by (None: one list), and for lists FBR
+# publishes as a whole, its path in the reference API and the field of its
+# answer holding the code
+KINDS = {
+    'hs_codes': {'scoped_by': None, 'fbr_path': 'itemdesccode', 'code_field': 'hS_CODE'},
+    'uoms': {'scoped_by': None, 'fbr_path': 'uom', 'code_field': 'description'},
+    'rates': {'scoped_by': 'scenario'},
+    'sro_schedules': {'scoped_by': 'scenario'},
+    'sro_items': {'scoped_by': 'SRO schedule'},
+}
+FBR_KINDS = tuple(kind for kind, spec in KINDS.items() if spec.get('fbr_path'))
+# Checked by validation, once loaded from a file or FBR
+VALIDATED = ('hs_codes', 'uoms')
+
+# Units of measure as FBR spells them
+DEFAULT_UOMS = (
+    'Numbers, pieces, units', 'Kilogram', 'KG', '40KG', 'MT', 'Gram', 'Pound', 'Carat', 'Liter', 'Gallon',
+    'Barrels', 'Cubic Metre', 'Meter', 'Foot', 'Square Metre', 'Square Foot', 'SqY', 'Pcs', 'Pair', 'Dozen',
+    'SET', 'Packs', 'Bag', 'Thousand Unit', 'KWH', '1000 kWh', 'Mega Watt', 'MMBTU', 'Timber Logs',
+    'Bill of lading', 'NO', 'Others',
+)
+
+_NON_DIGITS_RE = re.compile(r'\D+')
+_SEARCH_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+# ---------------- ENTRIES -----------------
+def key(kind, code):
+    """What codes are looked up by: HS codes by their digits, so ``0101.21`` and ``010121`` are the same prefix;
+    everything else regardless of case and spacing"""
+    if kind == 'hs_codes':
+        return _NON_DIGITS_RE.sub('', str(code))
+    return _text(code).lower()
+
+def read_file(path):
+    """Rows of a CSV file with a header line, or of a JSON file holding a list of objects"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        with open(path, encoding='utf-8-sig', newline='') as stream:
+            return list(csv.DictReader(stream))
+    if extension == '.json':
+        with open(path, encoding='utf-8-sig') as stream:
+            try:
+                rows = json.load(stream)
+            except ValueError as e:
+                raise ValueError(f'{path} is not valid JSON: {e}')
+        if not isinstance(rows, list):
+            raise ValueError(f'{path} must hold a list of entries')
+        return rows
+    raise ValueError(f'Unsupported reference file {path}: expected .csv or .json')
+
+def default_rows(kind):
+    """The shipped entries of a list"""
+    _checked(kind)
+    if kind == 'uoms':
+        return [{'code': uom} for uom in DEFAULT_UOMS]
+    if kind == 'rates':
+        return [{'scope': scenario_id, 'code': rate}
+                for scenario_id, scenario in SCENARIOS.items()
+                for rate in (scenario.get('rules') or {}).get('rates') or (scenario['tax_rate'],)]
+    if kind == 'sro_schedules':
+        return [{'scope': scenario_id, 'code': scenario['sro'][0]}
+                for scenario_id, scenario in SCENARIOS.items() if scenario.get('sro')]
+    if kind == 'sro_items':
+        return [{'scope': scenario['sro'][0], 'code': scenario['sro'][1]}
+                for scenario in SCENARIOS.values() if scenario.get('sro')]
+    return []
+
+def _entries(kind, rows):
+    """``(scope, code, description)`` of each row with a code.
+
+    Rows have ``code``, ``description`` and ``scope`` keys, or the fields of FBR's answer.
+    """
+    spec = KINDS[kind]
+    for number, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            raise ValueError(f'Entry {number} of {kind} is not an object')
+        code = _text(row.get('code')) or _text(row.get(spec.get('code_field')))
+        if not code:
+            continue
+        scope = _text(row.get('scope')) if spec['scoped_by'] else ''
+        if spec['scoped_by'] and not scope:
+            raise ValueError(f"Entry {number} of {kind} ({code}) has no scope ({spec['scoped_by']})")
+        description = _text(row.get('description'))
+        yield scope, code, '' if description == code else description
+
+def _text(value):
+    return ' '.join(str(value).split()) if value is not None else ''
+
+def _checked(kind):
+    if kind not in KINDS:
+        raise ValueError(f"Unknown reference list {kind!r}, expected one of {', '.join(KINDS)}")
+    return kind
+
+
+# ---------------- LOADING -----------------
+def load(kind, rows, source):
+    """Replace a list on the writer thread; returns the number of entries it now holds"""
+    count = storage.run_write(replace, kind, list(rows), source)
+    _expire_known()
+    return count
+
+def replace(conn, kind, rows, source):
+    """Replace every entry of a list with those of ``rows``, in their order (the first is a list's default).
+
+    Entries whose code repeats an earlier one are dropped. Returns the number kept.
+    """
+    _checked(kind)
+    conn.execute("DELETE FROM reference_fts WHERE rowid IN (SELECT id FROM reference_codes WHERE kind = ?)", (kind,))
+    conn.execute("DELETE FROM reference_codes WHERE kind = ?", (kind,))
+    count = 0
+    for position, (scope, code, description) in enumerate(_entries(kind, rows)):
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO reference_codes (kind, scope, code, code_key, description, position) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, scope, code, key(kind, code), description, position)
+        )
+        if cursor.rowcount:
+            count += 1
+            conn.execute("INSERT INTO reference_fts (rowid, code, description) VALUES (?, ?, ?)",
+                         (cursor.lastrowid, code, description))
+    # Versions only grow, across lists, so an ETag is never reused for different entries
+    version = conn.execute("SELECT COALESCE(MAX(version), 0) + 1 FROM reference_lists").fetchone()[0]
+    conn.execute(
+        "INSERT OR REPLACE INTO reference_lists (kind, source, entry_count, version, loaded_at) "
+        "VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
+        (kind, source, count, version)
+    )
+    return count
+
+def load_defaults(conn, kinds=tuple(KINDS)):
+    for kind in kinds:
+        replace(conn, kind, default_rows(kind), DEFAULTS)
+
+def fetch(kind, token, base_url=FBR_URL):
+    """The entries of a list, from FBR's reference API"""
+    path = KINDS[_checked(kind)].get('fbr_path')
+    if path is None:
+        raise ValueError(f'FBR does not publish {kind} as one list; load it from a file')
+    url = urljoin(base_url if base_url.endswith('/') else base_url + '/', path)
+    response = fbr_client.client.session_for(url).get(
+        url, headers={'Authorization': f'Bearer {token}'}, timeout=fbr_client.client.timeout
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f'FBR answered {response.status_code} for {url}')
+    try:
+        rows = response.json()
+    except ValueError:
+        raise RuntimeError(f'FBR did not answer {url} with JSON')
+    # An empty answer is a fault at FBR's end, not a reason to forget every code
+    if not isinstance(rows, list) or not rows:
+        raise RuntimeError(f'FBR answered {url} without a list of entries')
+    return rows
+
+
+# ---------------- LOOKUPS -----------------
+def search(conn, kind, query='', scope='', limit=SUGGESTIONS):
+    """Up to ``limit`` entries of a list as ``{'code', 'description'}``.
+
+    Entries whose code starts with ``query`` come first, in code order, then
+    those with a word starting with each word of it (in the description or the
+    code, so ``pieces`` finds ``Numbers, pieces, units``), in list order.
+    Without a query, the list in its own order.
+    """
+    _checked(kind)
+    limit = max(1, min(limit, MAX_SUGGESTIONS))
+    query = _text(query)
+    if not query:
+        return [dict(row) for row in conn.execute(
+            "SELECT code, description FROM reference_codes WHERE kind = ? AND scope = ? ORDER BY position LIMIT ?",
+            (kind, scope, limit)
+        )]
+
+    found = []
+    prefix = key(kind, query)
+    if prefix:
+        found = conn.execute(
+            "SELECT code, description FROM reference_codes "
+            "WHERE kind = ? AND scope = ? AND code_key >= ? AND code_key < ? ORDER BY code_key LIMIT ?",
+            (kind, scope, prefix, prefix + '\uffff', limit)
+        ).fetchall()
+    match = _match_expression(query)
+    if match and len(found) < limit:
+        codes = {row["code"] for row in found}
+        # Unranked, in list order, so a common word stops at ``limit`` matches; CROSS JOIN keeps the
+        # FTS table outermost, so the match runs once rather than once per entry
+        found += [row for row in conn.execute(
+            "SELECT c.code, c.description FROM reference_fts "
+            "CROSS JOIN reference_codes c ON c.id = reference_fts.rowid "
+            "WHERE reference_fts MATCH ? AND c.kind = ? AND c.scope = ? LIMIT ?",
+            (match, kind, scope, limit + len(found))
+        ) if row["code"] not in codes][:limit - len(found)]
+    return [dict(row) for row in found]
+
+def lists(conn):
+    """Where each list was loaded from, when, and how many entries it holds"""
+    return [dict(row) for row in conn.execute(
+        "SELECT kind, source, entry_count, version, loaded_at FROM reference_lists ORDER BY kind"
+    )]
+
+def version(conn, kind):
+    """Changes whenever a list is loaded again; 0 before it ever was"""
+    row = conn.execute("SELECT version FROM reference_lists WHERE kind = ?", (kind,)).fetchone()
+    return row["version"] if row else 0
+
+def _match_expression(query):
+    # Quote each word so FTS5 query syntax in user input is taken literally
+    tokens = _SEARCH_TOKEN_RE.findall(query)
+    if not tokens:
+        return None
+    return ' '.join(f'"{token}"*' for token in tokens)
+
+
+# ---------------- VALIDATION -----------------
+class KnownCodes:
+    """The codes of one list, held in memory for checking values without a query"""
+
+    def __init__(self, kind, codes):
+        self.kind = kind
+        self.codes = frozenset(codes)
+        self._by_key = {key(kind, code): code for code in self.codes}
+
+    def __contains__(self, value):
+        return _text(value) in self.codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def suggestion(self, value):
+        """The code a value differs from only in case, spacing or punctuation, if any"""
+        return self._by_key.get(key(self.kind, value))
+
+
+_known = {}      # kind -> KnownCodes, or None while the list holds the defaults
+_known_versions = {}
+_known_checked = float('-inf')
+_known_lock = threading.Lock()
+
+def known(kind):
+    """KnownCodes of a VALIDATED list loaded from a file or FBR, else None (nothing to check against)"""
+    if time.monotonic() - _known_checked > RELOAD_SECONDS:
+        _reload_known()
+    return _known.get(kind)
+
+def _reload_known():
+    global _known_checked
+    with _known_lock:
+        if time.monotonic() - _known_checked <= RELOAD_SECONDS:
+            return
+        # Before init_db() (e.g. validation benchmarks) there is nothing loaded to check against
+        if storage.database_path() is not None:
+            conn = storage.get_connection()
+            loaded = {row["kind"]: row for row in conn.execute("SELECT kind, source, entry_count, version "
+                                                               "FROM reference_lists")}
+            for kind in VALIDATED:
+                row = loaded.get(kind)
+                current = row["version"] if row else 0
+                if _known_versions.get(kind) == current:
+                    continue
+                codes = None
+                if row is not None and row["source"] != DEFAULTS and row["entry_count"]:
+                    codes = KnownCodes(kind, [code for code, in conn.execute(
+                        "SELECT code FROM reference_codes WHERE kind = ?", (kind,))])
+                _known[kind], _known_versions[kind] = codes, current
+        _known_checked = time.monotonic()
+
+def _expire_known():
+    global _known_checked
+    with _known_lock:
+        _known_checked = float('-inf')
@@ -0,0 +1,112 @@
+"""Rendered invoice pages, cached by invoice number and template version.
+
+A saved invoice never changes, so the page at ``/invoice/<invoice_id>`` only
+changes when the invoice template does. Rendered pages are kept in a
+size-bounded LRU in memory (FBR_RENDER_CACHE_BYTES, default 32 MB). When
+FBR_RENDER_CACHE_DIR is set they are also written there, one file per page, so
+pages evicted from memory, or rendered before a restart, are read back instead
+of rendered again. Files for other template versions are removed at startup.
+"""
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+from qr import LRUBytesCache
+
+RENDER_CACHE_BYTES = int(os.environ.get('FBR_RENDER_CACHE_BYTES', 32 * 1024 * 1024))
+RENDER_CACHE_DIR = os.environ.get('FBR_RENDER_CACHE_DIR') or None
+
+# Template versions are short hex digests; nothing else in the directory is touched
+VERSION_NAME = re.compile(r'[0-9a-f]{12}')
+
+
+class Page:
+    """Rendered HTML and when it last changed (a Unix timestamp)"""
+    __slots__ = ('html', 'last_modified')
+
+    def __init__(self, html, last_modified):
+        self.html = html
+        self.last_modified = last_modified
+
+    def __len__(self):
+        return len(self.html)
+
+
+class RenderCache:
+    def __init__(self, version, max_bytes=RENDER_CACHE_BYTES, directory=RENDER_CACHE_DIR):
+        self.version = version
+        self.directory = os.path.join(directory, version) if directory else None
+        self.hits = 0
+        self.misses = 0
+        self._memory = LRUBytesCache(max_bytes)
+        self._lock = threading.Lock()
+        if directory:
+            _remove_other_versions(directory, version)
+            os.makedirs(self.directory, exist_ok=True)
+
+    def etag(self, invoice_number):
+        """Strong ETag of an invoice's page, known without reading or rendering the invoice"""
+        return hashlib.sha1(f"{invoice_number}:{self.version}".encode()).hexdigest()
+
+    def get(self, invoice_number):
+        page = self._memory.get(invoice_number)
+        if page is None and self.directory:
+            page = self._read(invoice_number)
+            if page is not None:
+                self._memory.put(invoice_number, page)
+        with self._lock:
+            if page is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return page
+
+    def put(self, invoice_number, html, last_modified):
+        page = Page(html, last_modified)
+        self._memory.put(invoice_number, page)
+        if self.directory:
+            self._write(invoice_number, page)
+        return page
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._memory), 'bytes': self._memory.size}
+
+    def _path(self, invoice_number):
+        return os.path.join(self.directory, hashlib.sha1(invoice_number.encode()).hexdigest() + '.html')
+
+    def _read(self, invoice_number):
+        try:
+            with open(self._path(invoice_number), 'rb') as page_file:
+                return Page(page_file.read(), os.fstat(page_file.fileno()).st_mtime)
+        except OSError:
+            return None
+
+    def _write(self, invoice_number, page):
+        # Written under a temporary name and renamed, so readers never see half a page
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as page_file:
+                page_file.write(page.html)
+            # The file's mtime carries Last-Modified across restarts
+            os.utime(temp_path, (page.last_modified, page.last_modified))
+            os.replace(temp_path, self._path(invoice_number))
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+
+def _remove_other_versions(directory, version):
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name != version and VERSION_NAME.fullmatch(name) and os.path.isdir(os.path.join(directory, name)):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
@@ -0,0 +1,157 @@
+"""Sales tax reporting.
+
+Two daily aggregate tables are updated in the same transaction that saves an
+invoice, so summaries for any period are answered from the aggregates and never
+scan or parse the raw invoices:
+
+- ``daily_invoice_totals``: per day, scenario, buyer province and buyer type,
+  with invoice counts.
+- ``daily_item_totals``: per day, scenario, rate, HS code, buyer province and
+  buyer type, with line counts, for summaries by rate or HS code.
+
+The day is the invoice date, or the date it was saved when the invoice has
+none. Amounts are integer paisa, like the invoice totals columns.
+"""
+import archive
+import payload_codec
+import totals
+
+REBUILD_BATCH_SIZE = 1000
+
+# Report dimension -> column in the aggregate tables
+DIMENSIONS = {
+    'day': 'day',
+    'month': 'substr(day, 1, 7)',
+    'scenario': 'scenario_id',
+    'province': 'buyer_province',
+    'buyer_type': 'buyer_type',
+    'rate': 'rate',
+    'hs_code': 'hs_code',
+}
+# Dimensions only the per-item table has
+ITEM_DIMENSIONS = {'rate', 'hs_code'}
+
+AMOUNT_COLUMNS = ('value_excl_st', 'sales_tax', 'further_tax', 'discount', 'total')
+
+_INVOICE_KEY = ('day', 'scenario_id', 'buyer_province', 'buyer_type')
+_ITEM_KEY = ('day', 'scenario_id', 'rate', 'hs_code', 'buyer_province', 'buyer_type')
+
+
+def _upsert_sql(table, key, count_column):
+    columns = key + (count_column,) + AMOUNT_COLUMNS
+    updates = ', '.join(f'{column} = {column} + excluded.{column}' for column in (count_column,) + AMOUNT_COLUMNS)
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT ({', '.join(key)}) DO UPDATE SET {updates}"
+    )
+
+_UPSERT_INVOICE_SQL = _upsert_sql('daily_invoice_totals', _INVOICE_KEY, 'invoice_count')
+_UPSERT_ITEM_SQL = _upsert_sql('daily_item_totals', _ITEM_KEY, 'line_count')
+
+
+def add_invoice(conn, scenario_id, payload, day=None):
+    """Add one saved invoice to the daily aggregates. Runs inside the transaction that saved it."""
+    day = _key(payload.get('invoiceDate'))[:10] or day or conn.execute("SELECT date('now')").fetchone()[0]
+    province = _key(payload.get('buyerProvince'))
+    buyer_type = _key(payload.get('buyerRegistrationType'))
+    items = [item for item in payload.get('items') or [] if isinstance(item, dict)]
+    lines, invoice_totals = totals.invoice_totals(items)
+
+    conn.execute(_UPSERT_INVOICE_SQL, (day, scenario_id, province, buyer_type, 1) + _paisa(invoice_totals, 'grand_total'))
+
+    # Lines sharing a key are summed first: one upsert per key instead of per line
+    grouped = {}
+    for item, line in zip(items, lines):
+        key = (day, scenario_id, _key(item.get('rate')), _key(item.get('hsCode')), province, buyer_type)
+        sums = grouped.setdefault(key, [0] * (len(AMOUNT_COLUMNS) + 1))
+        for index, amount in enumerate((1,) + _paisa(line, 'line_total')):
+            sums[index] += amount
+    conn.executemany(_UPSERT_ITEM_SQL, [key + tuple(sums) for key, sums in grouped.items()])
+
+def rebuild(conn, batch_size=REBUILD_BATCH_SIZE):
+    """Recompute both aggregate tables from the saved invoices, archived ones included.
+
+    Returns the number of invoices read.
+    """
+    conn.execute("DELETE FROM daily_invoice_totals")
+    conn.execute("DELETE FROM daily_item_totals")
+    count = _aggregate(conn, conn, batch_size)
+    for period in archive.periods():
+        count += _aggregate(conn, archive.connection(period), batch_size)
+    return count
+
+def _aggregate(conn, source, batch_size):
+    """Add every invoice of ``source`` (invoices.db or an archive file) to the aggregates in ``conn``"""
+    count, last_id = 0, 0
+    while True:
+        rows = source.execute(
+            "SELECT id, scenario_id, payload, date(created_at) AS created_day FROM invoices "
+            "WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            return count
+        for row in rows:
+            try:
+                payload = payload_codec.decode(row["payload"] or '{}', source)
+            except ValueError:
+                payload = {}
+            add_invoice(conn, row["scenario_id"] or '', payload if isinstance(payload, dict) else {},
+                        day=row["created_day"])
+        count += len(rows)
+        last_id = rows[-1]["id"]
+
+
+# ---------------- QUERIES -----------------
+def summary(conn, group_by=(), date_from=None, date_to=None, scenario_id=None):
+    """Totals for a period, grouped by the given dimensions (see DIMENSIONS).
+
+    Dates are ``YYYY-MM-DD`` (inclusive). Returns a list of dicts holding the
+    dimension values, ``invoice_count`` (or ``line_count`` when grouping by
+    rate or HS code, since one invoice can span several rates) and the amounts
+    as Decimals.
+    """
+    unknown = [dimension for dimension in group_by if dimension not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Unknown report dimension(s): {', '.join(unknown)}. Use {', '.join(DIMENSIONS)}")
+
+    by_item = any(dimension in ITEM_DIMENSIONS for dimension in group_by)
+    table, count_column = ('daily_item_totals', 'line_count') if by_item else ('daily_invoice_totals', 'invoice_count')
+
+    conditions, params = [], []
+    if date_from:
+        conditions.append("day >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("day <= ?")
+        params.append(date_to)
+    if scenario_id:
+        conditions.append("scenario_id = ?")
+        params.append(scenario_id)
+
+    selected = [f"{DIMENSIONS[dimension]} AS {dimension}" for dimension in group_by]
+    selected += [f"SUM({column}) AS {column}" for column in (count_column,) + AMOUNT_COLUMNS]
+    sql = f"SELECT {', '.join(selected)} FROM {table}"
+    if conditions:
+        sql += f" WHERE {' AND '.join(conditions)}"
+    if group_by:
+        positions = ', '.join(str(position) for position in range(1, len(group_by) + 1))
+        sql += f" GROUP BY {positions} ORDER BY {positions}"
+
+    results = []
+    for row in conn.execute(sql, params):
+        result = dict(row)
+        if result[count_column] is None:
+            continue   # no data in the period
+        for column in AMOUNT_COLUMNS:
+            result[column] = totals.from_paisa(result[column])
+        results.append(result)
+    return results
+
+
+def _paisa(figures, total_key):
+    return tuple(totals.to_paisa(figures[total_key if column == 'total' else column]) for column in AMOUNT_COLUMNS)
+
+def _key(value):
+    # Part of a primary key: NULLs would never match each other, so missing values are ''
+    return '' if value is None else str(value).strip()
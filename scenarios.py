@@ -0,0 +1,246 @@
+"""FBR Digital Invoicing scenarios supported by the app.
+
+Each entry drives the scenario card and form (name, description, info), the
+form defaults (buyer_type, tax_rate, sale_type, and sro: the SRO schedule and
+item serial number items start with), the payload builder in
+payloads.py (payload_defaults: header fields whose default differs from the
+common one) and local validation in validation.py (rules):
+
+- rates: the only item rates allowed, e.g. ('18%',)
+- reduced_rate: items must use a rate above 0% and below the 18% standard rate
+- sro_required: items need an SRO schedule and SRO item serial number
+- fixed_value_required: items need a fixed/notified value or retail price
+- tax_on_retail_price: sales tax may be charged on the retail price instead of
+  the value excluding sales tax (3rd Schedule goods)
+- buyer_types: buyer registration types allowed (default: buyer_type only)
+"""
+
+SCENARIOS = {
+    'SN001': {
+        'name': 'Standard Rate - Registered Buyer (B2B)',
+        'description': 'Sale to registered business at 18% standard rate',
+        'buyer_type': 'Registered',
+        'tax_rate': '18%',
+        'sale_type': 'Goods at standard rate (default)',
+        'rules': {'rates': ('18%',)},
+        'info': {
+            'title': 'Business-to-Business (B2B) Sale',
+            'points': [
+                'Tax Rate: Standard rate (18%)',
+                'Buyer Type: Sales-tax registered',
+                'Input Tax Credit: Buyer can claim credit when filing',
+                'Use Case: Regular business sales of taxable goods'
+            ]
+        }
+    },
+    'SN002': {
+        'name': 'Standard Rate - Unregistered Buyer (B2C)',
+        'description': 'Sale to unregistered buyer/consumer at 18% standard rate',
+        'buyer_type': 'Unregistered',
+        'tax_rate': '18%',
+        'sale_type': 'Goods at standard rate (default)',
+        'rules': {'rates': ('18%',)},
+        'info': {
+            'title': 'Business-to-Consumer (B2C) Sale',
+            'points': [
+                'Tax Rate: Standard rate (18%)',
+                'Buyer Type: Not sales-tax registered (end consumer)',
+                'Input Tax Credit: Buyer CANNOT claim credit',
+                'Use Case: Selling products to end consumers'
+            ]
+        }
+    },
+    'SN005': {
+        'name': 'Reduced-Rate Sale',
+        'description': 'Sale of goods at reduced tax rate (lower than standard 18%)',
+        'buyer_type': 'Unregistered',
+        'tax_rate': '1%',
+        'sale_type': 'Goods at Reduced Rate',
+        'sro': ('EIGHTH SCHEDULE Table 1', '82'),
+        'rules': {'reduced_rate': True, 'sro_required': True},
+        'info': {
+            'title': 'Reduced-Rate Goods Sale',
+            'points': [
+                'Tax Rate: Reduced rate (1% or other lower rate, not standard 18%)',
+                'Applicable when law sets a lower tax percentage',
+                'Buyer Type: Unregistered',
+                'Requires correct reduced tax rate in invoice',
+                'SRO Schedule reference required'
+            ]
+        }
+    },
+    'SN006': {
+        'name': 'Exempt Goods Sale',
+        'description': 'Sale of goods that are exempt from Sales Tax',
+        'buyer_type': 'Registered',
+        'tax_rate': 'Exempt',
+        'sale_type': 'Exempt goods',
+        'sro': ('6th Schd Table I', '100'),
+        'rules': {'rates': ('Exempt',), 'sro_required': True},
+        'info': {
+            'title': 'Sales Tax Exempt Goods',
+            'points': [
+                'Tax Rate: Exempt (no sales tax charged)',
+                'Buyer Type: Registered',
+                'No normal sales tax is charged',
+                'Invoice must be marked as exempt sale',
+                'SRO Schedule reference required (e.g., 6th Schedule Table I)'
+            ]
+        }
+    },
+    'SN007': {
+        'name': 'Zero-Rated Sale',
+        'description': 'Sale of goods taxed at zero rate (exports & certain goods)',
+        'buyer_type': 'Unregistered',
+        'tax_rate': '0%',
+        'sale_type': 'Goods at zero-rate',
+        'payload_defaults': {'invoiceRefNo': '0'},
+        'sro': ('327(I)/2008', '1'),
+        'rules': {'rates': ('0%',), 'sro_required': True},
+        'info': {
+            'title': 'Zero-Rated Goods Sale',
+            'points': [
+                'Tax Rate: Zero-rate (0% - tax applied but at zero)',
+                'Buyer Type: Unregistered',
+                'Buyers may still claim input tax credit',
+                'Common for exports and internationally traded goods',
+                'SRO number required (e.g., 327(I)/2008)'
+            ]
+        }
+    },
+    'SN008': {
+        'name': 'Sale of 3rd Schedule Goods',
+        'description': 'Goods listed in 3rd Schedule with special tax treatment',
+        'buyer_type': 'Unregistered',
+        'tax_rate': '18%',
+        'sale_type': '3rd Schedule Goods',
+        'payload_defaults': {'invoiceRefNo': '0'},
+        'rules': {'fixed_value_required': True, 'tax_on_retail_price': True},
+        'info': {
+            'title': '3rd Schedule Goods Sale',
+            'points': [
+                'Tax Rate: Standard 18% (or as per specific SRO)',
+                'Goods listed in 3rd Schedule of Sales Tax Act',
+                'Special tax treatment or specific pricing master rules',
+                'Buyer Type: Unregistered',
+                'Examples: daily-essential items, regulated products',
+                'Fixed/Notified value may be required'
+            ]
+        }
+    },
+    'SN016': {
+        'name': 'Processing/Conversion of Goods',
+        'description': 'Processing or converting goods (toll manufacturing)',
+        'buyer_type': 'Unregistered',
+        'tax_rate': '5%',
+        'sale_type': 'Processing/Conversion of Goods',
+        'rules': {'rates': ('5%',)},
+        'info': {
+            'title': 'Processing/Conversion Service',
+            'points': [
+                'Tax Rate: 5%',
+                'Activity: Processing or converting goods on behalf of someone',
+                'Buyer Type: Unregistered',
+                'Common in toll processing/manufacturing arrangements',
+                'Buyer may not be typical reseller',
+                'Service-based transaction'
+            ]
+        }
+    },
+    'SN017': {
+        'name': 'Goods with FED in ST Mode',
+        'description': 'Goods where FED is charged in Sales Tax mode',
+        'buyer_type': 'Unregistered',
+        'tax_rate': '8%',
+        'sale_type': 'Goods (FED in ST Mode)',
+        'rules': {},
+        'info': {
+            'title': 'FED in Sales Tax Mode',
+            'points': [
+                'Tax Rate: 8% (or as applicable)',
+                'Federal Excise Duty (FED) applied in sales tax mode',
+                'Buyer Type: Unregistered',
+                'Requires correct FED fields in invoice',
+                'Both sales tax and FED may apply',
+                'Assign correct rates for both taxes'
+            ]
+        }
+    },
+    'SN024': {
+        'name': 'Goods per SRO 297(I)/2023',
+        'description': 'Goods with unique tax rules under SRO 297(I)/2023',
+        'buyer_type': 'Unregistered',
+        'tax_rate': '25%',
+        'sale_type': 'Goods as per SRO.297(|)/2023',
+        'sro': ('297(I)/2023-Table-I', '12'),
+        'rules': {'sro_required': True, 'fixed_value_required': True},
+        'info': {
+            'title': 'SRO 297(I)/2023 Specific Goods',
+            'points': [
+                'Tax Rate: 25% (or as defined in SRO)',
+                'Goods specifically defined in SRO 297(I)/2023',
+                'Buyer Type: Unregistered',
+                'Unique tax rules or fixed sales tax percentage',
+                'May have mandated schedules or fixed notified values',
+                'SRO Schedule and Item Serial No. required'
+            ]
+        }
+    },
+    'SN026': {
+        'name': 'Retail Sale - Standard Rate (B2C)',
+        'description': 'Retail sale to end consumer at standard 18% rate',
+        'buyer_type': 'Unregistered',
+        'tax_rate': '18%',
+        'sale_type': 'Goods at standard rate (default)',
+        'rules': {'rates': ('18%',)},
+        'info': {
+            'title': 'Retail B2C Sale - Standard Rate',
+            'points': [
+                'Tax Rate: Standard 18%',
+                'Buyer Type: End consumer (unregistered)',
+                'Retail business-to-consumer transaction',
+                'Tax clearly applied at standard rate',
+                'Typical retail store sale to individual customer'
+            ]
+        }
+    },
+    'SN027': {
+        'name': 'Retail Sale - 3rd Schedule Goods',
+        'description': 'Retail sale of 3rd Schedule goods to consumer',
+        'buyer_type': 'Unregistered',
+        'tax_rate': '18%',
+        'sale_type': '3rd Schedule Goods',
+        'rules': {'fixed_value_required': True, 'tax_on_retail_price': True},
+        'info': {
+            'title': 'Retail B2C Sale - 3rd Schedule Goods',
+            'points': [
+                'Tax Rate: 18% (or as per schedule)',
+                'Buyer Type: End consumer (unregistered)',
+                'Goods from 3rd Schedule (special tax rules)',
+                'Specific pricing and SRO schedule requirements',
+                'Regulated consumer products sold by retailers',
+                'Fixed/Notified value may be required'
+            ]
+        }
+    },
+    'SN028': {
+        'name': 'Retail Sale - Reduced Rate (B2C)',
+        'description': 'Retail sale to consumer at reduced tax rate',
+        'buyer_type': 'Unregistered',
+        'tax_rate': '1%',
+        'sale_type': 'Goods at Reduced Rate',
+        'sro': ('EIGHTH SCHEDULE Table 1', '70'),
+        'rules': {'reduced_rate': True, 'sro_required': True, 'fixed_value_required': True},
+        'info': {
+            'title': 'Retail B2C Sale - Reduced Rate',
+            'points': [
+                'Tax Rate: Reduced rate (1% or other lower rate)',
+                'Buyer Type: End consumer (unregistered)',
+                'Retail B2C transaction',
+                'Reduced rate must be correctly applied',
+                'SRO Schedule reference required',
+                'Fixed/Notified value required'
+            ]
+        }
+    }
+}
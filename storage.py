@@ -0,0 +1,422 @@
+"""SQLite storage layer.
+
+The schema is created and migrated once, when the app starts, using
+``PRAGMA user_version`` to remember which migrations already ran. Reads use one
+long-lived connection per thread. All writes are funnelled through a single
+writer thread that commits queued writes together, so concurrent submits don't
+fight over the database file lock.
+"""
+import atexit
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+log = logging.getLogger(__name__)
+
+# Applied to every connection. WAL lets readers carry on while the writer commits.
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),   # safe with WAL, avoids an fsync per commit
+    ('cache_size', -16000),      # ~16 MB page cache per connection
+    ('mmap_size', 268435456),    # map up to 256 MB of the file
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', 5000),
+    ('foreign_keys', 'ON'),
+)
+
+# Writes committed together in one transaction by the writer thread
+WRITE_BATCH_SIZE = 64
+
+# Schema migrations, applied in order. Each entry is SQL or a function taking a
+# connection. Never edit an entry once released; append a new one instead.
+MIGRATIONS = [
+    # 1: invoices saved after FBR returns an invoiceNumber
+    """
+    CREATE TABLE IF NOT EXISTS invoices (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        invoice_number TEXT UNIQUE,
+        scenario_id TEXT,
+        payload TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    # 2: optional persistent copies of generated QR code images (FBR_QR_PERSIST=1)
+    """
+    CREATE TABLE IF NOT EXISTS qr_codes (
+        invoice_number TEXT NOT NULL,
+        format TEXT NOT NULL,
+        image BLOB NOT NULL,
+        PRIMARY KEY (invoice_number, format)
+    ) WITHOUT ROWID
+    """,
+    # 3: normalised header columns and line items, indexed for lookups and reporting
+    """
+    ALTER TABLE invoices ADD COLUMN invoice_type TEXT;
+    ALTER TABLE invoices ADD COLUMN invoice_date TEXT;
+    ALTER TABLE invoices ADD COLUMN invoice_ref_no TEXT;
+    ALTER TABLE invoices ADD COLUMN seller_ntn_cnic TEXT;
+    ALTER TABLE invoices ADD COLUMN seller_business_name TEXT;
+    ALTER TABLE invoices ADD COLUMN seller_province TEXT;
+    ALTER TABLE invoices ADD COLUMN buyer_ntn_cnic TEXT;
+    ALTER TABLE invoices ADD COLUMN buyer_business_name TEXT;
+    ALTER TABLE invoices ADD COLUMN buyer_province TEXT;
+    ALTER TABLE invoices ADD COLUMN buyer_registration_type TEXT;
+    ALTER TABLE invoices ADD COLUMN item_count INTEGER;
+
+    CREATE TABLE invoice_items (
+        id INTEGER PRIMARY KEY,
+        invoice_id INTEGER NOT NULL REFERENCES invoices(id) ON DELETE CASCADE,
+        line_no INTEGER NOT NULL,
+        hs_code TEXT,
+        product_description TEXT,
+        rate TEXT,
+        uom TEXT,
+        quantity REAL,
+        total_values REAL,
+        value_sales_excluding_st REAL,
+        fixed_notified_value REAL,
+        sales_tax_applicable REAL,
+        sales_tax_withheld_at_source REAL,
+        extra_tax REAL,
+        further_tax REAL,
+        fed_payable REAL,
+        discount REAL,
+        sro_schedule_no TEXT,
+        sro_item_serial_no TEXT,
+        sale_type TEXT
+    );
+
+    CREATE INDEX idx_invoices_created_at ON invoices (created_at);
+    CREATE INDEX idx_invoices_scenario_id ON invoices (scenario_id, created_at);
+    CREATE INDEX idx_invoices_buyer_ntn_cnic ON invoices (buyer_ntn_cnic);
+    CREATE INDEX idx_invoices_seller_ntn_cnic ON invoices (seller_ntn_cnic);
+    CREATE INDEX idx_invoices_invoice_date ON invoices (invoice_date);
+    CREATE INDEX idx_invoice_items_invoice_id ON invoice_items (invoice_id, line_no);
+    CREATE INDEX idx_invoice_items_hs_code ON invoice_items (hs_code)
+    """,
+    # 4: full-text search over buyer names and product descriptions (rowid = invoices.id)
+    """
+    CREATE VIRTUAL TABLE invoices_fts USING fts5(
+        buyer_business_name, product_descriptions, tokenize = 'unicode61 remove_diacritics 2'
+    );
+    INSERT INTO invoices_fts (rowid, buyer_business_name, product_descriptions)
+        SELECT i.id, i.buyer_business_name,
+               (SELECT group_concat(product_description, ' ') FROM invoice_items WHERE invoice_id = i.id)
+        FROM invoices i
+    """,
+    # 5: totals computed at write time; money columns hold integer paisa (1/100 rupee)
+    """
+    ALTER TABLE invoices ADD COLUMN total_value_excl_st INTEGER;
+    ALTER TABLE invoices ADD COLUMN total_sales_tax INTEGER;
+    ALTER TABLE invoices ADD COLUMN total_further_tax INTEGER;
+    ALTER TABLE invoices ADD COLUMN total_discount INTEGER;
+    ALTER TABLE invoices ADD COLUMN grand_total INTEGER;
+    ALTER TABLE invoice_items ADD COLUMN unit_price INTEGER;
+    ALTER TABLE invoice_items ADD COLUMN line_total INTEGER;
+
+    CREATE INDEX idx_invoices_grand_total ON invoices (grand_total)
+    """,
+    # 6: normalise invoices saved before the header, item and total columns above existed
+    lambda conn: _invoices().backfill(conn),
+    # 7: daily sales tax aggregates for reporting (see reports.py); amounts in paisa
+    """
+    CREATE TABLE daily_invoice_totals (
+        day TEXT NOT NULL,
+        scenario_id TEXT NOT NULL,
+        buyer_province TEXT NOT NULL,
+        buyer_type TEXT NOT NULL,
+        invoice_count INTEGER NOT NULL,
+        value_excl_st INTEGER NOT NULL,
+        sales_tax INTEGER NOT NULL,
+        further_tax INTEGER NOT NULL,
+        discount INTEGER NOT NULL,
+        total INTEGER NOT NULL,
+        PRIMARY KEY (day, scenario_id, buyer_province, buyer_type)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE daily_item_totals (
+        day TEXT NOT NULL,
+        scenario_id TEXT NOT NULL,
+        rate TEXT NOT NULL,
+        hs_code TEXT NOT NULL,
+        buyer_province TEXT NOT NULL,
+        buyer_type TEXT NOT NULL,
+        line_count INTEGER NOT NULL,
+        value_excl_st INTEGER NOT NULL,
+        sales_tax INTEGER NOT NULL,
+        further_tax INTEGER NOT NULL,
+        discount INTEGER NOT NULL,
+        total INTEGER NOT NULL,
+        PRIMARY KEY (day, scenario_id, rate, hs_code, buyer_province, buyer_type)
+    ) WITHOUT ROWID
+    """,
+    # 8: aggregate the invoices saved so far
+    lambda conn: _reports().rebuild(conn),
+    # 9: built payloads waiting to be sent to FBR (see outbox.py). Times are unix seconds.
+    """
+    CREATE TABLE outbox (
+        id INTEGER PRIMARY KEY,
+        idempotency_key TEXT NOT NULL UNIQUE,
+        scenario_id TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        api_url TEXT NOT NULL,
+        bearer_token TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        lease_until REAL,
+        status_code INTEGER,
+        response TEXT,
+        invoice_number TEXT,
+        last_error TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    );
+    CREATE INDEX idx_outbox_due ON outbox(status, next_attempt_at);
+    CREATE INDEX idx_outbox_updated ON outbox(status, updated_at)
+    """,
+    # 10: compression dictionaries for invoice payloads (see payload_codec.py); rows are never changed
+    """
+    CREATE TABLE payload_dictionaries (
+        id INTEGER PRIMARY KEY,
+        codec TEXT NOT NULL,
+        dictionary BLOB NOT NULL,
+        created_at DATETIME NOT NULL
+    )
+    """,
+    # 11: the month each invoice moved out to an archive file went to (see archive.py)
+    """
+    CREATE TABLE archived_invoices (
+        invoice_number TEXT PRIMARY KEY,
+        period TEXT NOT NULL
+    ) WITHOUT ROWID
+    """,
+    # 12: canonical payload hashes, checked before sending so an invoice is never issued twice (see dedup.py)
+    """
+    ALTER TABLE invoices ADD COLUMN payload_hash TEXT;
+    ALTER TABLE outbox ADD COLUMN payload_hash TEXT;
+    CREATE UNIQUE INDEX idx_invoices_payload_hash ON invoices (payload_hash);
+    CREATE INDEX idx_outbox_payload_hash ON outbox (payload_hash, status)
+    """,
+    # 13: hash the invoices saved so far
+    lambda conn: _dedup().backfill(conn),
+    # 14: reference lists (HS codes, units of measure, rates, SRO references; see refdata.py)
+    """
+    CREATE TABLE reference_codes (
+        id INTEGER PRIMARY KEY,
+        kind TEXT NOT NULL,
+        scope TEXT NOT NULL,
+        code TEXT NOT NULL,
+        code_key TEXT NOT NULL,
+        description TEXT NOT NULL,
+        position INTEGER NOT NULL
+    );
+    CREATE UNIQUE INDEX idx_reference_codes_key ON reference_codes (kind, scope, code_key);
+    CREATE INDEX idx_reference_codes_position ON reference_codes (kind, scope, position);
+    CREATE VIRTUAL TABLE reference_fts USING fts5(
+        code, description, tokenize = 'unicode61 remove_diacritics 2'
+    );
+    CREATE TABLE reference_lists (
+        kind TEXT PRIMARY KEY,
+        source TEXT NOT NULL,
+        entry_count INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        loaded_at DATETIME NOT NULL
+    ) WITHOUT ROWID
+    """,
+    # 15: fill the reference lists with the shipped defaults
+    lambda conn: _refdata().load_defaults(conn),
+    # 16: payload hashes of archived invoices, so they are not issued again either (see dedup.py)
+    """
+    ALTER TABLE archived_invoices ADD COLUMN payload_hash TEXT;
+    CREATE INDEX idx_archived_invoices_payload_hash ON archived_invoices (payload_hash)
+    """,
+    # 17: hash the invoices archived so far
+    lambda conn: _archive().backfill_hashes(conn),
+]
+
+
+def _invoices():
+    # Imported lazily: invoices.py holds the payload <-> column mapping used by migrations
+    import invoices
+    return invoices
+
+
+def _reports():
+    import reports
+    return reports
+
+
+def _dedup():
+    import dedup
+    return dedup
+
+
+def _refdata():
+    import refdata
+    return refdata
+
+
+def _archive():
+    import archive
+    return archive
+
+
+_db_path = None
+_local = threading.local()
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def connect(path=None):
+    """Open a new connection with the tuned pragmas applied"""
+    # Autocommit mode: transactions are always opened explicitly
+    conn = sqlite3.connect(path or _db_path, timeout=30, check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    for name, value in PRAGMAS:
+        conn.execute(f'PRAGMA {name} = {value}')
+    return conn
+
+
+def init_db(path):
+    """Create or migrate the schema. Call once at startup, before any other function."""
+    global _db_path
+    _db_path = path
+    conn = connect(path)
+    try:
+        migrate(conn)
+    finally:
+        conn.close()
+
+
+def migrate(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        log.info('Applying database migration %d', number)
+        if callable(migration):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {number}')
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        else:
+            conn.executescript(f'BEGIN IMMEDIATE; {migration}; PRAGMA user_version = {number}; COMMIT;')
+
+
+def schema_is_current(conn):
+    """Whether every migration has been applied to the database behind ``conn``"""
+    return conn.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+
+
+def database_path():
+    """Path of the database init_db() opened, or None before it is called"""
+    return _db_path
+
+
+def get_connection():
+    """Return this thread's read connection"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.pid != os.getpid() or _local.path != _db_path:
+        conn = connect()
+        _local.conn, _local.pid, _local.path = conn, os.getpid(), _db_path
+    return conn
+
+
+# ---------------- SINGLE WRITER -----------------
+class _Writer(threading.Thread):
+    def __init__(self, path):
+        super().__init__(name='sqlite-writer', daemon=True)
+        self.path = path
+        self.pid = os.getpid()
+        self.jobs = queue.Queue()
+
+    def run(self):
+        conn = connect(self.path)
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    self.jobs.put(None)
+                    break
+                batch.append(job)
+            self._commit(conn, batch)
+        conn.close()
+
+    def _commit(self, conn, batch):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.Error as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        results = []
+        for func, args, future in batch:
+            # A savepoint per job, so one failing write doesn't undo the others in the batch
+            conn.execute('SAVEPOINT job')
+            try:
+                results.append((future, func(conn, *args), None))
+                conn.execute('RELEASE job')
+            except BaseException as e:
+                conn.execute('ROLLBACK TO job')
+                conn.execute('RELEASE job')
+                results.append((future, None, e))
+        try:
+            conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            conn.execute('ROLLBACK')
+            results = [(future, None, e) for future, _, _ in results]
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+def _get_writer():
+    global _writer
+    if _writer is None or _writer.pid != os.getpid() or _writer.path != _db_path:
+        with _writer_lock:
+            if _writer is None or _writer.pid != os.getpid() or _writer.path != _db_path:
+                _writer = _Writer(_db_path)
+                _writer.start()
+    return _writer
+
+
+def write(func, *args):
+    """Queue ``func(conn, *args)`` on the writer thread and return a Future of its result"""
+    future = Future()
+    _get_writer().jobs.put((func, args, future))
+    return future
+
+
+def run_write(func, *args):
+    """Run ``func(conn, *args)`` on the writer thread and wait for it to commit"""
+    return write(func, *args).result()
+
+
+def close():
+    """Stop the writer after it drains its queue"""
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None and writer.pid == os.getpid():
+        writer.jobs.put(None)
+        writer.join()
+
+
+atexit.register(close)
@@ -0,0 +1,69 @@
+"""Invoice money arithmetic.
+
+Line and invoice totals are computed once, when an invoice is saved, with
+Decimal arithmetic rounded half-up to the paisa, and stored as integer paisa
+so sums in SQL stay exact. Every line figure is rounded before it is added up,
+so the printed totals always equal the sum of the printed rows.
+"""
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+PAISA = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+# Invoice-level totals, in the order they appear on the printed invoice
+TOTAL_FIELDS = ('value_excl_st', 'sales_tax', 'further_tax', 'discount', 'grand_total')
+
+
+def to_decimal(value):
+    """An amount as a Decimal rounded to the paisa; blanks and junk count as zero"""
+    if value is None or value == '':
+        return ZERO
+    try:
+        amount = Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        return ZERO
+    if not amount.is_finite():
+        return ZERO
+    return amount.quantize(PAISA, rounding=ROUND_HALF_UP)
+
+def to_paisa(amount):
+    return int((to_decimal(amount) * 100).to_integral_value())
+
+def from_paisa(paisa):
+    if paisa is None:
+        return None
+    return (Decimal(int(paisa)) / 100).quantize(PAISA)
+
+def line_totals(item):
+    """Totals of one payload item: its amounts, unit price and line total (incl. taxes, less discount)"""
+    value = to_decimal(item.get('valueSalesExcludingST'))
+    sales_tax = to_decimal(item.get('salesTaxApplicable'))
+    further_tax = to_decimal(item.get('furtherTax'))
+    discount = to_decimal(item.get('discount'))
+    try:
+        quantity = Decimal(str(item.get('quantity', 1)))
+    except (InvalidOperation, ValueError):
+        quantity = ZERO
+    if not quantity.is_finite():
+        quantity = ZERO
+    unit_price = (value / quantity).quantize(PAISA, rounding=ROUND_HALF_UP) if quantity > 0 else ZERO
+    return {
+        'value_excl_st': value,
+        'sales_tax': sales_tax,
+        'further_tax': further_tax,
+        'discount': discount,
+        'unit_price': unit_price,
+        'line_total': value + sales_tax + further_tax - discount,
+    }
+
+def invoice_totals(items):
+    """``(lines, totals)`` for a list of payload items"""
+    lines = [line_totals(item) for item in items]
+    totals = {
+        'value_excl_st': sum((line['value_excl_st'] for line in lines), ZERO),
+        'sales_tax': sum((line['sales_tax'] for line in lines), ZERO),
+        'further_tax': sum((line['further_tax'] for line in lines), ZERO),
+        'discount': sum((line['discount'] for line in lines), ZERO),
+        'grand_total': sum((line['line_total'] for line in lines), ZERO),
+    }
+    return lines, totals
@@ -0,0 +1,200 @@
+"""Local pre-submission checks.
+
+Catches invoices FBR would reject (wrong rate for the scenario, missing SRO
+references, sales tax that doesn't match value x rate, malformed NTN/CNIC)
+before they cost an API round-trip and rate-limit budget. The checks for each
+scenario are put together once from its ``rules`` in scenarios.py, and only
+compare values already in the payload, so thousands of invoices can be checked
+per second. HS codes and units of measure are also checked against the
+reference lists in refdata.py, once those are loaded from a file or FBR; they
+are held in memory, so this adds no query either.
+
+``validate()`` returns a list of errors, each ``{'field', 'code', 'message'}``
+where ``field`` is the payload path, e.g. ``items[2].salesTaxApplicable``.
+An empty list means the invoice passed.
+"""
+import math
+import re
+from datetime import datetime
+
+import refdata
+from scenarios import SCENARIOS
+
+STANDARD_RATE = 18.0
+# Allowed difference between the sales tax given and value x rate, in rupees
+SALES_TAX_TOLERANCE = 1.0
+
+_PERCENT_RE = re.compile(r'\s*(\d+(?:\.\d+)?)\s*%\s*')
+_DIGITS_RE = re.compile(r'\d+')
+_DATE_RE = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+class ValidationError(ValueError):
+    """Raised with the list of errors when an invoice fails validation"""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(format_errors(errors))
+
+
+def validate(scenario_id, payload):
+    """Errors for one payload; an unknown scenario is itself an error"""
+    validator = VALIDATORS.get(scenario_id)
+    if validator is None:
+        return [_error('scenarioId', 'unknown_scenario', f'Scenario {scenario_id} is not supported')]
+    return validator(payload)
+
+def check(scenario_id, payload):
+    """Raise ValidationError unless the payload passes"""
+    errors = validate(scenario_id, payload)
+    if errors:
+        raise ValidationError(errors)
+
+def format_errors(errors):
+    return '; '.join(f"{error['field']}: {error['message']}" for error in errors)
+
+
+# ---------------- BUILDING VALIDATORS -----------------
+def compile_validator(scenario_id, scenario):
+    """``validate(payload) -> errors`` for one scenario, with its rules resolved up front"""
+    rules = scenario.get('rules') or {}
+    allowed_rates = frozenset(_normalise_rate(rate) for rate in rules.get('rates') or ())
+    reduced_rate = rules.get('reduced_rate', False)
+    sro_required = rules.get('sro_required', False)
+    fixed_value_required = rules.get('fixed_value_required', False)
+    tax_on_retail_price = rules.get('tax_on_retail_price', False)
+    buyer_types = tuple(rules.get('buyer_types') or (scenario['buyer_type'],))
+    expected_rates = ', '.join(sorted(allowed_rates))
+
+    def validate_payload(payload):
+        errors = []
+        _check_header(payload, errors)
+        hs_codes, uoms = refdata.known('hs_codes'), refdata.known('uoms')
+
+        buyer_type = payload.get('buyerRegistrationType')
+        if buyer_type not in buyer_types:
+            errors.append(_error('buyerRegistrationType', 'buyer_type_not_allowed',
+                                 f"{scenario_id} is for {' or '.join(buyer_types)} buyers, not {buyer_type or 'blank'}"))
+        _check_ntn_cnic(payload, 'buyerNTNCNIC', errors, required=buyer_type == 'Registered')
+
+        items = payload.get('items')
+        if not isinstance(items, list) or not items:
+            errors.append(_error('items', 'required', 'At least one item is required'))
+            return errors
+
+        for index, item in enumerate(items):
+            prefix = f'items[{index}].'
+            if not isinstance(item, dict):
+                errors.append(_error(f'items[{index}]', 'invalid', 'Item must be an object'))
+                continue
+            for field in ('hsCode', 'productDescription', 'uoM'):
+                if _blank(item.get(field)):
+                    errors.append(_error(prefix + field, 'required', 'Required'))
+            _check_reference(item, 'hsCode', hs_codes, 'unknown_hs_code', 'HS code', prefix, errors)
+            _check_reference(item, 'uoM', uoms, 'unknown_uom', 'unit of measure', prefix, errors)
+
+            quantity = _number(item.get('quantity'))
+            value = _number(item.get('valueSalesExcludingST'))
+            sales_tax = _number(item.get('salesTaxApplicable'))
+            if quantity is None or quantity < 0:
+                errors.append(_error(prefix + 'quantity', 'invalid', 'Must be a number of 0 or more'))
+            if value is None or value < 0:
+                errors.append(_error(prefix + 'valueSalesExcludingST', 'invalid', 'Must be an amount of 0 or more'))
+            if sales_tax is None or sales_tax < 0:
+                errors.append(_error(prefix + 'salesTaxApplicable', 'invalid', 'Must be an amount of 0 or more'))
+
+            rate = _normalise_rate(item.get('rate'))
+            percent = _percent(rate)
+            if allowed_rates and rate not in allowed_rates:
+                errors.append(_error(prefix + 'rate', 'rate_not_allowed',
+                                     f"Rate {item.get('rate') or 'blank'} is not allowed for {scenario_id} (expected {expected_rates})"))
+            elif reduced_rate and (percent is None or not 0 < percent < STANDARD_RATE):
+                errors.append(_error(prefix + 'rate', 'rate_not_allowed',
+                                     f"{scenario_id} needs a reduced rate below {STANDARD_RATE:g}%, not {item.get('rate') or 'blank'}"))
+
+            if sro_required:
+                for field in ('sroScheduleNo', 'sroItemSerialNo'):
+                    if _blank(item.get(field)):
+                        errors.append(_error(prefix + field, 'required', f'Required for {scenario_id}'))
+            retail_price = _number(item.get('fixedNotifiedValueOrRetailPrice'))
+            if fixed_value_required and not retail_price:
+                errors.append(_error(prefix + 'fixedNotifiedValueOrRetailPrice', 'required', f'Required for {scenario_id}'))
+
+            if sales_tax is not None and value is not None:
+                if rate == 'exempt' and sales_tax:
+                    errors.append(_error(prefix + 'salesTaxApplicable', 'sales_tax_mismatch',
+                                         'Exempt items carry no sales tax'))
+                elif percent is not None and abs(sales_tax - value * percent / 100) > SALES_TAX_TOLERANCE:
+                    if not (tax_on_retail_price and retail_price
+                            and abs(sales_tax - retail_price * percent / 100) <= SALES_TAX_TOLERANCE):
+                        errors.append(_error(prefix + 'salesTaxApplicable', 'sales_tax_mismatch',
+                                             f'{sales_tax:.2f} does not match {value:.2f} x {percent:g}% = '
+                                             f'{value * percent / 100:.2f}'))
+        return errors
+
+    validate_payload.__name__ = f'validate_{scenario_id.lower()}'
+    return validate_payload
+
+def _check_header(payload, errors):
+    invoice_date = payload.get('invoiceDate')
+    if not isinstance(invoice_date, str) or not _DATE_RE.fullmatch(invoice_date) or not _valid_date(invoice_date):
+        errors.append(_error('invoiceDate', 'invalid', 'Must be a date as YYYY-MM-DD'))
+    for field in ('sellerBusinessName', 'sellerProvince', 'sellerAddress', 'buyerBusinessName', 'buyerProvince'):
+        if _blank(payload.get(field)):
+            errors.append(_error(field, 'required', 'Required'))
+    _check_ntn_cnic(payload, 'sellerNTNCNIC', errors, required=True)
+
+def _check_ntn_cnic(payload, field, errors, required):
+    value = payload.get(field)
+    if _blank(value):
+        if required:
+            errors.append(_error(field, 'required', 'Required'))
+        return
+    value = str(value).strip()
+    if not _DIGITS_RE.fullmatch(value) or len(value) not in (7, 13):
+        errors.append(_error(field, 'invalid_ntn_cnic', 'Must be a 7 digit NTN or a 13 digit CNIC, digits only'))
+
+def _check_reference(item, field, known, code, label, prefix, errors):
+    value = item.get(field)
+    if known is None or _blank(value) or value in known:
+        return
+    suggestion = known.suggestion(value)
+    hint = f'; did you mean {suggestion}?' if suggestion else ''
+    errors.append(_error(prefix + field, code, f'{value} is not a known {label}{hint}'))
+
+
+def _error(field, code, message):
+    return {'field': field, 'code': code, 'message': message}
+
+def _blank(value):
+    return value is None or (isinstance(value, str) and not value.strip())
+
+def _number(value):
+    if isinstance(value, (int, float)):
+        return float(value) if math.isfinite(value) else None
+    if isinstance(value, str) and value.strip():
+        try:
+            number = float(value)
+        except ValueError:
+            return None
+        return number if math.isfinite(number) else None
+    return 0.0 if _blank(value) else None
+
+def _normalise_rate(rate):
+    if rate is None:
+        return ''
+    return str(rate).replace(' ', '').lower()
+
+def _percent(rate):
+    match = _PERCENT_RE.fullmatch(rate)
+    return float(match.group(1)) if match else None
+
+def _valid_date(value):
+    try:
+        datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return False
+    return True
+
+
+VALIDATORS = {scenario_id: compile_validator(scenario_id, scenario) for scenario_id, scenario in SCENARIOS.items()}
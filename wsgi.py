@@ -0,0 +1,17 @@
+"""Production WSGI entry point.
+
+    gunicorn -c gunicorn.conf.py
+
+gunicorn.conf.py has gunicorn call ``create_app()`` once, in the master
+process, and fork the workers from it afterwards. Everything loaded up to that
+point (the app and its templates, the schema migration, WeasyPrint with the
+invoice stylesheet and fonts, the QR encoder, the static assets) is shared by
+every worker copy-on-write, so no worker pays for it on its first invoice.
+"""
+import app as flask_app
+
+
+def create_app():
+    """The Flask app, warmed up"""
+    flask_app.warm_up()
+    return flask_app.app